@@ -1,4 +1,19 @@
-class Object:
+class _SlottedNode:
+    # NOTE: base of the node classes, which use __slots__ instead of a per-instance __dict__
+    # -- to keep memory low on large graphs. Pickling goes through a dict of all slots, and
+    # -- unpickling also accepts the __dict__ of instances pickled before the classes had slots.
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class Object(_SlottedNode):
     # NOTE: -- an object node is any item that is used in the cooking/manipulation procedure.
     # 	an Object has a state type and state label to describe the state or condition it is observed in.
     # -- an Object may have multiple states! This is given by multiple lines of 'S' in the textfiles.
@@ -10,6 +25,11 @@ class Object:
 
     """
 
+    # NOTE: every attribute an Object can have; states and ingredients are lists while an object is parsed
+    # -- and become tuples once ObjectRegistry interns it into a graph.
+    __slots__ = ('label', 'states', 'ingredients', 'container', 'id',
+                 'object_in_motion', 'recipe_category', 'vocab_key', 'vocabulary')
+
     # NOTE: constructor for Object node:
     def __init__(self, label=None):
         # -- member variables
@@ -18,6 +38,19 @@ class Object:
         self.ingredients = []
         self.container = None
         self.id = None  # id = index of this object in the object list
+        # -- optional third and fourth fields of an 'O' line in FOON.txt
+        self.object_in_motion = None
+        self.recipe_category = None
+        # -- set by ObjectRegistry when the object is interned: (label id, state ids, ingredient ids, container id),
+        # -- and the Vocabulary these ids are in; objects coded by the same vocabulary can be compared as int tuples.
+        self.vocab_key = None
+        self.vocabulary = None
+
+    # NOTE: the codes only mean something next to the registry that gave them, which is not pickled with the node.
+    def __getstate__(self):
+        state = _SlottedNode.__getstate__(self)
+        state['vocab_key'] = state['vocabulary'] = None
+        return state
 
     # -- accessor methods for Objects:
     def getStateLabel(self, X):
@@ -65,8 +98,7 @@ class Object:
                 return
             # endif
         # endfor
-        self.states.append(list(T))
-        self.states.sort()
+        self.states = sorted(list(self.states) + [list(T)])
 
     def printObject(self):
         print("O" + "\t" + self.getObjectLabel())
@@ -82,12 +114,20 @@ class Object:
 
     # checks if two objects are same
     def check_object_equal(self, T):
+        # int codes are only comparable when the same vocabulary gave them
+        if self.vocabulary is not None and self.vocabulary is T.vocabulary:
+            return self.vocab_key == T.vocab_key
         if self.label == T.label and sorted(self.states) == sorted(T.states) \
             and sorted(self.ingredients) == sorted(T.ingredients) \
                 and self.container == T.container:
             return True
         return False
 
+    # returns a hashable key; two objects are equal (check_object_equal) iff their keys are equal
+    def get_object_key(self):
+        return (self.label, tuple(sorted(self.states)),
+                tuple(sorted(self.ingredients)), self.container)
+
     # checks if an objet exist in a list of objects
     def check_object_exist(self, object_list):
         for index, object in enumerate(object_list):
@@ -131,7 +171,7 @@ class Object:
         return str
 
 
-class Motion:
+class Motion(_SlottedNode):
     # NOTE: -- a Motion node is the other node that is found in the bipartite FOON graph.
     # -- a Motion node reflects a manipulation or non-manipulation action that is needed to change (some) objects from one state to another
     # -- a Motion node simply has a type that describes what it is along with a label.
@@ -143,13 +183,17 @@ class Motion:
             motionLabel (str): A string referring to the motion's label
     '''
 
+    __slots__ = ('label',)
+
     # NOTE: constructor for Motion node:
     def __init__(self, motionLabel=None):
         # -- member variables
         self.label = motionLabel
 
 
-class FunctionalUnit:
+class FunctionalUnit(_SlottedNode):
+
+    __slots__ = ('input_nodes', 'output_nodes', 'motion_node', 'id', 'motion_id')
 
     def __init__(self):
         # NOTE: list of input and output object nodes (which use the Object class defined above):
@@ -157,6 +201,18 @@ class FunctionalUnit:
         self.output_nodes = []
         self.motion_node = None
         self.id = None  # id = index of this FU in the functional unit list
+        self.motion_id = None  # id of motion_node in the motion vocabulary of the graph, set when the graph is built
+
+    # returns a hashable key built from the motion, the number of input and output nodes and the sorted
+    # keys of the distinct input and output objects; FUs are duplicates for check_if_FU_exist when they
+    # have the same motion, as many nodes, and every node of one is among the nodes of the other, so a
+    # node listed twice does not tell two FUs apart
+    def get_FU_key(self):
+        return (self.motion_node,
+                len(self.input_nodes),
+                tuple(sorted(set(node.get_object_key() for node in self.input_nodes), key=_object_key_order)),
+                len(self.output_nodes),
+                tuple(sorted(set(node.get_object_key() for node in self.output_nodes), key=_object_key_order)))
 
     def check_if_FU_exist(self, functional_units):
 
@@ -191,3 +247,141 @@ class FunctionalUnit:
             str += node.get_object_as_text()
         str += "//"
         return str
+
+
+class Vocabulary:
+    '''
+    Maps each distinct string (label, state, ingredient, container or motion) to a small int.
+    The first time a string is added, that instance is kept and shared by every node using it.
+    '''
+
+    NONE_ID = -1  # id of a missing string (e.g. an object without container)
+
+    def __init__(self):
+        self.strings = []  # index = string id
+        self.ids = {}  # key = string, value = string id
+
+    def __len__(self):
+        return len(self.strings)
+
+    def add(self, text):
+        if text is None:
+            return self.NONE_ID
+        sid = self.ids.get(text)
+        if sid is None:
+            sid = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+        return sid
+
+    # returns the id of a string, or None if the string was never added
+    def get_id(self, text):
+        if text is None:
+            return self.NONE_ID
+        return self.ids.get(text)
+
+    def get_string(self, sid):
+        if sid == self.NONE_ID:
+            return None
+        return self.strings[sid]
+
+
+class ObjectRegistry:
+    '''
+    An interning table for object nodes.
+    Each distinct object (by get_object_key) is stored once and gets the next id,
+    so both assigning ids while building and finding a goal node are dict lookups.
+
+    The strings of an object are added to the registry's vocabulary when the object is
+    first registered, so the vocabulary only depends on the object list: a registry
+    rebuilt with from_objects gives every string (and every vocab_key) the same id.
+
+    A node keeps the codes (vocab_key and vocabulary) of the first registry that coded it; another
+    registry built over the same nodes (e.g. by an index) finds their codes with get_vocab_key
+    instead of overwriting them.
+    '''
+
+    def __init__(self):
+        self.object_nodes = []  # index = object id
+        self.object_ids = {}  # key = vocab key (object key as string ids), value = object id
+        self.vocabulary = Vocabulary()
+
+    @classmethod
+    def from_objects(cls, object_nodes):
+        # rebuild the registry from an already numbered object list (e.g. loaded from FOON.pkl)
+        registry = cls()
+        registry.object_nodes = object_nodes
+        for index, node in enumerate(object_nodes):
+            vocab_key = registry._encode_key(node.get_object_key(), add=True)
+            registry.object_ids.setdefault(vocab_key, index)
+            if node.vocabulary is None:
+                registry._share_strings(node, vocab_key)
+        return registry
+
+    def __len__(self):
+        return len(self.object_nodes)
+
+    # sets node.id to the id of the equal object, registering the node first if it is new
+    def intern(self, node, key=None):
+        if key is None:
+            key = node.get_object_key()
+        vocab_key = self._encode_key(key)
+        object_id = self.object_ids.get(vocab_key) if vocab_key is not None else None
+        if object_id is None:
+            vocab_key = self._encode_key(key, add=True)
+            object_id = len(self.object_nodes)
+            self.object_ids[vocab_key] = object_id
+            self.object_nodes.append(node)
+        self._share_strings(node, vocab_key)
+        node.id = object_id
+        return object_id
+
+    # returns the registered instance in place of an interned node that is identical to it,
+    # so FUs share one instance per object instead of each holding its own copy
+    def get_shared_node(self, node):
+        registered = self.object_nodes[node.id]
+        if registered is not node and registered.__getstate__() == node.__getstate__():
+            return registered
+        return node
+
+    # returns the key of the node as string ids of this registry's vocabulary; None if a string
+    # is unknown and add is False
+    def get_vocab_key(self, node, add=False):
+        if node.vocabulary is self.vocabulary:
+            return node.vocab_key
+        return self._encode_key(node.get_object_key(), add)
+
+    # returns the id of the equal object, or -1 like check_object_exist
+    def lookup(self, node):
+        vocab_key = self._encode_key(node.get_object_key())
+        if vocab_key is None:
+            return -1
+        return self.object_ids.get(vocab_key, -1)
+
+    # turns an object key into a tuple of string ids; None if a string is unknown and add is False
+    def _encode_key(self, key, add=False):
+        encode = self.vocabulary.add if add else self.vocabulary.get_id
+        label, states, ingredients, container = key
+        label_id = encode(label)
+        state_ids = tuple(encode(state) for state in states)
+        ingredient_ids = tuple(encode(ingredient) for ingredient in ingredients)
+        container_id = encode(container)
+        if label_id is None or container_id is None or None in state_ids or None in ingredient_ids:
+            return None
+        return (label_id, state_ids, ingredient_ids, container_id)
+
+    # points the node's strings at the vocabulary's instances, so equal strings are stored once,
+    # and stores its states and ingredients as tuples
+    def _share_strings(self, node, vocab_key):
+        strings = self.vocabulary.strings
+        ids = self.vocabulary.ids
+        node.label = strings[vocab_key[0]]
+        node.states = tuple(strings[ids[state]] for state in node.states)
+        node.ingredients = tuple(strings[ids[ingredient]] for ingredient in node.ingredients)
+        node.container = self.vocabulary.get_string(vocab_key[3])
+        node.vocab_key = vocab_key
+        node.vocabulary = self.vocabulary
+
+
+# sort order for object keys; the container can be None, which does not compare with str
+def _object_key_order(key):
+    return key[:3] + (key[3] is not None, key[3] or '')
@@ -0,0 +1,152 @@
+import json
+import random
+import sys
+import time
+
+from FOON_class import FunctionalUnit, Object
+from FOON_index import AttributeIndex, KitchenIndex, compile_kitchen
+from search import read_universal_foon, search_BFS, search_BFS_batch
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Compares search_BFS with the list-based version it replaced, on every goal of goal_nodes.json and on
+# larger synthetic graphs, and checks that both give the same task tree. Then compares one search_BFS per
+# goal with search_BFS_batch on many goals at once.
+
+
+def search_BFS_legacy(kitchen_items=[], goal_node=None, foon_object_nodes=None, foon_functional_units=None, foon_object_to_FU_map=None,utensils=None):
+    # search_BFS before it moved to a deque and visited bitmap: list.pop(0) and list membership tests
+    reference_task_tree = []
+    kitchen = compile_kitchen(kitchen_items)
+    items_to_search = [goal_node.id]
+    items_already_searched = []
+
+    while len(items_to_search) > 0:
+        current_item_index = items_to_search.pop(0)
+        if current_item_index in items_already_searched:
+            continue
+        else:
+            items_already_searched.append(current_item_index)
+
+        current_item = foon_object_nodes[current_item_index]
+
+        if not kitchen.contains(current_item):
+            candidate_units = foon_object_to_FU_map[current_item_index]
+            selected_candidate_idx = candidate_units[0]
+            if selected_candidate_idx in reference_task_tree:
+                continue
+
+            reference_task_tree.append(selected_candidate_idx)
+
+            for node in foon_functional_units[selected_candidate_idx].input_nodes:
+                node_idx = node.id
+                if node_idx not in items_to_search:
+                    flag = True
+                    if node.label in utensils and len(node.ingredients) == 1:
+                        for node2 in foon_functional_units[selected_candidate_idx].input_nodes:
+                            if node2.label == node.ingredients[0] and node2.container == node.label:
+                                flag = False
+                                break
+                    if flag:
+                        items_to_search.append(node_idx)
+
+    reference_task_tree.reverse()
+    return [foon_functional_units[i] for i in reference_task_tree]
+
+
+def make_synthetic_graph(num_objects, fan_in=3, window=50, seed=0):
+    """
+        parameters: number of objects, number of inputs of each FU,
+                    how far (in ids) an input can be from the object it makes, random seed
+        returns: functional_units (list), object_nodes (list), object_to_FU_map (dict) and the kitchen
+                 items (list): object 0 is the goal, the last objects are in the kitchen, and every
+                 other object is made by one or two FU from objects with larger ids
+    """
+    rng = random.Random(seed)
+    object_nodes = []
+    for index in range(num_objects):
+        node = Object('item %d' % index)
+        node.states = ('made',)
+        node.id = index
+        object_nodes.append(node)
+
+    num_kitchen_items = window
+    functional_units = []
+    object_to_FU_map = {}
+    for index in range(num_objects - num_kitchen_items):
+        for _ in range(rng.randint(1, 2)):
+            FU = FunctionalUnit()
+            FU.id = len(functional_units)
+            FU.motion_node = 'mix'
+            candidates = range(index + 1, min(num_objects, index + 1 + window))
+            FU.input_nodes = [object_nodes[i] for i in rng.sample(candidates, min(fan_in, len(candidates)))]
+            FU.output_nodes = [object_nodes[index]]
+            functional_units.append(FU)
+            object_to_FU_map.setdefault(index, []).append(FU.id)
+
+    kitchen_items = [{"label": node.label, "states": list(node.states), "ingredients": [], "container": None}
+                     for node in object_nodes[num_objects - num_kitchen_items:]]
+    return functional_units, object_nodes, object_to_FU_map, kitchen_items
+
+
+def time_search(search, *args):
+    start = time.perf_counter()
+    task_tree = search(*args)
+    return task_tree, time.perf_counter() - start
+
+
+def compare(name, kitchen, goal_node, object_nodes, functional_units, object_to_FU_map, utensils):
+    args = (kitchen, goal_node, object_nodes, functional_units, object_to_FU_map, utensils)
+    legacy_tree, legacy_time = time_search(search_BFS_legacy, *args)
+    task_tree, new_time = time_search(search_BFS, *args)
+    assert task_tree == legacy_tree, 'search_BFS gave a different task tree for ' + name
+    print('-- %-28s FU: %6d | legacy: %9.2f ms | search_BFS: %8.2f ms' %
+          (name, len(task_tree), legacy_time * 1000, new_time * 1000))
+
+
+def compare_batch(name, kitchen, goal_nodes, object_nodes, functional_units, object_to_FU_map, utensils):
+    start = time.perf_counter()
+    task_trees = [search_BFS(kitchen, goal_node, object_nodes, functional_units, object_to_FU_map, utensils)
+                  for goal_node in goal_nodes]
+    single_time = time.perf_counter() - start
+    (batch_trees, merged_task_tree), batch_time = time_search(search_BFS_batch, kitchen, goal_nodes, object_nodes,
+                                                              functional_units, object_to_FU_map, utensils)
+    assert batch_trees == task_trees, 'search_BFS_batch gave a different task tree for ' + name
+    print('-- %-28s goals: %5d | FU in all trees: %7d | distinct FU: %5d | one by one: %8.2f ms | batch: %8.2f ms' %
+          (name, len(goal_nodes), sum(len(task_tree) for task_tree in task_trees), len(merged_task_tree),
+           single_time * 1000, batch_time * 1000))
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 5000, 20000]
+
+    foon_functional_units, foon_object_nodes, foon_object_to_FU_map = read_universal_foon()
+    with open('utensils.txt', 'r') as f:
+        utensils = [line.rstrip() for line in f]
+    kitchen_items = json.load(open('kitchen.json'))
+    goal_nodes = json.load(open('goal_nodes.json'))
+    attribute_index = AttributeIndex(foon_object_nodes)
+    kitchen = KitchenIndex(kitchen_items, foon_object_nodes, attribute_index)
+
+    for node in goal_nodes:
+        node_object = Object(node["label"])
+        node_object.states = node["states"]
+        node_object.ingredients = node["ingredients"]
+        node_object.container = node["container"]
+        goal_node = attribute_index.find(node_object)
+        if goal_node is not None:
+            compare(node["label"], kitchen, goal_node, foon_object_nodes, foon_functional_units,
+                    foon_object_to_FU_map, utensils)
+
+    for size in sizes:
+        functional_units, object_nodes, object_to_FU_map, synthetic_kitchen = make_synthetic_graph(size)
+        compare('synthetic, %d objects' % size, KitchenIndex(synthetic_kitchen, object_nodes), object_nodes[0],
+                object_nodes, functional_units, object_to_FU_map, [])
+
+    # every object of the universal foon as a goal, then every tenth object of each synthetic graph
+    compare_batch('universal foon, all objects', kitchen, foon_object_nodes, foon_object_nodes, foon_functional_units,
+                  foon_object_to_FU_map, utensils)
+    for size in sizes:
+        functional_units, object_nodes, object_to_FU_map, synthetic_kitchen = make_synthetic_graph(size)
+        compare_batch('synthetic, %d objects' % size, KitchenIndex(synthetic_kitchen, object_nodes),
+                      object_nodes[:size // 2:10], object_nodes, functional_units, object_to_FU_map, [])
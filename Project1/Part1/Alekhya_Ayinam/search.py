@@ -1,6 +1,9 @@
-import pickle
 import json
+from collections import deque
 from FOON_class import Object
+from FOON_cache import get_utensil_fingerprint
+from FOON_index import AttributeIndex, KitchenIndex, ReachabilityIndex, compile_kitchen, get_inputs_to_search
+from preprocess import load_graph
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
@@ -9,48 +12,64 @@ from FOON_class import Object
 
 def check_if_exist_in_kitchen(kitchen_items, ingredient):
     """
-        parameters: a list of all kitchen items,
+        parameters: a list of all kitchen items (or a KitchenIndex of them),
                     an ingredient to be searched in the kitchen
         returns: True if ingredient exists in the kitchen
     """
 
-    for item in kitchen_items:
-        if item["label"] == ingredient.label \
-                and sorted(item["states"]) == sorted(ingredient.states) \
-                and sorted(item["ingredients"]) == sorted(ingredient.ingredients) \
-                and item["container"] == ingredient.container:
-            return True
-
-    return False
+    return compile_kitchen(kitchen_items).contains(ingredient)
 
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
 
-def search_BFS(kitchen_items=[], goal_node=None, foon_object_nodes=None, foon_functional_units=None, foon_object_to_FU_map=None,utensils=None):
-    # list of indices of functional units
-    reference_task_tree = []
-
-    # list of object indices that need to be searched
-    items_to_search = []
-
-    # find the index of the goal node in object node list
-    items_to_search.append(goal_node.id)
-
-    # list of items already explored
-    items_already_searched = []
-
-    while len(items_to_search) > 0:
-        current_item_index = items_to_search.pop(0)  # pop the first element
-        if current_item_index in items_already_searched:
+def search_BFS(kitchen_items=[], goal_node=None, foon_object_nodes=None, foon_functional_units=None, foon_object_to_FU_map=None,utensils=None, subtree_cache=None, reachable=None):
+    # indices of the selected functional units; a dict keeps them in the order they
+    # were selected and tells in O(1) whether an FU is already taken
+    reference_task_tree = {}
+
+    # the kitchen is compiled once, so each check below is a lookup instead of a scan of every item
+    kitchen = compile_kitchen(kitchen_items)
+    utensils = set(utensils) if utensils else set()
+
+    # with a ReachabilityIndex of the kitchen, a goal that cannot be made is known at once,
+    # and an object is made by its first FU that can run; its kitchen also holds the utensils
+    # it took as available
+    if reachable is not None:
+        if not reachable.is_makeable(goal_node):
+            return []
+        kitchen = reachable.kitchen
+
+    # a goal already solved in this kitchen, with these utensils, is not searched again; skipping the
+    # FUs that cannot run can select other FUs, so those trees are cached apart
+    algorithm = 'BFS' if reachable is None else 'BFS_reachable'
+    if subtree_cache is not None:
+        utensil_fingerprint = get_utensil_fingerprint(utensils)
+        FU_indices = subtree_cache.get(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm)
+        if FU_indices is not None:
+            return [foon_functional_units[i] for i in FU_indices]
+
+    # queue of object indices that need to be searched, starting from the goal node,
+    # and the set of indices in it (an index is never queued twice at the same time)
+    items_to_search = deque([goal_node.id])
+    items_in_queue = {goal_node.id}
+
+    # items already explored, one byte per object id
+    items_already_searched = bytearray(len(foon_object_nodes))
+
+    while items_to_search:
+        current_item_index = items_to_search.popleft()  # pop the first element
+        items_in_queue.discard(current_item_index)
+        if items_already_searched[current_item_index]:
             continue
-        else:
-            items_already_searched.append(current_item_index)
+        items_already_searched[current_item_index] = 1
 
         current_item = foon_object_nodes[current_item_index]
 
-        if not check_if_exist_in_kitchen(kitchen_items, current_item):
+        if not kitchen.contains(current_item):
             candidate_units = foon_object_to_FU_map[current_item_index]
+            if reachable is not None:
+                candidate_units = reachable.get_candidates(candidate_units)
 
             # selecting the first path
             selected_candidate_idx = candidate_units[0]
@@ -59,32 +78,138 @@ def search_BFS(kitchen_items=[], goal_node=None, foon_object_nodes=None, foon_fu
             if selected_candidate_idx in reference_task_tree:
                 continue
 
-            reference_task_tree.append(selected_candidate_idx)
+            reference_task_tree[selected_candidate_idx] = None
 
             # all input of the selected FU need to be explored
-            for node in foon_functional_units[selected_candidate_idx].input_nodes:
-                node_idx = node.id
-                if node_idx not in items_to_search:
-                    flag = True
-                    if node.label in utensils and len(node.ingredients) == 1:
-                        for node2 in foon_functional_units[selected_candidate_idx].input_nodes:
-                            if node2.label == node.ingredients[0] and node2.container == node.label:
-                                flag = False
-                                break
-                    if flag:
-                        items_to_search.append(node_idx)
-
-    # reverse the task tree
-    reference_task_tree.reverse()
-
-    # create a list of functional units from the indices of reference_task_tree
-    task_tree_units = []
-    for i in reference_task_tree:
-        task_tree_units.append(foon_functional_units[i])
+            for node_idx in get_inputs_to_search(foon_functional_units[selected_candidate_idx], utensils):
+                if node_idx not in items_in_queue:
+                    items_to_search.append(node_idx)
+                    items_in_queue.add(node_idx)
+
+    # create a list of functional units from the task tree, in reverse order of selection
+    FU_indices = list(reference_task_tree)[::-1]
+    if subtree_cache is not None:
+        subtree_cache.put(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm, FU_indices)
+    task_tree_units = [foon_functional_units[i] for i in FU_indices]
 
     return task_tree_units
 
 
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Batch search: many goals in one kitchen. Which FU makes an object, and which of its inputs have to be
+# explored, only depends on the object and the kitchen, so every object is expanded once for the whole
+# batch; each goal then only walks the memoized expansions to put its task tree in BFS order.
+
+
+def search_BFS_batch(kitchen_items=[], goal_nodes=None, foon_object_nodes=None, foon_functional_units=None, foon_object_to_FU_map=None, utensils=None, subtree_cache=None, reachable=None):
+    """
+        parameters: a list of all kitchen items (or a KitchenIndex of them),
+                    a list of goal nodes (object nodes of the graph),
+                    object nodes, functional units and object_to_FU_map of the graph,
+                    a list of utensils,
+                    a SubtreeCache (FOON_cache) that is read before and filled after each goal, or None,
+                    a ReachabilityIndex (FOON_index) of the kitchen, used as in search_BFS, or None
+        returns: task trees (list, one list of functional units per goal, the same as search_BFS
+                 gives for that goal),
+                 merged task tree (dict, key = index of every FU in any of the task trees,
+                 value = indices of the FUs that make its inputs); each FU is there once however
+                 many goals need it, and the keys are ordered so that an FU comes after the FUs it
+                 needs (as far as the graph has no cycle)
+    """
+    kitchen = compile_kitchen(kitchen_items) if reachable is None else reachable.kitchen
+    utensils = set(utensils) if utensils else set()
+    algorithm = 'BFS' if reachable is None else 'BFS_reachable'
+    utensil_fingerprint = get_utensil_fingerprint(utensils) if subtree_cache is not None else None
+
+    # key = object index, value = None if the object is in the kitchen,
+    # otherwise (index of the selected FU, indices of the inputs to explore)
+    expansions = {}
+
+    def expand(object_index):
+        if object_index not in expansions:
+            if kitchen.contains(foon_object_nodes[object_index]):
+                expansions[object_index] = None
+            else:
+                # selecting the first path, like search_BFS
+                candidate_units = foon_object_to_FU_map[object_index]
+                if reachable is not None:
+                    candidate_units = reachable.get_candidates(candidate_units)
+                selected_candidate_idx = candidate_units[0]
+                expansions[object_index] = (selected_candidate_idx, get_inputs_to_search(
+                    foon_functional_units[selected_candidate_idx], utensils))
+        return expansions[object_index]
+
+    task_tree_indices = []
+    for goal_node in goal_nodes:
+        if reachable is not None and not reachable.is_makeable(goal_node):
+            task_tree_indices.append([])
+            continue
+        if subtree_cache is not None:
+            FU_indices = subtree_cache.get(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm)
+            if FU_indices is not None:
+                task_tree_indices.append(list(FU_indices))
+                continue
+
+        # BFS over the expansions; an object is queued when it is first reached, which selects
+        # the FUs in the same order as the queue of search_BFS
+        reference_task_tree = {}
+        items_to_search = deque([goal_node.id])
+        items_reached = {goal_node.id}
+        while items_to_search:
+            expansion = expand(items_to_search.popleft())
+            if expansion is None:
+                continue
+            selected_candidate_idx, inputs_to_search = expansion
+            if selected_candidate_idx in reference_task_tree:
+                continue
+            reference_task_tree[selected_candidate_idx] = None
+            for node_idx in inputs_to_search:
+                if node_idx not in items_reached:
+                    items_reached.add(node_idx)
+                    items_to_search.append(node_idx)
+
+        FU_indices = list(reference_task_tree)[::-1]
+        if subtree_cache is not None:
+            subtree_cache.put(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm, FU_indices)
+        task_tree_indices.append(FU_indices)
+
+    # FU index -> indices of the FUs making its inputs, for every selected FU; the FUs of a
+    # tree taken from the cache are expanded here, since the walk above did not reach them
+    requirements = {}
+    for FU_indices in task_tree_indices:
+        for FU_idx in FU_indices:
+            if FU_idx not in requirements:
+                required = {}
+                for node_idx in get_inputs_to_search(foon_functional_units[FU_idx], utensils):
+                    expansion = expand(node_idx)
+                    if expansion is not None:
+                        required[expansion[0]] = None
+                requirements[FU_idx] = list(required)
+
+    # the merged tree lists the FUs of the goals' trees, each after the FUs it requires
+    merged_task_tree = {}
+    started = set()  # FUs whose requirements are being added; reaching one again means a cycle
+    for FU_indices in task_tree_indices:
+        for tree_FU_idx in FU_indices:
+            stack = [(tree_FU_idx, False)]
+            while stack:
+                FU_idx, requirements_added = stack.pop()
+                if requirements_added:
+                    merged_task_tree[FU_idx] = requirements[FU_idx]
+                    continue
+                if FU_idx in started:
+                    continue
+                started.add(FU_idx)
+                stack.append((FU_idx, True))
+                for required_idx in reversed(requirements[FU_idx]):
+                    if required_idx not in started:
+                        stack.append((required_idx, False))
+
+    task_trees = [[foon_functional_units[i] for i in FU_indices] for FU_indices in task_tree_indices]
+    return task_trees, merged_task_tree
+
+
 
 def save_paths_to_file(task_tree, path):
 
@@ -105,15 +230,11 @@ def save_paths_to_file(task_tree, path):
 
 def read_universal_foon(filepath='FOON.pkl'):
     """
-        parameters: path of universal foon (pickle file)
+        parameters: path of universal foon (pickle file or compact FOON_store file)
         returns: a map. key = object, value = list of functional units
     """
-    pickle_data = pickle.load(open(filepath, 'rb'))
-    functional_units = pickle_data["functional_units"]
-    object_nodes = pickle_data["object_nodes"]
-    object_to_FU_map = pickle_data["object_to_FU_map"]
-
-    return functional_units, object_nodes, object_to_FU_map
+    # the graph is rebuilt first if FOON.txt changed since it was written
+    return load_graph(filepath)
 
 
 # -----------------------------------------------------------------------------------------------------------------------------#
@@ -128,15 +249,31 @@ if __name__ == '__main__':
 
     kitchen_items = json.load(open('kitchen.json'))
     goal_nodes = json.load(open("goal_nodes.json"))
+    attribute_index = AttributeIndex(foon_object_nodes)
+    # the kitchen is compiled once for all goals: one array lookup per kitchen check
+    kitchen = KitchenIndex(kitchen_items, foon_object_nodes, attribute_index)
+    # what the kitchen can make, so unmakeable goals and FUs are skipped without searching
+    reachable = ReachabilityIndex(kitchen, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
 
+    found_goals = []
     for node in goal_nodes:
         node_object = Object(node["label"])
         node_object.states = node["states"]
         node_object.ingredients = node["ingredients"]
         node_object.container = node["container"]
 
-        for object in foon_object_nodes:
-            if object.check_object_equal(node_object):
-                output_task_tree = search_BFS(kitchen_items, object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
-                save_paths_to_file(output_task_tree, 'output_BFS_{}.txt'.format(node["label"]))
-                break
+        goal_id = attribute_index.lookup(node_object)
+        if goal_id != -1:
+            if reachable.is_makeable(foon_object_nodes[goal_id]):
+                found_goals.append((node, foon_object_nodes[goal_id]))
+            else:
+                print(node["label"], '- goal node cannot be made from the kitchen')
+
+    # all goals are searched together, so objects needed by several goals are expanded once
+    output_task_trees, merged_task_tree = search_BFS_batch(kitchen, [object for _, object in found_goals], foon_object_nodes,
+                                                           foon_functional_units, foon_object_to_FU_map, utensils,
+                                                           reachable=reachable)
+    for (node, _), output_task_tree in zip(found_goals, output_task_trees):
+        save_paths_to_file(output_task_tree, 'output_BFS_{}.txt'.format(node["label"]))
+    print('-- steps of all task trees:', sum(len(output_task_tree) for output_task_tree in output_task_trees),
+          '| distinct steps:', len(merged_task_tree))
@@ -1,6 +1,8 @@
 import json
-from search import read_universal_foon, search_BFS, save_paths_to_file
-from FOON_class import Object
+from search import search_BFS, save_paths_to_file
+from FOON_class import Object, ObjectRegistry
+from FOON_index import AttributeIndex
+from preprocess import get_FU_indexes, load_graph
 
 def load_kitchen_items_and_utensils(kitchen_filepath, utensils_filepath):
     """
@@ -16,11 +18,15 @@ def load_kitchen_items_and_utensils(kitchen_filepath, utensils_filepath):
     
     return kitchen_items, utensils
 
-def find_functional_units_for_kitchen_items(kitchen_items, utensils, foon_functional_units, foon_object_nodes):
+def find_functional_units_for_kitchen_items(kitchen_items, utensils, foon_functional_units, foon_object_nodes, foon_object_to_mention_map=None):
     """
     For each item in the kitchen or utensils, find the functional units where they are input or output,
     and write the results to a text file.
     """
+    if foon_object_to_mention_map is None:
+        foon_object_to_mention_map = get_FU_indexes(foon_functional_units)[1]
+    object_registry = ObjectRegistry.from_objects(foon_object_nodes)
+
     with open("kitchen_items_functional_units.txt", "w") as f:
         for item in kitchen_items:
             item_object = Object(item["label"])
@@ -29,7 +35,7 @@ def find_functional_units_for_kitchen_items(kitchen_items, utensils, foon_functi
             item_object.container = item.get("container", None)
             
             f.write(f"Searching functional units for kitchen item: {item['label']}\n")
-            search_functional_units(item_object, foon_functional_units, f)
+            search_functional_units(item_object, foon_functional_units, f, object_registry, foon_object_to_mention_map)
         
         for utensil in utensils:
             utensil_object = Object(utensil)
@@ -38,29 +44,23 @@ def find_functional_units_for_kitchen_items(kitchen_items, utensils, foon_functi
             utensil_object.container = None
             
             f.write(f"Searching functional units for utensil: {utensil}\n")
-            search_functional_units(utensil_object, foon_functional_units, f)
+            search_functional_units(utensil_object, foon_functional_units, f, object_registry, foon_object_to_mention_map)
 
-def search_functional_units(item_object, foon_functional_units, file_handle):
+def search_functional_units(item_object, foon_functional_units, file_handle, object_registry, foon_object_to_mention_map):
     """
     Search for functional units where the given item_object is either an input or an output,
     and write the results to the file.
     """
     found_units = []
-    
-    for FU in foon_functional_units:
+
+    # the mention map lists, in FU order, only the FUs that hold the item,
+    # so the rest of the graph is never looked at
+    item_id = object_registry.lookup(item_object)
+    for FU_id in foon_object_to_mention_map.get(item_id, []):
+        FU = foon_functional_units[FU_id]
         # Check if the item is an input or output node
-        input_found = False
-        output_found = False
-        
-        for input_node in FU.input_nodes:
-            if input_node.check_object_equal(item_object):
-                input_found = True
-                break
-        
-        for output_node in FU.output_nodes:
-            if output_node.check_object_equal(item_object):
-                output_found = True
-                break
+        input_found = any(input_node.id == item_id for input_node in FU.input_nodes)
+        output_found = any(output_node.id == item_id for output_node in FU.output_nodes)
 
         # Write messages before writing the functional unit to the file
         if input_found:
@@ -79,35 +79,38 @@ def find_goal_functional_units(goal_nodes, kitchen_items, foon_functional_units,
     """
     For each goal node, find the relevant functional units where the goal node is in the output nodes.
     """
+    attribute_index = AttributeIndex(foon_object_nodes)
+
     for node in goal_nodes:
         node_object = Object(node["label"])
         node_object.states = node["states"]
         node_object.ingredients = node["ingredients"]
         node_object.container = node["container"]
 
-        for object in foon_object_nodes:
-            if object.check_object_equal(node_object):
-                # Perform BFS search to get the task tree
-                output_task_tree = search_BFS(kitchen_items, object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
-                
-                # Now, find functional units where this node_object is in the output
-                print(f"Functional units for goal node {node['label']}:")
-                goal_units = []
-                for FU in output_task_tree:
-                    for output_node in FU.output_nodes:
-                        if output_node.check_object_equal(node_object):
-                            print(FU.get_FU_as_text())  # Output the functional unit where the goal node is an output
-                            goal_units.append(FU)
-
-                # Save paths for these functional units (optional)
-                if goal_units:
-                    save_paths_to_file(goal_units, 'Goal_nodes_FunctionalUnits_{}.txt'.format(node["label"]))
-
-                break
+        goal_id = attribute_index.lookup(node_object)
+        if goal_id != -1:
+            object = foon_object_nodes[goal_id]
+
+            # Perform BFS search to get the task tree
+            output_task_tree = search_BFS(kitchen_items, object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
+
+            # Now, find functional units where this node_object is in the output
+            print(f"Functional units for goal node {node['label']}:")
+            goal_units = []
+            for FU in output_task_tree:
+                for output_node in FU.output_nodes:
+                    if output_node.id == goal_id:
+                        print(FU.get_FU_as_text())  # Output the functional unit where the goal node is an output
+                        goal_units.append(FU)
+
+            # Save paths for these functional units (optional)
+            if goal_units:
+                save_paths_to_file(goal_units, 'Goal_nodes_FunctionalUnits_{}.txt'.format(node["label"]))
 
 if __name__ == '__main__':
     # Load the FOON data
-    foon_functional_units, foon_object_nodes, foon_object_to_FU_map = read_universal_foon()
+    foon_functional_units, foon_object_nodes, foon_object_to_FU_map, _, foon_object_to_mention_map = \
+        load_graph('FOON.pkl', with_indexes=True)
 
     # Load utensils and kitchen items
     kitchen_items, utensils = load_kitchen_items_and_utensils('kitchen.json', 'utensils.txt')
@@ -116,7 +119,7 @@ if __name__ == '__main__':
     goal_nodes = json.load(open("goal_nodes.json"))
 
     # Find functional units for each kitchen item and utensil and store output in a text file
-    find_functional_units_for_kitchen_items(kitchen_items, utensils, foon_functional_units, foon_object_nodes)
+    find_functional_units_for_kitchen_items(kitchen_items, utensils, foon_functional_units, foon_object_nodes, foon_object_to_mention_map)
 
     # Find functional units for each goal node
     find_goal_functional_units(goal_nodes, kitchen_items, foon_functional_units, foon_object_nodes, foon_object_to_FU_map, utensils)
@@ -0,0 +1,127 @@
+import json
+import random
+
+from benchmark_BFS import make_synthetic_graph
+from FOON_cache import SubtreeCache
+from FOON_class import Object
+from FOON_index import AttributeIndex, KitchenIndex, ReachabilityIndex, get_inputs_to_search
+from search import read_universal_foon, search_BFS, search_BFS_batch
+
+def load_test_data():
+    """
+        parameters: none
+        returns: functional units, object nodes and object_to_FU_map of FOON.pkl, the KitchenIndex of
+                 kitchen.json, the utensils of utensils.txt, and the goal nodes of goal_nodes.json
+                 found in the graph
+    """
+    functional_units, object_nodes, object_to_FU_map = read_universal_foon('FOON.pkl')
+    with open('kitchen.json', 'r') as kitchen_file:
+        kitchen_items = json.load(kitchen_file)
+    with open('utensils.txt', 'r') as utensil_file:
+        utensils = [line.strip() for line in utensil_file]
+    with open('goal_nodes.json', 'r') as goal_file:
+        goals = json.load(goal_file)
+
+    attribute_index = AttributeIndex(object_nodes)
+    kitchen = KitchenIndex(kitchen_items, object_nodes, attribute_index)
+    goal_nodes = []
+    for goal in goals:
+        goal_object = Object(goal["label"])
+        goal_object.states = goal["states"]
+        goal_object.ingredients = goal["ingredients"]
+        goal_object.container = goal["container"]
+        goal_node = attribute_index.find(goal_object)
+        if goal_node is not None:
+            goal_nodes.append(goal_node)
+    return functional_units, object_nodes, object_to_FU_map, kitchen, utensils, goal_nodes
+
+def check_merged_task_tree(merged_task_tree, task_trees, kitchen, object_nodes, functional_units, object_to_FU_map,
+                           utensils, reachable=None):
+    """
+        parameters: what search_BFS_batch returned (merged task tree and task trees), and the kitchen,
+                    graph, utensils and ReachabilityIndex (or None) it was given
+        returns: nothing; asserts that the merged task tree holds every FU of the task trees and nothing
+                 else, and that each FU lists the FUs selected for its inputs and comes after them,
+                 unless they need it in turn (a cycle of the graph); with a ReachabilityIndex, the
+                 kitchen is the one of the index, as in the search
+    """
+    if reachable is not None:
+        kitchen = reachable.kitchen
+
+    def needs(FU_idx, needed_idx):
+        # whether FU_idx needs needed_idx, directly or through the FUs it needs
+        stack, seen = [FU_idx], {FU_idx}
+        while stack:
+            for required_idx in merged_task_tree[stack.pop()]:
+                if required_idx == needed_idx:
+                    return True
+                if required_idx not in seen:
+                    seen.add(required_idx)
+                    stack.append(required_idx)
+        return False
+
+    assert set(merged_task_tree) == {FU.id for task_tree in task_trees for FU in task_tree}
+    position = {FU_idx: i for i, FU_idx in enumerate(merged_task_tree)}
+    for FU_idx, required_units in merged_task_tree.items():
+        expected_units = []
+        for node_idx in get_inputs_to_search(functional_units[FU_idx], utensils):
+            if kitchen.contains(object_nodes[node_idx]):
+                continue
+            candidate_units = object_to_FU_map[node_idx]
+            if reachable is not None:
+                candidate_units = reachable.get_candidates(candidate_units)
+            if candidate_units[0] not in expected_units:
+                expected_units.append(candidate_units[0])
+        assert required_units == expected_units
+        for required_idx in required_units:
+            assert position[required_idx] < position[FU_idx] or needs(required_idx, FU_idx), \
+                'FU %d comes before FU %d, which it needs' % (FU_idx, required_idx)
+
+
+# Test that the batch search gives every goal the task tree search_BFS gives it, with and without a
+# ReachabilityIndex and a subtree cache, and merges the trees with each FU once, after the FUs it needs;
+# in kitchens with part of the items, every object the index calls makeable gets a complete tree
+def test_BFS_batch_matches_search_BFS():
+    functional_units, object_nodes, object_to_FU_map, kitchen, utensils, goal_nodes = load_test_data()
+    args = (object_nodes, functional_units, object_to_FU_map, utensils)
+    rng = random.Random(0)
+    reduced_kitchens = [KitchenIndex(rng.sample(kitchen.kitchen_items, len(kitchen) * percent // 100), object_nodes)
+                        for percent in (30, 60, 90)]
+
+    for goal_kitchen in [kitchen] + reduced_kitchens:
+        reachable = ReachabilityIndex(goal_kitchen, object_nodes, functional_units, object_to_FU_map, utensils)
+        # without the index, only the full kitchen has every input the search expands
+        for goal_reachable in ((None, reachable) if goal_kitchen is kitchen else (reachable,)):
+            goals = goal_nodes + [node for node in object_nodes if goal_reachable is not None or
+                                  object_to_FU_map.get(node.id) or goal_kitchen.contains(node)]
+            expected = [search_BFS(goal_kitchen, goal_node, *args, reachable=goal_reachable) for goal_node in goals]
+
+            task_trees, merged_task_tree = search_BFS_batch(goal_kitchen, goals, *args, reachable=goal_reachable)
+            assert task_trees == expected
+            check_merged_task_tree(merged_task_tree, task_trees, goal_kitchen, *args, goal_reachable)
+            if goal_reachable is not None:
+                for goal_node, task_tree in zip(goals, task_trees):
+                    assert bool(task_tree) == (reachable.is_makeable(goal_node) and
+                                               not reachable.kitchen.contains(goal_node))
+
+            # a second batch reads every tree from the cache the first one filled, and merges them the same way
+            subtree_cache = SubtreeCache(capacity=len(goals))
+            search_BFS_batch(goal_kitchen, goals, *args, subtree_cache, reachable=goal_reachable)
+            cached_trees, cached_merged_task_tree = search_BFS_batch(goal_kitchen, goals, *args, subtree_cache,
+                                                                     reachable=goal_reachable)
+            assert cached_trees == expected
+            assert list(cached_merged_task_tree.items()) == list(merged_task_tree.items())
+
+
+# Test the batch search on a larger synthetic graph, where objects have one or two FUs and trees share
+# most of their FUs
+def test_BFS_batch_on_synthetic_graph():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items = make_synthetic_graph(3000)
+    kitchen = KitchenIndex(kitchen_items, object_nodes)
+    goals = object_nodes[:1500:10]
+    args = (object_nodes, functional_units, object_to_FU_map, [])
+
+    task_trees, merged_task_tree = search_BFS_batch(kitchen, goals, *args)
+    assert task_trees == [search_BFS(kitchen, goal_node, *args) for goal_node in goals]
+    assert len(merged_task_tree) < sum(len(task_tree) for task_tree in task_trees)
+    check_merged_task_tree(merged_task_tree, task_trees, kitchen, *args)
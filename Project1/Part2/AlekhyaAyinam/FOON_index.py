@@ -0,0 +1,315 @@
+import hashlib
+from collections import deque
+
+from FOON_class import Object, ObjectRegistry
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Indexes over the object nodes of a loaded universal foon.
+#
+# AttributeIndex keeps one posting set per label, state, ingredient and container (string id -> ids of
+# the objects that have it). An exact goal is found with one lookup in the object registry, and a partial
+# query such as "every onion that is chopped" or "anything containing tomato" intersects the posting sets
+# of the attributes it names, starting from the smallest one.
+#
+# KitchenIndex is kitchen.json compiled once: every item becomes an object key in a set, and for a loaded
+# graph a bytearray (index = object id) says which objects are in the kitchen, so the kitchen check of a
+# search is one array lookup instead of a scan of every item.
+#
+# ReachabilityIndex is what a kitchen can make: starting from the kitchen items, an FU is reachable once
+# every input it needs is, and its outputs then are too. A search given it skips the FUs that can never
+# run, and whether a goal can be made at all is one array lookup.
+
+
+class AttributeIndex:
+    '''
+    Inverted indexes from object attributes to object ids.
+
+    Constructor Parameters:
+            object_nodes (list): the object nodes of the graph (index = object id)
+            object_registry (ObjectRegistry): registry of object_nodes, built from them if not given
+
+    '''
+
+    def __init__(self, object_nodes, object_registry=None):
+        self.object_nodes = object_nodes
+        self.object_registry = object_registry or ObjectRegistry.from_objects(object_nodes)
+        # key = string id in the registry's vocabulary, value = set of object ids
+        self.label_index = {}
+        self.state_index = {}
+        self.ingredient_index = {}
+        self.container_index = {}
+
+        for node in object_nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.object_nodes)
+
+    def add(self, node):
+        # indexes an interned node under its label, states, ingredients and container
+        label_id, state_ids, ingredient_ids, container_id = self.object_registry.get_vocab_key(node, add=True)
+        self.label_index.setdefault(label_id, set()).add(node.id)
+        for state_id in state_ids:
+            self.state_index.setdefault(state_id, set()).add(node.id)
+        for ingredient_id in ingredient_ids:
+            self.ingredient_index.setdefault(ingredient_id, set()).add(node.id)
+        if container_id != self.object_registry.vocabulary.NONE_ID:
+            self.container_index.setdefault(container_id, set()).add(node.id)
+
+    # returns the id of the equal object, or -1 like check_object_exist
+    def lookup(self, node):
+        return self.object_registry.lookup(node)
+
+    # returns the object node equal to node, or None if the graph has no such object
+    def find(self, node):
+        object_id = self.lookup(node)
+        if object_id == -1:
+            return None
+        return self.object_nodes[object_id]
+
+    def query(self, label=None, states=(), ingredients=(), container=None):
+        """
+            parameters: the attributes an object must have; a label or container of None
+                        and empty states or ingredients do not restrict the result
+            returns: the ids of every object with that label, all of those states, all of
+                     those ingredients and that container, in increasing order
+        """
+        postings = []
+        for index, texts in ((self.label_index, [label] if label is not None else []),
+                             (self.state_index, states),
+                             (self.ingredient_index, ingredients),
+                             (self.container_index, [container] if container is not None else [])):
+            for text in texts:
+                string_id = self.object_registry.vocabulary.get_id(text)
+                if string_id not in index:
+                    return []  # no object has this attribute
+                postings.append(index[string_id])
+
+        if not postings:
+            return list(range(len(self.object_nodes)))
+
+        postings.sort(key=len)
+        object_ids = set(postings[0])
+        for posting in postings[1:]:
+            object_ids.intersection_update(posting)
+            if not object_ids:
+                break
+        return sorted(object_ids)
+
+    # same as query, returning the object nodes instead of their ids
+    def query_objects(self, label=None, states=(), ingredients=(), container=None):
+        return [self.object_nodes[object_id] for object_id in self.query(label, states, ingredients, container)]
+
+
+class KitchenIndex:
+    '''
+    The items of a kitchen, compiled for constant time "is this object in the kitchen" checks.
+
+    Constructor Parameters:
+            kitchen_items (list): kitchen items as loaded from kitchen.json
+            object_nodes (list): object nodes of a graph; when given, in_kitchen is filled for their ids
+            object_index: anything with a lookup(node) method giving object ids (ObjectRegistry,
+                    AttributeIndex, FOON_store.LazyFOON); if not given, object_nodes itself when it has
+                    one (the lazy view of FOON_store, which does not build its nodes for it), or else
+                    an ObjectRegistry built from object_nodes
+            utensils (list): labels of the utensils; a utensil holding no ingredient counts as in the
+                    kitchen, the way the searches take it as available
+
+    '''
+
+    def __init__(self, kitchen_items, object_nodes=None, object_index=None, utensils=()):
+        self.kitchen_items = list(kitchen_items)
+        self.item_keys = frozenset(get_kitchen_item_key(item) for item in self.kitchen_items)
+        self.utensils = frozenset(utensils)
+        self._fingerprint = None
+
+        # index = object id, 1 if the object is in the kitchen; None until a graph is given
+        self.in_kitchen = None
+        if object_nodes is not None:
+            if object_index is None:
+                object_index = object_nodes if hasattr(object_nodes, 'lookup') else ObjectRegistry.from_objects(object_nodes)
+            self.in_kitchen = bytearray(len(object_nodes))
+            for item in self.kitchen_items:
+                object_id = object_index.lookup(make_kitchen_object(item))
+                if object_id != -1:
+                    self.in_kitchen[object_id] = 1
+            self._add_utensils(object_nodes)
+
+    def _add_utensils(self, object_nodes):
+        if self.utensils:
+            for node in object_nodes:
+                if node.label in self.utensils and not node.ingredients:
+                    self.in_kitchen[node.id] = 1
+
+    # returns a KitchenIndex of the same items that also takes the given utensils as in the kitchen
+    def with_utensils(self, utensils, object_nodes=None):
+        kitchen = KitchenIndex(self.kitchen_items, utensils=self.utensils | frozenset(utensils))
+        if self.in_kitchen is not None and object_nodes is not None:
+            kitchen.in_kitchen = bytearray(self.in_kitchen)
+            kitchen._add_utensils(object_nodes)
+        return kitchen
+
+    # identifies the kitchen by its content, e.g. to key cached search results
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            item_keys = sorted(repr(key) for key in self.item_keys)
+            if self.utensils:
+                item_keys.append(repr(sorted(self.utensils)))
+            self._fingerprint = hashlib.sha256('\n'.join(item_keys).encode('utf-8')).hexdigest()[:16]
+        return self._fingerprint
+
+    def __len__(self):
+        return len(self.kitchen_items)
+
+    def __iter__(self):
+        return iter(self.kitchen_items)
+
+    def __contains__(self, node):
+        return self.contains(node)
+
+    # returns True if the object node is in the kitchen
+    def contains(self, node):
+        if self.in_kitchen is not None and node.id is not None:
+            return self.in_kitchen[node.id] == 1
+        if node.label in self.utensils and not node.ingredients:
+            return True
+        return node.get_object_key() in self.item_keys
+
+
+def compile_kitchen(kitchen_items):
+    """
+        parameters: kitchen items (list from kitchen.json) or an already compiled KitchenIndex
+        returns: a KitchenIndex of the items; a KitchenIndex is returned as it is
+    """
+    if isinstance(kitchen_items, KitchenIndex):
+        return kitchen_items
+    return KitchenIndex(kitchen_items)
+
+
+# returns the key of a kitchen.json item, equal to get_object_key of the same object
+def get_kitchen_item_key(item):
+    return (item["label"], tuple(sorted(item["states"])), tuple(sorted(item["ingredients"])), item["container"])
+
+
+def make_kitchen_object(item):
+    kitchen_object = Object(item["label"])
+    kitchen_object.states = list(item["states"])
+    kitchen_object.ingredients = list(item["ingredients"])
+    kitchen_object.container = item["container"]
+    return kitchen_object
+
+
+class ReachabilityIndex:
+    '''
+    The objects and functional units that can be made from a kitchen, found with one forward pass.
+
+    Constructor Parameters:
+            kitchen_items: kitchen items as loaded from kitchen.json, or a KitchenIndex of them
+            object_nodes (list): the object nodes of the graph (index = object id)
+            functional_units (list): the functional units of the graph (index = FU id)
+            object_to_FU_map (dict): object id -> ids of the FUs making it
+            utensils (list): labels of the utensils, with the same meaning as in the searches; they are
+                    taken as in the kitchen (see KitchenIndex), which the searches given this index
+                    use as self.kitchen
+            get_inputs (function): FU -> ids of the inputs a search expands for it, all of which the FU
+                    needs; get_inputs_to_search with the utensils if not given
+
+    '''
+
+    def __init__(self, kitchen_items, object_nodes, functional_units, object_to_FU_map, utensils=(),
+                 get_inputs=None):
+        kitchen = compile_kitchen(kitchen_items)
+        utensils = set(utensils)
+        if not utensils <= kitchen.utensils:
+            kitchen = kitchen.with_utensils(utensils, object_nodes)
+        self.kitchen = kitchen
+        if get_inputs is None:
+            get_inputs = lambda FU: get_inputs_to_search(FU, utensils)
+        # index = object id / FU id, 1 if it is in the kitchen or can be made from it
+        self.objects = bytearray(len(object_nodes))
+        self.units = bytearray(len(functional_units))
+        # index = object id, the FU that made the object reachable (-1 for kitchen items and objects
+        # that cannot be made); its inputs were all reachable before, so following these FUs from any
+        # makeable object gives a task tree without cycles
+        self.first_units = [-1] * len(object_nodes)
+
+        inputs_left = []
+        consumers = {}  # object id -> ids of the FUs that need it
+        for FU_idx, FU in enumerate(functional_units):
+            # an input that is also an output counts as well: the searches expand it all the same
+            required_inputs = set(get_inputs(FU))
+            inputs_left.append(len(required_inputs))
+            for node_id in required_inputs:
+                consumers.setdefault(node_id, []).append(FU_idx)
+        unit_outputs = {}  # FU id -> ids of the objects it makes
+        for node_id, candidate_units in object_to_FU_map.items():
+            for FU_idx in candidate_units:
+                unit_outputs.setdefault(FU_idx, []).append(node_id)
+
+        items_to_search = deque()
+
+        def add_unit(FU_idx):
+            self.units[FU_idx] = 1
+            for node_id in unit_outputs.get(FU_idx, []):
+                if not self.objects[node_id]:
+                    self.objects[node_id] = 1
+                    self.first_units[node_id] = FU_idx
+                    items_to_search.append(node_id)
+
+        for node in object_nodes:
+            if kitchen.contains(node):
+                self.objects[node.id] = 1
+                items_to_search.append(node.id)
+        for FU_idx, num_inputs in enumerate(inputs_left):
+            if num_inputs == 0:
+                add_unit(FU_idx)
+
+        # every object is searched once, and every FU is counted down once per input
+        while items_to_search:
+            for FU_idx in consumers.get(items_to_search.popleft(), []):
+                inputs_left[FU_idx] -= 1
+                if inputs_left[FU_idx] == 0:
+                    add_unit(FU_idx)
+
+    def __contains__(self, node):
+        return self.is_makeable(node)
+
+    # returns True if the object node is in the kitchen or can be made from it
+    def is_makeable(self, node):
+        return self.objects[node.id] == 1
+
+    # returns the ids of the FUs in candidate_units that can run with this kitchen, in the same order
+    def get_candidates(self, candidate_units):
+        return [FU_idx for FU_idx in candidate_units if self.units[FU_idx]]
+
+
+def get_inputs_to_search(FU, utensils):
+    """
+        parameters: a functional unit, a set of utensil labels
+        returns: ids of the input nodes of the FU that a search has to explore, in input order;
+                 a utensil holding one ingredient is left out when that ingredient is also
+                 an input of the FU, inside the utensil
+    """
+    inputs_to_search = []
+    for node in FU.input_nodes:
+        flag = True
+        if node.label in utensils and len(node.ingredients) == 1:
+            for node2 in FU.input_nodes:
+                if node2.label == node.ingredients[0] and node2.container == node.label:
+                    flag = False
+                    break
+        if flag:
+            inputs_to_search.append(node.id)
+    return inputs_to_search
+
+
+def get_required_inputs(FU, utensils):
+    """
+        parameters: a functional unit, a set of utensil labels
+        returns: the inputs to search that are needed to make the outputs of the FU; an input
+                 that is also an output (e.g. a container it pours into) goes through it unchanged
+    """
+    output_ids = set(node.id for node in FU.output_nodes)
+    return [node_id for node_id in get_inputs_to_search(FU, utensils) if node_id not in output_ids]
@@ -0,0 +1,487 @@
+import mmap
+import operator
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+
+from FOON_class import FunctionalUnit, Object, ObjectRegistry, Vocabulary
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Compact, array-backed file format for the universal FOON.
+#
+# Every label, state, ingredient, container and motion is stored once in a string table, and the graph
+# is a set of int32 arrays in CSR form (a "ptr" array of length n+1 and an "ids" array, so that the
+# entries of row i are ids[ptr[i]:ptr[i+1]]):
+#   - object records: label, container, states and ingredients as string ids
+#   - FU -> motion, FU -> input records, FU -> output records
+#   - object -> producer FUs (the object_to_FU_map of FOON.pkl)
+#   - label string -> objects with that label, to find a goal node without reading every object
+#
+# The first num_objects records are the object nodes, so a record index is the object id. An object that
+# appears in some FU with its states or ingredients listed in a different order gets an extra record after
+# those, mapped back to its object id, so that FU text is written back exactly as it was annotated.
+#
+# All arrays are little-endian and 8-byte aligned, so the file is used directly through mmap.
+
+FOON_MAGIC = b'FOONBIN\0'
+FOON_VERSION = 2
+
+_HEADER = struct.Struct('<8sIIIII')  # magic, version, objects, records, functional units, strings
+_SECTIONS = (
+    'string_ptr', 'string_bytes',
+    'record_label', 'record_container',
+    'record_state_ptr', 'record_state_ids',
+    'record_ingredient_ptr', 'record_ingredient_ids',
+    'variant_object_id',
+    'FU_motion',
+    'FU_input_ptr', 'FU_input_records',
+    'FU_output_ptr', 'FU_output_records',
+    'producer_ptr', 'producer_FU_ids',
+    'label_object_ptr', 'label_object_ids',
+)
+_SECTION_TABLE = struct.Struct('<' + 'QQ' * len(_SECTIONS))  # (offset, size in bytes) per section
+_ALIGNMENT = 8
+
+NO_STRING = -1  # string id of a missing container
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+
+def is_compact_foon(filepath):
+    """
+        parameters: path of a universal foon file
+        returns: True if the file is in the compact format (and not a pickle)
+    """
+    with open(filepath, 'rb') as _file:
+        return _file.read(len(FOON_MAGIC)) == FOON_MAGIC
+
+
+def write_compact_foon(functional_units, object_nodes, object_to_FU_map, filepath='FOON.bin'):
+    """
+        parameters: the universal foon as built by preprocess.create_graph,
+                    path of the output file
+        returns: nothing, the graph is written to filepath
+    """
+    strings = []
+    string_ids = {}
+
+    def string_id(text):
+        if text is None:
+            return NO_STRING
+        sid = string_ids.get(text)
+        if sid is None:
+            sid = string_ids[text] = len(strings)
+            strings.append(text)
+        return sid
+
+    record_label = array('i')
+    record_container = array('i')
+    record_state_ptr = array('i', [0])
+    record_state_ids = array('i')
+    record_ingredient_ptr = array('i', [0])
+    record_ingredient_ids = array('i')
+    variant_object_id = array('i')
+    variant_ids = {}  # key = (object id, states, ingredients), value = record index
+
+    def add_record(node):
+        record_label.append(string_id(node.label))
+        record_container.append(string_id(node.container))
+        record_state_ids.extend(string_id(state) for state in node.states)
+        record_state_ptr.append(len(record_state_ids))
+        record_ingredient_ids.extend(string_id(ingredient) for ingredient in node.ingredients)
+        record_ingredient_ptr.append(len(record_ingredient_ids))
+
+    for node in object_nodes:
+        add_record(node)
+
+    def record_index(node):
+        canonical = object_nodes[node.id]
+        if tuple(node.states) == tuple(canonical.states) and tuple(node.ingredients) == tuple(canonical.ingredients):
+            return node.id
+        variant = (node.id, tuple(node.states), tuple(node.ingredients))
+        index = variant_ids.get(variant)
+        if index is None:
+            index = variant_ids[variant] = len(record_label)
+            add_record(node)
+            variant_object_id.append(node.id)
+        return index
+
+    FU_motion = array('i')
+    FU_input_ptr = array('i', [0])
+    FU_input_records = array('i')
+    FU_output_ptr = array('i', [0])
+    FU_output_records = array('i')
+    for FU in functional_units:
+        FU_motion.append(string_id(FU.motion_node))
+        FU_input_records.extend(record_index(node) for node in FU.input_nodes)
+        FU_input_ptr.append(len(FU_input_records))
+        FU_output_records.extend(record_index(node) for node in FU.output_nodes)
+        FU_output_ptr.append(len(FU_output_records))
+
+    producer_ptr = array('i', [0])
+    producer_FU_ids = array('i')
+    for object_id in range(len(object_nodes)):
+        producer_FU_ids.extend(object_to_FU_map.get(object_id, ()))
+        producer_ptr.append(len(producer_FU_ids))
+
+    label_objects = [[] for _ in strings]
+    for object_id in range(len(object_nodes)):
+        label_objects[record_label[object_id]].append(object_id)
+    label_object_ptr = array('i', [0])
+    label_object_ids = array('i')
+    for object_ids in label_objects:
+        label_object_ids.extend(object_ids)
+        label_object_ptr.append(len(label_object_ids))
+
+    encoded = [text.encode('utf-8') for text in strings]
+    string_ptr = array('i', [0])
+    for text in encoded:
+        string_ptr.append(string_ptr[-1] + len(text))
+
+    sections = {
+        'string_ptr': string_ptr, 'string_bytes': b''.join(encoded),
+        'record_label': record_label, 'record_container': record_container,
+        'record_state_ptr': record_state_ptr, 'record_state_ids': record_state_ids,
+        'record_ingredient_ptr': record_ingredient_ptr, 'record_ingredient_ids': record_ingredient_ids,
+        'variant_object_id': variant_object_id,
+        'FU_motion': FU_motion,
+        'FU_input_ptr': FU_input_ptr, 'FU_input_records': FU_input_records,
+        'FU_output_ptr': FU_output_ptr, 'FU_output_records': FU_output_records,
+        'producer_ptr': producer_ptr, 'producer_FU_ids': producer_FU_ids,
+        'label_object_ptr': label_object_ptr, 'label_object_ids': label_object_ids,
+    }
+
+    payloads = []
+    table = []
+    offset = _align(_HEADER.size + _SECTION_TABLE.size)
+    for name in _SECTIONS:
+        data = sections[name]
+        if isinstance(data, array):
+            if sys.byteorder != 'little':
+                data = array('i', data)
+                data.byteswap()
+            data = data.tobytes()
+        payloads.append((offset, data))
+        table.extend((offset, len(data)))
+        offset = _align(offset + len(data))
+
+    with open(filepath, 'wb') as _file:
+        _file.write(_HEADER.pack(FOON_MAGIC, FOON_VERSION, len(object_nodes), len(record_label),
+                                 len(functional_units), len(strings)))
+        _file.write(_SECTION_TABLE.pack(*table))
+        for offset, data in payloads:
+            _file.write(b'\0' * (offset - _file.tell()))
+            _file.write(data)
+
+
+def read_compact_foon(filepath='FOON.bin'):
+    """
+        parameters: path of a compact universal foon
+        returns: functional_units (list), object_nodes (list), object_to_FU_map (dict),
+                 the same view that FOON.pkl gives
+    """
+    with CompactFOON(filepath) as foon:
+        return foon.to_lists()
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+
+class CompactFOON:
+    '''
+    A read-only universal foon backed by a memory-mapped compact file.
+
+    Constructor Parameters:
+            filepath (str): path of a file written by write_compact_foon
+    '''
+
+    def __init__(self, filepath='FOON.bin'):
+        self._file = open(filepath, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = []
+        self._strings = {}  # key = string id, value = decoded string
+        self._string_ids = None  # key = string, value = string id; built on the first lookup
+
+        magic, version, self.num_objects, self.num_records, self.num_functional_units, self.num_strings = \
+            _HEADER.unpack_from(self._mmap, 0)
+        if magic != FOON_MAGIC:
+            self.close()
+            raise ValueError(filepath + ' is not a compact FOON file')
+        if version != FOON_VERSION:
+            self.close()
+            raise ValueError('unsupported compact FOON version: ' + str(version))
+
+        table = _SECTION_TABLE.unpack_from(self._mmap, _HEADER.size)
+        for index, name in enumerate(_SECTIONS):
+            offset, size = table[2 * index], table[2 * index + 1]
+            setattr(self, name, self._section(offset, size, name == 'string_bytes'))
+
+    def _section(self, offset, size, raw):
+        view = memoryview(self._mmap)[offset:offset + size]
+        self._views.append(view)
+        if raw:
+            return view
+        if sys.byteorder != 'little':
+            # the file is little-endian, so copy and swap instead of mapping
+            data = array('i', view.tobytes())
+            data.byteswap()
+            return data
+        view = view.cast('i')
+        self._views.append(view)
+        return view
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # -- accessors working on ids only, without building Object/FunctionalUnit instances:
+    def get_string(self, sid):
+        if sid == NO_STRING:
+            return None
+        text = self._strings.get(sid)
+        if text is None:
+            text = self._strings[sid] = \
+                bytes(self.string_bytes[self.string_ptr[sid]:self.string_ptr[sid + 1]]).decode('utf-8')
+        return text
+
+    # returns the id of a string, or None if no node uses it
+    def get_string_id(self, text):
+        if text is None:
+            return NO_STRING
+        if self._string_ids is None:
+            self._string_ids = {self.get_string(sid): sid for sid in range(self.num_strings)}
+        return self._string_ids.get(text)
+
+    # returns the id of the object equal to node (see Object.check_object_equal), or -1;
+    # only the objects with the same label are read
+    def lookup(self, node):
+        label_id = self.get_string_id(node.label)
+        container_id = self.get_string_id(node.container)
+        state_ids = [self.get_string_id(state) for state in node.states]
+        ingredient_ids = [self.get_string_id(ingredient) for ingredient in node.ingredients]
+        if label_id is None or container_id is None or None in state_ids or None in ingredient_ids:
+            return -1
+        state_ids.sort()
+        ingredient_ids.sort()
+
+        for object_id in self.label_object_ids[self.label_object_ptr[label_id]:self.label_object_ptr[label_id + 1]]:
+            if self.record_container[object_id] == container_id and \
+                    sorted(self.record_state_ids[self.record_state_ptr[object_id]:self.record_state_ptr[object_id + 1]]) == state_ids and \
+                    sorted(self.record_ingredient_ids[self.record_ingredient_ptr[object_id]:self.record_ingredient_ptr[object_id + 1]]) == ingredient_ids:
+                return object_id
+        return -1
+
+    def get_record_object_id(self, record):
+        if record < self.num_objects:
+            return record
+        return self.variant_object_id[record - self.num_objects]
+
+    def get_FU_inputs(self, FU_id):
+        # returns the object ids of the input nodes
+        records = self.FU_input_records[self.FU_input_ptr[FU_id]:self.FU_input_ptr[FU_id + 1]]
+        return [self.get_record_object_id(record) for record in records]
+
+    def get_FU_outputs(self, FU_id):
+        # returns the object ids of the output nodes
+        records = self.FU_output_records[self.FU_output_ptr[FU_id]:self.FU_output_ptr[FU_id + 1]]
+        return [self.get_record_object_id(record) for record in records]
+
+    def get_FU_motion(self, FU_id):
+        return self.get_string(self.FU_motion[FU_id])
+
+    def get_producers(self, object_id):
+        # returns the ids of all FU where the object is an output (empty if it is not in object_to_FU_map)
+        return list(self.producer_FU_ids[self.producer_ptr[object_id]:self.producer_ptr[object_id + 1]])
+
+    # -- builders for the list-of-objects view:
+    def make_object(self, record):
+        node = Object(self.get_string(self.record_label[record]))
+        node.states = tuple(self.get_string(sid) for sid in
+                            self.record_state_ids[self.record_state_ptr[record]:self.record_state_ptr[record + 1]])
+        node.ingredients = tuple(self.get_string(sid) for sid in
+                                 self.record_ingredient_ids[self.record_ingredient_ptr[record]:self.record_ingredient_ptr[record + 1]])
+        node.container = self.get_string(self.record_container[record])
+        node.id = self.get_record_object_id(record)
+        return node
+
+    def make_functional_unit(self, FU_id, object_nodes=None):
+        # nodes are taken from object_nodes when given, so FUs share object instances as in a freshly built graph
+        def make_node(record):
+            if object_nodes is None:
+                return self.make_object(record)
+            if record < self.num_objects:
+                return object_nodes[record]
+            node = self.make_object(record)
+            node.vocab_key = object_nodes[node.id].vocab_key
+            node.vocabulary = object_nodes[node.id].vocabulary
+            return node
+
+        FU = FunctionalUnit()
+        FU.input_nodes = [make_node(record) for record in
+                          self.FU_input_records[self.FU_input_ptr[FU_id]:self.FU_input_ptr[FU_id + 1]]]
+        FU.output_nodes = [make_node(record) for record in
+                           self.FU_output_records[self.FU_output_ptr[FU_id]:self.FU_output_ptr[FU_id + 1]]]
+        FU.motion_node = self.get_FU_motion(FU_id)
+        FU.id = FU_id
+        return FU
+
+    def get_object_to_FU_map(self):
+        object_to_FU_map = {}
+        for object_id in range(self.num_objects):
+            producers = self.get_producers(object_id)
+            if producers:
+                object_to_FU_map[object_id] = producers
+        return object_to_FU_map
+
+    def to_lists(self):
+        """
+            returns: functional_units (list), object_nodes (list), object_to_FU_map (dict)
+        """
+        object_nodes = [self.make_object(object_id) for object_id in range(self.num_objects)]
+        # gives the objects the same vocab keys as preprocess.FOONBuilder does
+        ObjectRegistry.from_objects(object_nodes)
+
+        functional_units = []
+        motion_vocabulary = Vocabulary()
+        for FU_id in range(self.num_functional_units):
+            FU = self.make_functional_unit(FU_id, object_nodes)
+            FU.motion_id = motion_vocabulary.add(FU.motion_node)
+            FU.motion_node = motion_vocabulary.get_string(FU.motion_id)
+            functional_units.append(FU)
+        return functional_units, object_nodes, self.get_object_to_FU_map()
+
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Lazy view of a compact universal foon: functional_units, object_nodes and object_to_FU_map behave like the
+# lists and dict of FOON.pkl (indexing, len, iteration, KeyError for an object with no producer), so the
+# search functions work on them unchanged, but an Object or FunctionalUnit is only built when its id is
+# accessed. The most recently used ones are kept in an LRU cache, so memory stays bounded.
+# object_nodes also has a lookup(node) method answered from the label index of the file, so a
+# KitchenIndex or goal lookup over the view does not build every object.
+
+
+class LazyFOON:
+    '''
+    A universal foon whose nodes are built on access.
+
+    Constructor Parameters:
+            filepath (str): path of a file written by write_compact_foon
+            cache_size (int): number of objects (and of FUs) kept built
+    '''
+
+    def __init__(self, filepath='FOON.bin', cache_size=4096):
+        self.store = CompactFOON(filepath)
+        self.object_nodes = LazyObjectNodes(self.store, cache_size)
+        self.functional_units = LazyFunctionalUnits(self.store, self.object_nodes, cache_size)
+        self.object_to_FU_map = LazyObjectToFUMap(self.store)
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # returns the id of the object equal to node, or -1, without building other objects
+    def lookup(self, node):
+        return self.store.lookup(node)
+
+
+class _LazySequence(Sequence):
+
+    def __init__(self, size, make_item, cache_size):
+        self._size = size
+        self._make_item = make_item
+        self._cache = OrderedDict()  # key = id, value = built item, least recently used first
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._size))]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('index out of range')
+
+        item = self._cache.get(index)
+        if item is None:
+            item = self._cache[index] = self._make_item(index)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(index)
+        return item
+
+    def cached_count(self):
+        return len(self._cache)
+
+
+class LazyObjectNodes(_LazySequence):
+
+    def __init__(self, store, cache_size=4096):
+        super().__init__(store.num_objects, store.make_object, cache_size)
+        self._store = store
+
+    # returns the id of the object equal to node, or -1, reading only the objects with its label
+    def lookup(self, node):
+        return self._store.lookup(node)
+
+
+class LazyFunctionalUnits(_LazySequence):
+
+    def __init__(self, store, object_nodes, cache_size=4096):
+        # input and output nodes are taken from object_nodes, so an object used by several FUs is built once
+        super().__init__(store.num_functional_units,
+                         lambda FU_id: store.make_functional_unit(FU_id, object_nodes), cache_size)
+
+
+class LazyObjectToFUMap(Mapping):
+
+    def __init__(self, store):
+        self._store = store
+        self._size = None
+
+    def __getitem__(self, object_id):
+        # any integer type is an id, e.g. numpy.int64 taken from an array of ids
+        try:
+            index = operator.index(object_id)
+        except TypeError:
+            raise KeyError(object_id) from None
+        if not 0 <= index < self._store.num_objects:
+            raise KeyError(object_id)
+        producers = self._store.get_producers(index)
+        if not producers:
+            raise KeyError(object_id)
+        return producers
+
+    def __iter__(self):
+        producer_ptr = self._store.producer_ptr
+        for object_id in range(self._store.num_objects):
+            if producer_ptr[object_id] != producer_ptr[object_id + 1]:
+                yield object_id
+
+    def __len__(self):
+        if self._size is None:
+            self._size = sum(1 for _ in self)
+        return self._size
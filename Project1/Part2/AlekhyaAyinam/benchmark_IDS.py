@@ -0,0 +1,124 @@
+import json
+import sys
+import time
+
+from FOON_class import Object
+from FOON_index import AttributeIndex, KitchenIndex, compile_kitchen
+from search_IDS_A_star import load_universal_foon, search_IDS
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Compares search_IDS with the version it replaced, which searched the whole tree again at every depth limit:
+# node expansions (objects whose inputs were opened) and time, on every goal of goal_nodes.json and, with
+# --all, on every object of the universal foon. Both versions must give the same task tree.
+
+
+def search_IDS_legacy(kitchen_items=[], goal_node=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[], stats=None):
+    # search_IDS before the transposition table, with a counter of expansions added
+    kitchen = compile_kitchen(kitchen_items)
+    depth_limit = 0
+    num_expansions = 0
+
+    while depth_limit >= 0:
+        reference_task_tree = []
+        items_to_search = [[goal_node.id, 0]]
+        searched_items = []
+        skipped_items = []
+
+        while items_to_search:
+            node_id, current_depth = items_to_search.pop(0)
+
+            if current_depth > depth_limit:
+                skipped_items.append(node_id)
+                continue
+
+            if node_id in searched_items:
+                continue
+            searched_items.append(node_id)
+
+            current_node = foon_object_nodes[node_id]
+
+            if not kitchen.contains(current_node):
+                candidate_units = foon_object_to_FU_map[node_id]
+                selected_candidate_idx = candidate_units[0]
+
+                if selected_candidate_idx in reference_task_tree:
+                    continue
+                reference_task_tree.append(selected_candidate_idx)
+                num_expansions += 1
+
+                sibling_nodes = []
+                for input_node in foon_functional_units[selected_candidate_idx].input_nodes:
+                    node_idx = input_node.id
+                    flag = True
+                    if input_node.label in utensils and len(input_node.ingredients) == 1:
+                        for node2 in foon_functional_units[selected_candidate_idx].input_nodes:
+                            if node2.label == input_node.ingredients[0] and node2.container == input_node.label:
+                                flag = False
+                                break
+                    if flag:
+                        sibling_nodes.append(node_idx)
+
+                items_to_search = [[sibling_node, current_depth + 1] for sibling_node in sibling_nodes] + items_to_search
+
+        if skipped_items:
+            depth_limit += 1
+        else:
+            if stats is not None:
+                stats["depth_limit"] = depth_limit
+                stats["iterations"] = depth_limit + 1
+                stats["expansions"] = num_expansions
+            reference_task_tree.reverse()
+            return [foon_functional_units[i] for i in reference_task_tree]
+
+
+def run(search, goal_node, *args):
+    stats = {}
+    start = time.perf_counter()
+    try:
+        task_tree = search(args[0], goal_node, *args[1:], stats=stats)
+    except KeyError:
+        task_tree = None  # an object of the tree has no FU making it
+    return task_tree, stats, time.perf_counter() - start
+
+
+def compare(name, goal_node, *args):
+    legacy_tree, legacy_stats, legacy_time = run(search_IDS_legacy, goal_node, *args)
+    task_tree, new_stats, new_time = run(search_IDS, goal_node, *args)
+    assert task_tree == legacy_tree, 'search_IDS gave a different task tree for ' + name
+    return legacy_stats, legacy_time, new_stats, new_time
+
+
+if __name__ == '__main__':
+    foon_functional_units, foon_object_nodes, foon_object_to_FU_map = load_universal_foon()
+    with open('utensils.txt', 'r') as utensil_file:
+        utensils = [line.strip() for line in utensil_file]
+    kitchen_items = json.load(open('kitchen.json'))
+    goal_nodes = json.load(open('goal_nodes.json'))
+    attribute_index = AttributeIndex(foon_object_nodes)
+    kitchen = KitchenIndex(kitchen_items, foon_object_nodes, attribute_index)
+    graph = (foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
+
+    for node in goal_nodes:
+        node_object = Object(node["label"])
+        node_object.states = node["states"]
+        node_object.ingredients = node["ingredients"]
+        node_object.container = node["container"]
+        goal_node = attribute_index.find(node_object)
+        if goal_node is None:
+            continue
+        legacy_stats, legacy_time, new_stats, new_time = compare(node["label"], goal_node, kitchen, *graph)
+        print('-- %-14s depth: %3d | expansions legacy: %6d, search_IDS: %5d | time legacy: %8.2f ms, search_IDS: %7.2f ms' %
+              (node["label"], new_stats["depth_limit"], legacy_stats["expansions"], new_stats["expansions"],
+               legacy_time * 1000, new_time * 1000))
+
+    if '--all' in sys.argv[1:]:
+        totals = [0, 0.0, 0, 0.0]
+        for goal_node in foon_object_nodes:
+            legacy_stats, legacy_time, new_stats, new_time = compare('object %d' % goal_node.id, goal_node, kitchen, *graph)
+            totals[0] += legacy_stats.get("expansions", 0)
+            totals[1] += legacy_time
+            totals[2] += new_stats.get("expansions", 0)
+            totals[3] += new_time
+        print('-- all %d objects | expansions legacy: %d, search_IDS: %d | time legacy: %.2f s, search_IDS: %.2f s' %
+              (len(foon_object_nodes), totals[0], totals[2], totals[1], totals[3]))
@@ -0,0 +1,79 @@
+import gc
+import sys
+import tracemalloc
+
+from FOON_class import Object
+from preprocess import load_graph
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Compares the memory used by the FOON node classes, which use __slots__, with the same nodes
+# stored the way they were before: one plain instance with a __dict__ per node.
+
+
+class DictNode:
+    # NOTE: a node that keeps its attributes in a __dict__, as the FOON classes did before __slots__
+    def __init__(self, state):
+        self.__dict__.update(state)
+
+
+def make_slotted_node(node, state):
+    copy = type(node).__new__(type(node))
+    copy.__setstate__(state)
+    return copy
+
+
+def make_dict_node(node, state):
+    if isinstance(node, Object):
+        state['states'] = list(state['states'])
+        state['ingredients'] = list(state['ingredients'])
+    return DictNode(state)
+
+
+def copy_graph(functional_units, object_nodes, make_node):
+    """
+    parameters: the functional units and object nodes of a graph, and a function making one copied node
+    returns: a copy of the graph with the same sharing of nodes and strings
+    """
+    copies = {}
+
+    def copy_object(node):
+        if id(node) not in copies:
+            copies[id(node)] = make_node(node, node.__getstate__())
+        return copies[id(node)]
+
+    object_copies = [copy_object(node) for node in object_nodes]
+    FU_copies = []
+    for FU in functional_units:
+        state = FU.__getstate__()
+        state['input_nodes'] = [copy_object(node) for node in FU.input_nodes]
+        state['output_nodes'] = [copy_object(node) for node in FU.output_nodes]
+        FU_copies.append(make_node(FU, state))
+    return FU_copies, object_copies
+
+
+def measure(functional_units, object_nodes, make_node):
+    """
+    parameters: the functional units and object nodes of a graph, and a function making one copied node
+    returns: the memory in bytes allocated for a copy of the graph
+    """
+    gc.collect()
+    tracemalloc.start()
+    graph = copy_graph(functional_units, object_nodes, make_node)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del graph
+    return size
+
+
+if __name__ == '__main__':
+    graph_file = sys.argv[1] if len(sys.argv) > 1 else 'FOON.pkl'
+
+    functional_units, object_nodes, _ = load_graph(graph_file)
+    # -- both copies share the strings of the loaded graph, so only the node instances are measured
+    slotted_size = measure(functional_units, object_nodes, make_slotted_node)
+    dict_size = measure(functional_units, object_nodes, make_dict_node)
+
+    print('-- functional units:', len(functional_units), '| object nodes:', len(object_nodes))
+    print('-- nodes with __slots__: %.1f KB' % (slotted_size / 1024))
+    print('-- nodes with __dict__:  %.1f KB' % (dict_size / 1024))
@@ -1,32 +1,30 @@
-import pickle
 import json
 import heapq  # for priority queue used in A*
+import time
+from collections import deque
 
 from FOON_class import Object
+from FOON_cache import get_utensil_fingerprint
+from FOON_index import AttributeIndex, KitchenIndex, ReachabilityIndex, compile_kitchen, get_inputs_to_search, get_required_inputs
+from preprocess import load_graph
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
 # Utility function to check if an ingredient exists in the kitchen
 def check_ingredient_in_kitchen(kitchen_items, ingredient):
     """
-    parameters: kitchen_items (list) - List of items in the kitchen
+    parameters: kitchen_items (list or KitchenIndex) - List of items in the kitchen
                 ingredient (Object) - Object representing the ingredient to search for
     returns: True if the ingredient exists in the kitchen, False otherwise
     """
-    for item in kitchen_items:
-        if (item["label"] == ingredient.label and
-                sorted(item["states"]) == sorted(ingredient.states) and
-                sorted(item["ingredients"]) == sorted(ingredient.ingredients) and
-                item["container"] == ingredient.container):
-            return True
-    return False
+    return compile_kitchen(kitchen_items).contains(ingredient)
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 # Load success rates from motion.txt
 def load_success_rates(file_path="motion.txt"):
     """
     Load the success rates from a file and return as a dictionary
-    with functional unit IDs as keys and success rates as values.
+    with motion names (the motion of a functional unit) as keys and success rates as values.
     Skips lines that are not properly formatted.
     """
     success_rates = {}
@@ -50,194 +48,624 @@ def load_success_rates(file_path="motion.txt"):
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
-# A* Search algorithm with cost and heuristic functions
-def search_A_star(kitchen_items=[], goal_node=None, success_rates=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[]):
+# A* Search over the AND-OR graph of the FOON
+#
+# An object is made by any one of its candidate FUs (OR), and an FU needs all of its inputs (AND). The
+# cost of an FU is the inverse of the success rate of its motion in motion.txt, an object in the kitchen
+# costs nothing, and the cost of making an object is the cost of the FU chosen for it plus the cost of
+# making each of its inputs. search_A_star returns the task tree of least cost in this sense, choosing
+# among every candidate FU; a subtree needed twice is counted twice, although the task tree lists its
+# FUs once.
+#
+# The search has two passes over the part of the graph the goal depends on:
+# 1. from the goal down: for every object, the cheapest chain of FUs linking it to the goal (heuristic).
+#    Any task tree using the object also contains such a chain, so this never overestimates what is left
+#    to pay above the object once it is made.
+# 2. from the kitchen up (a generalized Dijkstra): objects are settled in increasing order of cost of
+#    making them plus heuristic, an FU gets a cost once all its inputs are settled, and the search stops
+#    when the goal is settled, at which point its cost is the least possible.
+#
+# Given the table of compute_production_costs for the same kitchen, both passes are skipped: the table
+# is a perfect heuristic, and the task tree is read off it directly.
+#
+# The search can be given a budget (time_limit, max_expansions). When it runs out before the goal is
+# settled, the search stops and returns the best task tree it can complete: objects that pass 2 gave a
+# cost keep the FU of that cost, and the others take the FU that first made them reachable
+# (ReachabilityIndex.first_units), which always ends in the kitchen. No cost is below the lower bound
+# the search had reached: the least key left in pass 2 (cost plus heuristic of an object, which is at
+# most the cost of any task tree using it), or in pass 1 the cheapest chain from the goal to a leaf.
+# The subtree cache is checked once, for the goal; the objects expanded under it are not looked up in it.
+# Only task trees of completed searches are cached, with their cost, so a hit fills stats like the
+# search it replaces.
+def search_A_star(kitchen_items=[], goal_node=None, success_rates=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[], subtree_cache=None, stats=None, production_costs=None, reachable=None,
+                  time_limit=None, max_expansions=None):
     """
     A* search algorithm
-    parameters: kitchen_items (list) - List of items in the kitchen
+    parameters: kitchen_items (list or KitchenIndex) - List of items in the kitchen
                 goal_node (Object) - The target node to search for
-                success_rates (dict) - A dictionary with functional unit IDs and their success rates
+                success_rates (dict) - A dictionary with motion names and their success rates
                 foon_object_nodes (list) - List of object nodes in the FOON
                 foon_functional_units (list) - List of functional units in the FOON
                 foon_object_to_FU_map (dict) - Dictionary mapping object nodes to functional units
                 utensils (list) - List of utensils to check during search
-    returns: task_tree_units (list) - List of functional units representing the task tree
+                subtree_cache (SubtreeCache) - Cache of solved task trees and their costs (FOON_cache), read for the
+                                               goal before and filled after the search, or None
+                stats (dict) - If given, filled with the cost of the task tree ("cost"), a lower bound of the least
+                               cost ("lower_bound", equal to the cost unless the budget ran out), whether the budget
+                               ran out ("exhausted"), the number of objects the goal depends on ("objects_reached")
+                               and the number settled ("objects_settled")
+                production_costs (tuple) - What compute_production_costs returned for this kitchen, or None
+                reachable (ReachabilityIndex) - What this kitchen can make (FOON_index); FUs that can never run are
+                                                not searched, and a goal that cannot be made gives an empty task tree
+                time_limit (float) - Seconds the search may take, or None for no limit
+                max_expansions (int) - Number of objects the two passes may settle together, or None for no limit
+    returns: task_tree_units (list) - List of functional units representing the task tree, empty if the goal
+             is in the kitchen or cannot be made from it; when the budget runs out, the best task tree
+             the search could complete, empty if it had none (without reachable)
     """
-    # Priority queue for A* search
+    kitchen = compile_kitchen(kitchen_items)
+    utensils = set(utensils) if utensils else set()
+    success_rates = success_rates or {}
+    # the kitchen of a ReachabilityIndex also holds the utensils it took as available
+    if reachable is not None:
+        kitchen = reachable.kitchen
+
+    if reachable is not None and not reachable.is_makeable(goal_node):
+        if stats is not None:
+            stats["cost"] = stats["lower_bound"] = float('inf')
+            stats["exhausted"] = False
+            stats["objects_reached"] = stats["objects_settled"] = 0
+        return []
+
+    # a goal already solved in this kitchen, with these utensils, is not searched again; skipping the
+    # FUs that cannot run can select other FUs of the same cost, so those trees are cached apart
+    algorithm = 'A_star' if reachable is None else 'A_star_reachable'
+    if subtree_cache is not None:
+        utensil_fingerprint = get_utensil_fingerprint(utensils)
+        cached_tree = subtree_cache.get(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm,
+                                        with_cost=True)
+        if cached_tree is not None:
+            FU_indices, cost = cached_tree
+            if stats is not None:
+                stats["cost"] = stats["lower_bound"] = cost
+                stats["exhausted"] = False
+                stats["objects_reached"] = stats["objects_settled"] = 0
+            return [foon_functional_units[i] for i in FU_indices]
+
+    if production_costs is not None:
+        best_costs, selected_units = production_costs
+        cost = best_costs.get(goal_node.id, float('inf'))
+        if stats is not None:
+            stats["cost"] = stats["lower_bound"] = cost
+            stats["exhausted"] = False
+            stats["objects_reached"] = stats["objects_settled"] = 0
+        FU_indices = get_cheapest_task_tree(goal_node.id, selected_units, foon_functional_units, utensils)
+        if subtree_cache is not None:
+            subtree_cache.put(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm, FU_indices, cost)
+        return [foon_functional_units[i] for i in FU_indices]
+
+    # pass 1: best-first from the goal over every candidate FU. heuristic = object index -> cost of the
+    # cheapest chain of FUs from the goal down to the object; the FUs met on the way are kept with the
+    # output they were reached for and the inputs they need
+    heuristic = {goal_node.id: 0}
+    open_list = [(0, goal_node.id)]
+    settled_items = set()
+    kitchen_items_reached = []
+    unit_inputs = {}  # FU index -> indices of its inputs to search
+    unit_outputs = {}  # FU index -> indices of the objects it was reached for
+    consumers = {}  # object index -> FU indices that need it
+
+    # budget: objects settled by both passes, and the time the search started
+    start_time = time.perf_counter()
+    num_expansions = 0
+    exhausted = False
+
+    def out_of_budget():
+        return (max_expansions is not None and num_expansions >= max_expansions) or \
+            (time_limit is not None and time.perf_counter() - start_time >= time_limit)
+
+    leaf_cost = float('inf')  # cheapest chain from the goal to a kitchen item or an FU needing no input
+    while open_list:
+        if out_of_budget():
+            exhausted = True
+            break
+        current_cost, current_item_index = heapq.heappop(open_list)
+        if current_item_index in settled_items:
+            continue
+        settled_items.add(current_item_index)
+        num_expansions += 1
+
+        if kitchen.contains(foon_object_nodes[current_item_index]):
+            kitchen_items_reached.append(current_item_index)
+            leaf_cost = min(leaf_cost, current_cost)
+            continue
+
+        candidate_units = foon_object_to_FU_map.get(current_item_index, [])
+        if reachable is not None:
+            candidate_units = reachable.get_candidates(candidate_units)
+        for candidate_idx in candidate_units:
+            if candidate_idx not in unit_inputs:
+                unit_inputs[candidate_idx] = get_required_inputs(foon_functional_units[candidate_idx], utensils)
+                unit_outputs[candidate_idx] = []
+                for node_id in unit_inputs[candidate_idx]:
+                    consumers.setdefault(node_id, []).append(candidate_idx)
+            unit_outputs[candidate_idx].append(current_item_index)
+
+            new_cost = current_cost + get_unit_cost(foon_functional_units[candidate_idx], success_rates)
+            if not unit_inputs[candidate_idx]:
+                leaf_cost = min(leaf_cost, new_cost)
+            for node_id in unit_inputs[candidate_idx]:
+                if new_cost < heuristic.get(node_id, float('inf')):
+                    heuristic[node_id] = new_cost
+                    heapq.heappush(open_list, (new_cost, node_id))
+
+    if exhausted:
+        # every task tree has a chain from the goal to a leaf, not shorter than the open objects' chains
+        lower_bound = min([leaf_cost] + [cost for cost, node_id in open_list if node_id not in settled_items])
+
+    # pass 2: from the kitchen up. best_costs = object index -> least cost found so far of making it,
+    # selected_units = object index -> FU giving that cost
+    best_costs = {}
+    selected_units = {}
+    inputs_left = {}  # FU index -> number of its inputs not settled yet
     open_list = []
-    heapq.heappush(open_list, (0, goal_node.id, 0))  # (f(n), node_id, g(n))
 
-    reference_task_tree = []
-    searched_items = {}
+    def offer(FU_idx):
+        # all inputs of the FU are settled: it gives its outputs a cost
+        unit_cost = get_unit_cost(foon_functional_units[FU_idx], success_rates) + sum(best_costs[node_id] for node_id in unit_inputs[FU_idx])
+        for node_id in unit_outputs[FU_idx]:
+            if node_id not in settled_items and unit_cost < best_costs.get(node_id, float('inf')):
+                best_costs[node_id] = unit_cost
+                selected_units[node_id] = FU_idx
+                heapq.heappush(open_list, (unit_cost + heuristic[node_id], node_id))
+
+    if not exhausted:
+        settled_items = set()
+        for node_id in kitchen_items_reached:
+            best_costs[node_id] = 0
+            heapq.heappush(open_list, (heuristic[node_id], node_id))
+        for FU_idx, inputs_to_search in unit_inputs.items():
+            inputs_left[FU_idx] = len(inputs_to_search)
+            if not inputs_to_search:
+                offer(FU_idx)
 
     while open_list:
-        _, current_item_index, current_cost = heapq.heappop(open_list)
-
-        if current_item_index in searched_items and current_cost >= searched_items[current_item_index]:
+        if out_of_budget():
+            exhausted = True
+            # an object of the cheapest task tree is open with a key at most its cost
+            lower_bound = min([key for key, node_id in open_list if node_id not in settled_items] or [float('inf')])
+            break
+        _, current_item_index = heapq.heappop(open_list)
+        if current_item_index in settled_items:
             continue
-        searched_items[current_item_index] = current_cost
+        settled_items.add(current_item_index)
+        num_expansions += 1
+        if current_item_index == goal_node.id:
+            break
+
+        for FU_idx in consumers.get(current_item_index, []):
+            inputs_left[FU_idx] -= 1
+            if inputs_left[FU_idx] == 0:
+                offer(FU_idx)
+
+    if exhausted:
+        FU_indices, cost = get_anytime_task_tree(kitchen, goal_node.id, selected_units, best_costs, reachable,
+                                                 foon_object_nodes, foon_functional_units, utensils, success_rates)
+        lower_bound = min(lower_bound, cost)
+    else:
+        cost = lower_bound = best_costs.get(goal_node.id, float('inf'))
+        FU_indices = get_cheapest_task_tree(goal_node.id, selected_units, foon_functional_units, utensils)
+        if subtree_cache is not None:
+            subtree_cache.put(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm, FU_indices, cost)
+
+    if stats is not None:
+        stats["cost"] = cost
+        stats["lower_bound"] = lower_bound
+        stats["exhausted"] = exhausted
+        stats["objects_reached"] = len(heuristic)
+        stats["objects_settled"] = len(settled_items)
+
+    task_tree_units = [foon_functional_units[i] for i in FU_indices]
+    return task_tree_units
 
-        current_node = foon_object_nodes[current_item_index]
 
-        # If the current node is in the kitchen, skip further processing
-        if check_ingredient_in_kitchen(kitchen_items, current_node):
-            continue
+# Cost function: inverse of the success rate of the FU's motion (1 if the motion is not in motion.txt)
+def get_unit_cost(FU, success_rates):
+    return 1 / success_rates.get(FU.motion_node, 1)
 
-        candidate_units = foon_object_to_FU_map[current_item_index]
-        selected_candidate_idx = candidate_units[0]  # Selecting the first path
 
-        # Avoid revisiting the same functional unit
-        if selected_candidate_idx in reference_task_tree:
+def get_cheapest_task_tree(goal_id, selected_units, foon_functional_units, utensils):
+    """
+    parameters: goal_id (int) - Index of the goal object
+                selected_units (dict) - Object index -> index of the FU of least cost making it
+                foon_functional_units (list) - List of functional units in the FOON
+                utensils (set) - Set of utensil labels
+    returns: FU_indices (list) - The selected FU of the goal and, breadth first, of every input it needs,
+             listed from the last selected to the first; empty if the goal has no selected FU
+    """
+    # an input of a selected FU always costs less than its output, so following the selection never loops
+    reference_task_tree = {}
+    if goal_id in selected_units:
+        items_to_search = deque([goal_id])
+        items_already_searched = {goal_id}
+        while items_to_search:
+            current_item_index = items_to_search.popleft()
+            if current_item_index not in selected_units:
+                continue  # in the kitchen
+            selected_candidate_idx = selected_units[current_item_index]
+            if selected_candidate_idx in reference_task_tree:
+                continue
+            reference_task_tree[selected_candidate_idx] = None
+            for node_id in get_required_inputs(foon_functional_units[selected_candidate_idx], utensils):
+                if node_id not in items_already_searched:
+                    items_already_searched.add(node_id)
+                    items_to_search.append(node_id)
+
+    return list(reference_task_tree)[::-1]
+
+
+def get_anytime_task_tree(kitchen, goal_id, selected_units, best_costs, reachable, foon_object_nodes, foon_functional_units, utensils, success_rates):
+    """
+    parameters: kitchen (KitchenIndex) - The kitchen of the search
+                goal_id (int) - Index of the goal object
+                selected_units (dict) - Object index -> index of the FU of least cost found so far for it, whose
+                                        inputs all have a selected FU or are in the kitchen
+                best_costs (dict) - Object index -> cost of making it with its selected FU
+                reachable (ReachabilityIndex) - What this kitchen can make, or None
+                foon_object_nodes (list) - List of object nodes in the FOON
+                foon_functional_units (list) - List of functional units in the FOON
+                utensils (set) - Set of utensil labels
+                success_rates (dict) - A dictionary with motion names and their success rates
+    returns: FU_indices (list) - A complete task tree of the goal, listed like get_cheapest_task_tree: every
+                                 object takes its selected FU, or else the FU that first made it reachable;
+                                 empty if an object has neither
+             cost (float) - The cost of that task tree, infinite if it is empty
+    """
+    # the objects of the tree and the FU each of them takes
+    tree_units = {}
+    items_to_search = [goal_id]
+    items_already_searched = {goal_id}
+    while items_to_search:
+        current_item_index = items_to_search.pop()
+        if current_item_index in selected_units:
+            tree_units[current_item_index] = selected_units[current_item_index]
+        elif kitchen.contains(foon_object_nodes[current_item_index]):
             continue
-        reference_task_tree.append(selected_candidate_idx)
+        elif reachable is not None and reachable.first_units[current_item_index] != -1:
+            tree_units[current_item_index] = reachable.first_units[current_item_index]
+        else:
+            return [], float('inf')
+        for node_id in get_required_inputs(foon_functional_units[tree_units[current_item_index]], utensils):
+            if node_id not in items_already_searched:
+                items_already_searched.add(node_id)
+                items_to_search.append(node_id)
+
+    # an object costs its FU plus its inputs (its best cost if the FU is its selected one); the FUs taken
+    # from first_units only need objects that were reachable before, so there is no cycle
+    costs = {}
+    stack = [goal_id]
+    while stack:
+        current_item_index = stack[-1]
+        if current_item_index in costs:
+            stack.pop()
+        elif current_item_index not in tree_units:
+            costs[current_item_index] = 0  # in the kitchen
+            stack.pop()
+        elif current_item_index in selected_units:
+            costs[current_item_index] = best_costs[current_item_index]
+            stack.pop()
+        else:
+            inputs_to_search = get_required_inputs(foon_functional_units[tree_units[current_item_index]], utensils)
+            inputs_left = [node_id for node_id in inputs_to_search if node_id not in costs]
+            if inputs_left:
+                stack.extend(inputs_left)
+            else:
+                stack.pop()
+                costs[current_item_index] = get_unit_cost(foon_functional_units[tree_units[current_item_index]], success_rates) + \
+                    sum(costs[node_id] for node_id in inputs_to_search)
+
+    return get_cheapest_task_tree(goal_id, tree_units, foon_functional_units, utensils), costs[goal_id]
+
+# -----------------------------------------------------------------------------------------------------------------------------#
 
-        # Cost function: inverse of the success rate from motion.txt
-        unit_success_rate = success_rates.get(selected_candidate_idx, 1)  # Default success rate is 1 if not found
-        unit_cost = 1 / unit_success_rate
+# Cost to produce every object of the FOON from one kitchen (Knuth's generalization of Dijkstra)
+#
+# The same cost as search_A_star, computed for the whole graph at once: objects in the kitchen cost
+# nothing, an FU gets a cost once all its inputs are settled, and objects are settled in increasing order
+# of cost. After this one pass the cheapest task tree of any goal is a walk over the selected FUs
+# (get_cheapest_task_tree, or search_A_star given the table), so many goals can be answered for one kitchen.
+def compute_production_costs(kitchen_items=[], success_rates=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[]):
+    """
+    parameters: kitchen_items (list or KitchenIndex) - List of items in the kitchen
+                success_rates (dict) - A dictionary with motion names and their success rates
+                foon_object_nodes (list) - List of object nodes in the FOON
+                foon_functional_units (list) - List of functional units in the FOON
+                foon_object_to_FU_map (dict) - Dictionary mapping object nodes to functional units
+                utensils (list) - List of utensils to check during search
+    returns: best_costs (dict) - Object index -> least cost of making it, for every object that can be made
+             selected_units (dict) - Object index -> index of the FU giving that cost (objects in the kitchen
+                                     are not in it)
+    """
+    kitchen = compile_kitchen(kitchen_items)
+    utensils = set(utensils) if utensils else set()
+    success_rates = success_rates or {}
+
+    unit_inputs = [get_required_inputs(FU, utensils) for FU in foon_functional_units]
+    inputs_left = [len(inputs_to_search) for inputs_to_search in unit_inputs]
+    unit_outputs = {}  # FU index -> indices of the objects it makes
+    for node_id, candidate_units in foon_object_to_FU_map.items():
+        for candidate_idx in candidate_units:
+            unit_outputs.setdefault(candidate_idx, []).append(node_id)
+    consumers = {}  # object index -> FU indices that need it
+    for FU_idx, inputs_to_search in enumerate(unit_inputs):
+        for node_id in inputs_to_search:
+            consumers.setdefault(node_id, []).append(FU_idx)
+
+    best_costs = {}
+    selected_units = {}
+    settled_items = bytearray(len(foon_object_nodes))
+    open_list = []
 
-        # Explore input nodes (children)
-        for input_node in foon_functional_units[selected_candidate_idx].input_nodes:
-            node_id = input_node.id
-            new_cost = current_cost + unit_cost  # Increment cost by the functional unit's cost
+    def offer(FU_idx):
+        # all inputs of the FU are settled: it gives its outputs a cost
+        unit_cost = get_unit_cost(foon_functional_units[FU_idx], success_rates) + \
+            sum(best_costs[node_id] for node_id in unit_inputs[FU_idx])
+        for node_id in unit_outputs.get(FU_idx, []):
+            if not settled_items[node_id] and unit_cost < best_costs.get(node_id, float('inf')):
+                best_costs[node_id] = unit_cost
+                selected_units[node_id] = FU_idx
+                heapq.heappush(open_list, (unit_cost, node_id))
+
+    for node in foon_object_nodes:
+        if kitchen.contains(node):
+            best_costs[node.id] = 0
+            heapq.heappush(open_list, (0, node.id))
+    for FU_idx, inputs_to_search in enumerate(unit_inputs):
+        if not inputs_to_search:
+            offer(FU_idx)
 
-            # Heuristic function: number of input objects (fewer inputs preferred)
-            heuristic_value = len(foon_functional_units[selected_candidate_idx].input_nodes)
+    while open_list:
+        _, current_item_index = heapq.heappop(open_list)
+        if settled_items[current_item_index]:
+            continue
+        settled_items[current_item_index] = 1
 
-            estimated_cost = new_cost + heuristic_value  # A* f(n) = g(n) + h(n)
-            heapq.heappush(open_list, (estimated_cost, node_id, new_cost))
+        for FU_idx in consumers.get(current_item_index, []):
+            inputs_left[FU_idx] -= 1
+            if inputs_left[FU_idx] == 0:
+                offer(FU_idx)
 
-    reference_task_tree.reverse()
-    task_tree_units = [foon_functional_units[i] for i in reference_task_tree]
-    return task_tree_units
+    return best_costs, selected_units
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
-# Iterative Deepening Search (IDS) 
-def search_IDS(kitchen_items=[], goal_node=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[]):
+# Iterative Deepening Search (IDS)
+#
+# Each pass is a depth-limited DFS on an explicit stack. Which FU makes an object and which of its inputs
+# are searched is worked out once per object (expansions), and a transposition table keeps what the
+# passes learnt: the height of every subtree found to be fully resolved, and the largest remaining depth at
+# which a subtree was found not to fit. A resolved subtree is never expanded again, whatever the depth it is
+# reached at, and a subtree that did not fit is only expanded again once a deeper pass gives it more room.
+#
+# The goal fits a depth limit when every object of its task tree, wherever it is needed, has its own
+# subtree within the limit. The search this replaced only checked an object's subtree where the DFS first
+# met it, so the depth limit it stopped at can differ, but the task tree is the same.
+#
+# The task tree of the last pass is the one of a DFS that never reaches its depth limit, so it is read off
+# the expansions with an unlimited DFS once the goal fits: an object is visited the first time it is
+# popped, and the inputs of its FU are searched in order.
+def search_IDS(kitchen_items=[], goal_node=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[], stats=None, reachable=None):
     """
     Iterative Deepening Search (IDS) algorithm
-    parameters: kitchen_items (list) - List of items in the kitchen
+    parameters: kitchen_items (list or KitchenIndex) - List of items in the kitchen
                 goal_node (Object) - The target node to search for
                 foon_object_nodes (list) - List of object nodes in the FOON
                 foon_functional_units (list) - List of functional units in the FOON
                 foon_object_to_FU_map (dict) - Dictionary mapping object nodes to functional units
                 utensils (list) - List of utensils to check during search
+                stats (dict) - If given, filled with the depth limit of the last pass ("depth_limit"),
+                               the number of passes ("iterations") and the number of times an object
+                               had its inputs opened ("expansions")
+                reachable (ReachabilityIndex) - What this kitchen can make (FOON_index); an object is made by its first
+                                                FU that can run, and a goal that cannot be made gives an empty task tree
     returns: task_tree_units (list) - List of functional units representing the task tree
     """
-    depth_limit = 0
-
-    while depth_limit >= 0:
-        reference_task_tree = []
-        items_to_search = [[goal_node.id, 0]]
-        searched_items = []
-        skipped_items = []
+    kitchen = compile_kitchen(kitchen_items) if reachable is None else reachable.kitchen
+    utensils = set(utensils) if utensils else set()
+
+    if reachable is not None and not reachable.is_makeable(goal_node):
+        if stats is not None:
+            stats["depth_limit"] = stats["iterations"] = stats["expansions"] = 0
+        return []
+
+    # key = object index, value = None if the object is in the kitchen,
+    # otherwise (index of the selected FU, indices of the inputs to search)
+    expansions = {}
+
+    def expand(node_id):
+        if node_id not in expansions:
+            if kitchen.contains(foon_object_nodes[node_id]):
+                expansions[node_id] = None
+            else:
+                candidate_units = foon_object_to_FU_map[node_id]
+                if reachable is not None:
+                    candidate_units = reachable.get_candidates(candidate_units)
+                selected_candidate_idx = candidate_units[0]  # Selecting the first path
+                expansions[node_id] = (selected_candidate_idx, get_inputs_to_search(
+                    foon_functional_units[selected_candidate_idx], utensils))
+        return expansions[node_id]
+
+    # transposition table: object index -> height of its resolved subtree (0 for an object in the
+    # kitchen or whose FU has no input to search), and object index -> largest remaining depth
+    # at which its subtree did not fit
+    solved_heights = {}
+    unsolved_depths = {}
+    num_expansions = 0
+
+    def enter(node_id, remaining_depth):
+        # returns the height of the subtree if it is known to fit in remaining_depth, False if it
+        # is known not to fit, or None when its inputs have to be searched
+        if node_id in solved_heights:
+            return solved_heights[node_id] if solved_heights[node_id] <= remaining_depth else False
+        if remaining_depth < 0 or unsolved_depths.get(node_id, -1) >= remaining_depth:
+            return False
+        expansion = expand(node_id)
+        if expansion is None or not expansion[1]:
+            solved_heights[node_id] = 0
+            return 0
+        return None
+
+    def fits(depth_limit):
+        # depth-limited DFS from the goal; returns True if the whole task tree fits in depth_limit
+        nonlocal num_expansions
+        result = enter(goal_node.id, depth_limit)
+        if result is not None:
+            return result is not False
+
+        # frames: [object index, depth, inputs to search, next input, height so far]
+        stack = [[goal_node.id, 0, expand(goal_node.id)[1], 0, 0]]
+        on_path = {goal_node.id}
+        num_expansions += 1
+        while stack:
+            frame = stack[-1]
+            node_id, current_depth, inputs_to_search, next_input, height = frame
+            if next_input == len(inputs_to_search):
+                # every input fits: the subtree is resolved
+                stack.pop()
+                on_path.discard(node_id)
+                solved_heights[node_id] = height
+                if stack:
+                    stack[-1][4] = max(stack[-1][4], height + 1)
+                continue
 
-        while items_to_search:
-            node_id, current_depth = items_to_search.pop(0)
+            frame[3] += 1
+            input_id = inputs_to_search[next_input]
+            if input_id in on_path:
+                continue  # a cycle back into the path, skipped like an already searched item
+            result = enter(input_id, depth_limit - current_depth - 1)
+            if result is None:
+                stack.append([input_id, current_depth + 1, expand(input_id)[1], 0, 0])
+                on_path.add(input_id)
+                num_expansions += 1
+            elif result is False:
+                # the input does not fit, so neither does any object on the path
+                for node_id, current_depth, _, _, _ in stack:
+                    remaining_depth = depth_limit - current_depth
+                    unsolved_depths[node_id] = max(unsolved_depths.get(node_id, -1), remaining_depth)
+                return False
+            else:
+                frame[4] = max(height, result + 1)
+        return True
 
-            # Skip nodes that exceed the current depth limit
-            if current_depth > depth_limit:
-                skipped_items.append(node_id)
-                continue
+    depth_limit = 0
+    while not fits(depth_limit):
+        depth_limit += 1
+
+    if stats is not None:
+        stats["depth_limit"] = depth_limit
+        stats["iterations"] = depth_limit + 1
+        stats["expansions"] = num_expansions
+
+    # unlimited DFS over the expansions, in the order the last pass searched the objects
+    reference_task_tree = {}
+    searched_items = set()
+    items_to_search = [goal_node.id]
+    while items_to_search:
+        node_id = items_to_search.pop()
+        if node_id in searched_items:
+            continue
+        searched_items.add(node_id)
 
-            # Skip already explored nodes
-            if node_id in searched_items:
-                continue
-            searched_items.append(node_id)
+        expansion = expand(node_id)
+        if expansion is None:
+            continue
+        selected_candidate_idx, inputs_to_search = expansion
 
-            current_node = foon_object_nodes[node_id]
+        # Avoid revisiting already processed functional units
+        if selected_candidate_idx in reference_task_tree:
+            continue
+        reference_task_tree[selected_candidate_idx] = None
 
-            # If the current node is not in the kitchen, look for its parent functional unit
-            if not check_ingredient_in_kitchen(kitchen_items, current_node):
-                candidate_units = foon_object_to_FU_map[node_id]
-                selected_candidate_idx = candidate_units[0]  # Selecting the first path
+        # the first input is searched next
+        items_to_search.extend(reversed(inputs_to_search))
 
-                # Avoid revisiting already processed functional units
-                if selected_candidate_idx in reference_task_tree:
-                    continue
-                reference_task_tree.append(selected_candidate_idx)
-
-                # Add input nodes of the functional unit for further exploration
-                sibling_nodes = []
-                for input_node in foon_functional_units[selected_candidate_idx].input_nodes:
-                    node_idx = input_node.id
-                    flag = True
-                    if input_node.label in utensils and len(input_node.ingredients) == 1:
-                        for node2 in foon_functional_units[selected_candidate_idx].input_nodes:
-                            if node2.label == input_node.ingredients[0] and node2.container == input_node.label:
-                                flag = False
-                                break
-                    if flag:
-                        sibling_nodes.append(node_idx)
-
-                # Add sibling nodes to be searched next
-                items_to_search = [[sibling_node, current_depth + 1] for sibling_node in sibling_nodes] + items_to_search
-
-        if skipped_items:
-            depth_limit += 1
-        else:
-            reference_task_tree.reverse()
-            task_tree_units = [foon_functional_units[i] for i in reference_task_tree]
-            return task_tree_units
+    task_tree_units = [foon_functional_units[i] for i in reversed(list(reference_task_tree))]
+    return task_tree_units
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
 # Breadth-First Search (BFS) function 
-def search_BFS(kitchen_items=[], goal_node=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[]):
+def search_BFS(kitchen_items=[], goal_node=None, foon_object_nodes=[], foon_functional_units=[], foon_object_to_FU_map=[], utensils=[], subtree_cache=None, reachable=None):
     """
     Breadth-First Search (BFS) algorithm
-    parameters: kitchen_items (list) - List of items in the kitchen
+    parameters: kitchen_items (list or KitchenIndex) - List of items in the kitchen
                 goal_node (Object) - The target node to search for
                 foon_object_nodes (list) - List of object nodes in the FOON
                 foon_functional_units (list) - List of functional units in the FOON
                 foon_object_to_FU_map (dict) - Dictionary mapping object nodes to functional units
                 utensils (list) - List of utensils to check during search
+                subtree_cache (SubtreeCache) - Cache of solved task trees (FOON_cache), read before and filled after the search, or None
+                reachable (ReachabilityIndex) - What this kitchen can make (FOON_index); an object is made by its first
+                                                FU that can run, and a goal that cannot be made gives an empty task tree
     returns: task_tree_units (list) - List of functional units representing the task tree
     """
-    # list of indices of functional units
-    reference_task_tree = []
-
-    # list of object indices that need to be searched
-    items_to_search = []
-
-    # find the index of the goal node in object node list
-    items_to_search.append(goal_node.id)
-
-    # list of items already explored
-    items_already_searched = []
-
-    while len(items_to_search) > 0:
-        current_item_index = items_to_search.pop(0)  # pop the first element
-        if current_item_index in items_already_searched:
+    # indices of the selected functional units; a dict keeps them in selection order
+    # and tells in O(1) whether an FU is already taken
+    reference_task_tree = {}
+
+    kitchen = compile_kitchen(kitchen_items) if reachable is None else reachable.kitchen
+    utensils = set(utensils) if utensils else set()
+
+    if reachable is not None and not reachable.is_makeable(goal_node):
+        return []
+
+    # a goal already solved in this kitchen, with these utensils, is not searched again; skipping the
+    # FUs that cannot run can select other FUs, so those trees are cached apart
+    algorithm = 'BFS' if reachable is None else 'BFS_reachable'
+    if subtree_cache is not None:
+        utensil_fingerprint = get_utensil_fingerprint(utensils)
+        FU_indices = subtree_cache.get(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm)
+        if FU_indices is not None:
+            return [foon_functional_units[i] for i in FU_indices]
+
+    # queue of object indices that need to be searched, starting from the goal node,
+    # and the set of indices in it (an index is never queued twice at the same time)
+    items_to_search = deque([goal_node.id])
+    items_in_queue = {goal_node.id}
+
+    # items already explored, one byte per object id
+    items_already_searched = bytearray(len(foon_object_nodes))
+
+    while items_to_search:
+        current_item_index = items_to_search.popleft()
+        items_in_queue.discard(current_item_index)
+        if items_already_searched[current_item_index]:
             continue
+        items_already_searched[current_item_index] = 1
 
-        items_already_searched.append(current_item_index)
         current_item = foon_object_nodes[current_item_index]
 
-        if not check_ingredient_in_kitchen(kitchen_items, current_item):
+        if not kitchen.contains(current_item):
             candidate_units = foon_object_to_FU_map[current_item_index]
+            if reachable is not None:
+                candidate_units = reachable.get_candidates(candidate_units)
             selected_candidate_idx = candidate_units[0]  # selecting the first path
 
             if selected_candidate_idx in reference_task_tree:
                 continue
 
-            reference_task_tree.append(selected_candidate_idx)
+            reference_task_tree[selected_candidate_idx] = None
 
             # all input of the selected FU need to be explored
-            for node in foon_functional_units[selected_candidate_idx].input_nodes:
-                node_idx = node.id
-                if node_idx not in items_to_search:
-                    flag = True
-                    if node.label in utensils and len(node.ingredients) == 1:
-                        for node2 in foon_functional_units[selected_candidate_idx].input_nodes:
-                            if node2.label == node.ingredients[0] and node2.container == node.label:
-                                flag = False
-                                break
-                    if flag:
-                        items_to_search.append(node_idx)
-
-    reference_task_tree.reverse()
-    task_tree_units = [foon_functional_units[i] for i in reference_task_tree]
+            for node_idx in get_inputs_to_search(foon_functional_units[selected_candidate_idx], utensils):
+                if node_idx not in items_in_queue:
+                    items_to_search.append(node_idx)
+                    items_in_queue.add(node_idx)
+
+    FU_indices = list(reference_task_tree)[::-1]
+    if subtree_cache is not None:
+        subtree_cache.put(goal_node.id, kitchen.fingerprint, utensil_fingerprint, algorithm, FU_indices)
+    task_tree_units = [foon_functional_units[i] for i in FU_indices]
     return task_tree_units
 
 # -----------------------------------------------------------------------------------------------------------------------------#
@@ -256,15 +684,14 @@ def save_task_tree_to_file(task_tree, file_path):
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
-# Reads the universal FOON from a pickle file and returns the functional units, object nodes, and object-to-FU map
+# Reads the universal FOON from a pickle file (or a compact FOON_store file) and returns the functional units, object nodes, and object-to-FU map
 def load_universal_foon(file_path='FOON.pkl'):
     """
-    parameters: file_path (str) - Path to the pickle file containing FOON data
+    parameters: file_path (str) - Path to the pickle file (or compact FOON_store file) containing FOON data
     returns: functional_units (list), object_nodes (list), object_to_FU_map (dict)
     """
-    with open(file_path, 'rb') as foon_file:
-        foon_data = pickle.load(foon_file)
-    return foon_data["functional_units"], foon_data["object_nodes"], foon_data["object_to_FU_map"]
+    # the graph is rebuilt first if FOON.txt changed since it was written
+    return load_graph(file_path)
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
@@ -277,9 +704,16 @@ if __name__ == '__main__':
 
     kitchen_items = json.load(open('kitchen.json'))
     goal_nodes = json.load(open('goal_nodes.json'))
+    attribute_index = AttributeIndex(foon_object_nodes)
+    # the kitchen is compiled once for all goals: one array lookup per kitchen check
+    kitchen = KitchenIndex(kitchen_items, foon_object_nodes, attribute_index)
+    # what the kitchen can make, so unmakeable goals and FUs are skipped without searching
+    reachable = ReachabilityIndex(kitchen, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
     
     # Load success rates for A* search
     success_rates = load_success_rates()
+    # cost of producing every object from this kitchen, computed once for all A* goals
+    production_costs = compute_production_costs(kitchen, success_rates, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
 
     # Search for each goal node in the FOON graph using IDS, BFS, and A* search
     for node in goal_nodes:
@@ -288,24 +722,27 @@ if __name__ == '__main__':
         node_object.ingredients = node["ingredients"]
         node_object.container = node["container"]
 
-        goal_found = False
-        for foon_object in foon_object_nodes:
-            if foon_object.check_object_equal(node_object):
-                goal_found = True
-
-                # Perform IDS search and save the result
-                task_tree_ids = search_IDS(kitchen_items, foon_object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
-                save_task_tree_to_file(task_tree_ids, f'output_IDS_{node["label"]}.txt')
+        goal_id = attribute_index.lookup(node_object)
+        if goal_id != -1:
+            foon_object = foon_object_nodes[goal_id]
+            if not reachable.is_makeable(foon_object):
+                print(f'{node_object.label} - Goal node cannot be made from the kitchen')
+                continue
 
-                # Perform BFS search and save the result
-                task_tree_bfs = search_BFS(kitchen_items, foon_object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
-                save_task_tree_to_file(task_tree_bfs, f'output_BFS_{node["label"]}.txt')
+            # Perform IDS search and save the result
+            task_tree_ids = search_IDS(kitchen, foon_object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils,
+                                       reachable=reachable)
+            save_task_tree_to_file(task_tree_ids, f'output_IDS_{node["label"]}.txt')
 
-                # Perform A* search and save the result
-                task_tree_a_star = search_A_star(kitchen_items, foon_object, success_rates, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils)
-                save_task_tree_to_file(task_tree_a_star, f'output_A_star_{node["label"]}.txt')
+            # Perform BFS search and save the result
+            task_tree_bfs = search_BFS(kitchen, foon_object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils,
+                                       reachable=reachable)
+            save_task_tree_to_file(task_tree_bfs, f'output_BFS_{node["label"]}.txt')
 
-                break
+            # Perform A* search and save the result
+            task_tree_a_star = search_A_star(kitchen, foon_object, success_rates, foon_object_nodes, foon_functional_units, foon_object_to_FU_map, utensils,
+                                             production_costs=production_costs)
+            save_task_tree_to_file(task_tree_a_star, f'output_A_star_{node["label"]}.txt')
 
-        if not goal_found:
+        else:
             print(f'{node_object.label} - Goal node not found')
@@ -1,7 +1,18 @@
 import json
-import pickle
-from FOON_class import Object
-from search_IDS_A_star import search_IDS, search_A_star, load_universal_foon, load_success_rates, save_task_tree_to_file
+import os
+import random
+import shutil
+import tempfile
+
+import pytest
+
+from benchmark_IDS import search_IDS_legacy
+from FOON_class import FunctionalUnit, Object, ObjectRegistry
+from FOON_cache import SubtreeCache, get_utensil_fingerprint
+from FOON_index import AttributeIndex, KitchenIndex, ReachabilityIndex, get_inputs_to_search, get_required_inputs
+from FOON_store import LazyFOON, write_compact_foon
+from preprocess import append_to_graph, create_graph, create_graph_parallel, load_graph
+from search_IDS_A_star import search_IDS, search_A_star, search_BFS, compute_production_costs, load_universal_foon, load_success_rates, save_task_tree_to_file
 
 # Utility function to create a dummy object for testing
 def create_test_object(label, states, ingredients, container):
@@ -11,18 +22,18 @@ def create_test_object(label, states, ingredients, container):
     obj.container = container
     return obj
 
-def find_goal_node_in_foon(goal_object, foon_object_nodes):
+def find_goal_node_in_foon(goal_object, foon_object_nodes, object_registry=None):
     """
     Find the corresponding goal node in the FOON object nodes.
     If a matching node is found, return the node with its id.
     """
-    for node in foon_object_nodes:
-        if (node.label == goal_object.label and
-            sorted(node.states) == sorted(goal_object.states) and
-            sorted(node.ingredients) == sorted(goal_object.ingredients) and
-            node.container == goal_object.container):
-            return node
-    return None
+    if object_registry is None:
+        object_registry = ObjectRegistry.from_objects(foon_object_nodes)
+
+    goal_id = object_registry.lookup(goal_object)
+    if goal_id == -1:
+        return None
+    return foon_object_nodes[goal_id]
 
 def load_test_data():
     """
@@ -52,12 +63,14 @@ def load_test_data():
 def test_IDS_search():
     functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, _ = load_test_data()
     
+    object_registry = ObjectRegistry.from_objects(object_nodes)
+
     # Pick a goal node from the test data
     for goal in goal_nodes:
         goal_object = create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"])
         
         # Find the matching goal node in FOON object nodes
-        foon_goal_node = find_goal_node_in_foon(goal_object, object_nodes)
+        foon_goal_node = find_goal_node_in_foon(goal_object, object_nodes, object_registry)
         
         if foon_goal_node is None:
             print(f"Goal node {goal['label']} not found in FOON")
@@ -78,12 +91,14 @@ def test_IDS_search():
 def test_A_star_search():
     functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
 
+    object_registry = ObjectRegistry.from_objects(object_nodes)
+
     # Pick a goal node from the test data
     for goal in goal_nodes:
         goal_object = create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"])
         
         # Find the matching goal node in FOON object nodes
-        foon_goal_node = find_goal_node_in_foon(goal_object, object_nodes)
+        foon_goal_node = find_goal_node_in_foon(goal_object, object_nodes, object_registry)
         
         if foon_goal_node is None:
             print(f"Goal node {goal['label']} not found in FOON")
@@ -101,6 +116,556 @@ def test_A_star_search():
         print(f"A* search for {goal['label']} passed.\n")
 
 
+# Test that the compact FOON file loads back to the same graph as FOON.pkl
+def test_compact_foon_round_trip():
+    functional_units, object_nodes, object_to_FU_map = load_universal_foon('FOON.pkl')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compact_path = os.path.join(tmp_dir, 'FOON.bin')
+        write_compact_foon(functional_units, object_nodes, object_to_FU_map, compact_path)
+        compact_units, compact_nodes, compact_map = load_universal_foon(compact_path)
+
+    assert compact_map == object_to_FU_map
+    assert [node.__getstate__() for node in compact_nodes] == [node.__getstate__() for node in object_nodes]
+    for FU, compact_FU in zip(functional_units, compact_units):
+        assert compact_FU.id == FU.id
+        assert compact_FU.get_FU_as_text() == FU.get_FU_as_text()
+        assert [node.id for node in compact_FU.input_nodes] == [node.id for node in FU.input_nodes]
+        assert [node.id for node in compact_FU.output_nodes] == [node.id for node in FU.output_nodes]
+
+
+# Test that appending the second half of FOON.txt to a graph of the first half gives the full graph
+def test_append_to_graph():
+    with open('FOON.txt', 'r') as foon_file:
+        lines = foon_file.readlines()
+    separators = [index for index, line in enumerate(lines) if line.startswith('//')]
+    middle = separators[len(separators) // 2] + 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        first_half = os.path.join(tmp_dir, 'first_half.txt')
+        second_half = os.path.join(tmp_dir, 'second_half.txt')
+        with open(first_half, 'w') as foon_file:
+            foon_file.writelines(lines[:middle])
+        with open(second_half, 'w') as foon_file:
+            foon_file.writelines(['//\n'] + lines[middle:])
+
+        full_graph = os.path.join(tmp_dir, 'full.pkl')
+        appended_graph = os.path.join(tmp_dir, 'appended.pkl')
+        create_graph('FOON.txt', full_graph)
+        create_graph(first_half, appended_graph)
+        append_to_graph([second_half], appended_graph)
+
+        functional_units, object_nodes, object_to_FU_map = load_universal_foon(full_graph)
+        appended_units, appended_nodes, appended_map = load_universal_foon(appended_graph)
+
+    assert appended_map == object_to_FU_map
+    assert [node.get_object_key() for node in appended_nodes] == [node.get_object_key() for node in object_nodes]
+    assert [FU.get_FU_key() for FU in appended_units] == [FU.get_FU_key() for FU in functional_units]
+
+
+# Test that two FUs have the same key exactly when check_if_FU_exist takes one for the other: the same
+# motion, as many nodes, and the same objects, so inputs [a, a, b] and [a, b, b] make a duplicate, which
+# a build keeps once
+def test_FU_key_matches_check_if_FU_exist():
+    def make_FU(motion, input_labels, output_labels):
+        FU = FunctionalUnit()
+        FU.motion_node = motion
+        FU.input_nodes = [create_test_object(label, [], [], None) for label in input_labels]
+        FU.output_nodes = [create_test_object(label, [], [], None) for label in output_labels]
+        return FU
+
+    FU = make_FU('chop', ['onion', 'onion', 'knife'], ['onion'])
+    for other, duplicate in ((make_FU('chop', ['onion', 'knife', 'knife'], ['onion']), True),
+                             (make_FU('chop', ['knife', 'onion', 'onion'], ['onion']), True),
+                             (make_FU('chop', ['onion', 'knife'], ['onion']), False),
+                             (make_FU('chop', ['onion', 'onion', 'knife'], ['onion', 'onion']), False),
+                             (make_FU('slice', ['onion', 'onion', 'knife'], ['onion']), False)):
+        assert other.check_if_FU_exist([FU]) == duplicate
+        assert (other.get_FU_key() == FU.get_FU_key()) == duplicate
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        foon_file = os.path.join(tmp_dir, 'FOON.txt')
+        graph_file = os.path.join(tmp_dir, 'FOON.pkl')
+        with open(foon_file, 'w') as foon_text:
+            foon_text.write('//\nO\tonion\nO\tonion\nO\tknife\nM\tchop\nO\tonion\n//\n'
+                            'O\tonion\nO\tknife\nO\tknife\nM\tchop\nO\tonion\n//\n')
+        for build in (create_graph, lambda source, target: create_graph_parallel(source, target, num_workers=2)):
+            build(foon_file, graph_file)
+            functional_units, _, _ = load_universal_foon(graph_file)
+            assert len(functional_units) == 1
+
+
+# Test that a graph loaded after an append keeps the appended FU, and that a graph without a build
+# record (which could not be rebuilt with the appended FU) is not appended to
+def test_append_to_graph_then_load():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        foon_file = os.path.join(tmp_dir, 'FOON.txt')
+        new_file = os.path.join(tmp_dir, 'new.txt')
+        graph_file = os.path.join(tmp_dir, 'FOON.pkl')
+        shutil.copy('FOON.txt', foon_file)
+        with open(new_file, 'w') as foon:
+            foon.write('//\nO\tonion\nS\twhole\nM\tslice\nO\tonion\nS\tsliced\n//\n')
+
+        create_graph(foon_file, graph_file)
+        functional_units, _, _ = load_graph(graph_file)
+        assert append_to_graph([new_file], graph_file) == 1
+        appended_units, _, _ = load_graph(graph_file)
+        assert len(appended_units) == len(functional_units) + 1
+        assert appended_units[-1].motion_node == 'slice'
+
+        os.remove(graph_file + '.build.json')
+        with open(graph_file, 'rb') as graph:
+            graph_bytes = graph.read()
+        with pytest.raises(ValueError):
+            append_to_graph([new_file], graph_file)
+        with open(graph_file, 'rb') as graph:
+            assert graph.read() == graph_bytes
+        assert len(load_graph(graph_file)[0]) == len(appended_units)
+
+
+# Test that objects coded by different registries are compared by their strings, and that a registry
+# or index built over the graph's nodes in another order does not change their codes
+def test_object_codes_of_different_registries():
+    first = [create_test_object('onion', ['chopped'], [], None), create_test_object('tomato', ['sliced'], [], None)]
+    second = [create_test_object('tomato', ['sliced'], [], None), create_test_object('onion', ['chopped'], [], None)]
+    ObjectRegistry.from_objects(first)
+    ObjectRegistry.from_objects(second)
+    assert first[0].check_object_equal(second[1])
+    assert not first[0].check_object_equal(second[0])
+
+    _, object_nodes, _ = load_universal_foon('FOON.pkl')
+    object_registry = ObjectRegistry.from_objects(object_nodes)
+    vocab_keys = [node.vocab_key for node in object_nodes]
+    reordered_registry = ObjectRegistry.from_objects(object_nodes[::-1])
+    attribute_index = AttributeIndex(object_nodes[::-1])
+    KitchenIndex([], object_nodes[:10])
+    assert [node.vocab_key for node in object_nodes] == vocab_keys
+    assert all(node.vocabulary is object_registry.vocabulary for node in object_nodes)
+    for node in object_nodes[::50]:
+        assert reordered_registry.lookup(node) == len(object_nodes) - 1 - object_registry.lookup(node)
+        assert attribute_index.lookup(node) == reordered_registry.lookup(node)
+
+
+# Test that the consumer and mention maps saved with the graph match a scan of every FU
+def test_FU_indexes():
+    functional_units, object_nodes, _, object_to_consumer_map, object_to_mention_map = \
+        load_graph('FOON.pkl', with_indexes=True)
+
+    input_ids = [set(_input.id for _input in FU.input_nodes) for FU in functional_units]
+    output_ids = [set(_output.id for _output in FU.output_nodes) for FU in functional_units]
+    for node in object_nodes:
+        consumers = [FU.id for FU in functional_units if node.id in input_ids[FU.id]]
+        mentions = [FU.id for FU in functional_units if node.id in input_ids[FU.id] or node.id in output_ids[FU.id]]
+        assert object_to_consumer_map.get(node.id, []) == consumers
+        assert object_to_mention_map.get(node.id, []) == mentions
+
+
+# Test that partial queries on the attribute index give the same objects as a scan of every object
+def test_attribute_index_query():
+    _, object_nodes, _ = load_graph('FOON.pkl')
+    attribute_index = AttributeIndex(object_nodes)
+
+    queries = [
+        ({'label': 'onion', 'states': ['chopped']}, lambda node: node.label == 'onion' and 'chopped' in node.states),
+        ({'ingredients': ['tomato']}, lambda node: 'tomato' in node.ingredients),
+        ({'label': 'cooking pan', 'ingredients': ['onion', 'garlic']},
+         lambda node: node.label == 'cooking pan' and {'onion', 'garlic'} <= set(node.ingredients)),
+        ({'container': 'bowl', 'states': ['mixed']}, lambda node: node.container == 'bowl' and 'mixed' in node.states),
+        ({'label': 'no such label'}, lambda node: False),
+    ]
+    for query, matches in queries:
+        assert attribute_index.query(**query) == [node.id for node in object_nodes if matches(node)]
+
+    for node in object_nodes[:200]:
+        assert attribute_index.find(node) is object_nodes[node.id]
+
+
+# Test that the compiled kitchen agrees with a scan of kitchen.json, and that the searches give the same trees with it
+def test_kitchen_index():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
+    attribute_index = AttributeIndex(object_nodes)
+    kitchen = KitchenIndex(kitchen_items, object_nodes, attribute_index)
+    unbound_kitchen = KitchenIndex(kitchen_items)
+
+    kitchen_objects = [create_test_object(item["label"], item["states"], item["ingredients"], item["container"])
+                       for item in kitchen_items]
+    for node in object_nodes:
+        in_kitchen = any(kitchen_object.check_object_equal(node) for kitchen_object in kitchen_objects)
+        assert kitchen.contains(node) == in_kitchen
+        assert unbound_kitchen.contains(node) == in_kitchen
+
+    for goal in goal_nodes:
+        goal_object = create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"])
+        foon_goal_node = attribute_index.find(goal_object)
+        for search in (search_IDS, search_BFS):
+            expected = search(kitchen_items, foon_goal_node, object_nodes, functional_units, object_to_FU_map, utensils)
+            result = search(kitchen, foon_goal_node, object_nodes, functional_units, object_to_FU_map, utensils)
+            assert result == expected
+        expected = search_A_star(kitchen_items, foon_goal_node, success_rates, object_nodes, functional_units, object_to_FU_map, utensils)
+        result = search_A_star(kitchen, foon_goal_node, success_rates, object_nodes, functional_units, object_to_FU_map, utensils)
+        assert result == expected
+
+
+# Test that BFS still gives the task trees saved in output_BFS_<goal>.txt
+def test_BFS_search():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, _ = load_test_data()
+    object_registry = ObjectRegistry.from_objects(object_nodes)
+
+    for goal in goal_nodes:
+        goal_object = create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"])
+        foon_goal_node = find_goal_node_in_foon(goal_object, object_nodes, object_registry)
+        result = search_BFS(kitchen_items, foon_goal_node, object_nodes, functional_units, object_to_FU_map, utensils)
+
+        with open(f'output_BFS_{goal["label"]}.txt', 'r') as output_file:
+            assert output_file.read() == '//\n' + ''.join(FU.get_FU_as_text() + '\n' for FU in result)
+
+
+# Test that IDS with the transposition table gives the same task trees as the search it replaced,
+# with every object of the graph as the goal, in fewer expansions
+def test_IDS_search_matches_legacy():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, _ = load_test_data()
+    kitchen = KitchenIndex(kitchen_items, object_nodes)
+    args = (object_nodes, functional_units, object_to_FU_map, utensils)
+
+    legacy_expansions = expansions = 0
+    for goal_node in object_nodes:
+        legacy_stats, stats = {}, {}
+        try:
+            expected = search_IDS_legacy(kitchen, goal_node, *args, stats=legacy_stats)
+        except KeyError:
+            # an object of the tree has no FU making it
+            with pytest.raises(KeyError):
+                search_IDS(kitchen, goal_node, *args)
+            continue
+        assert search_IDS(kitchen, goal_node, *args, stats=stats) == expected
+        assert stats["iterations"] == stats["depth_limit"] + 1
+        legacy_expansions += legacy_stats["expansions"]
+        expansions += stats["expansions"]
+    assert expansions < legacy_expansions
+
+
+# Test that A* finds the least cost of making every object of the graph, the same as repeatedly
+# lowering each object's cost to that of its cheapest FU until nothing changes, and that every input
+# its task tree needs is in the kitchen or made by an FU of the tree
+def test_A_star_search_is_optimal():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
+    kitchen = KitchenIndex(kitchen_items, object_nodes)
+
+    unit_inputs = {}
+    for FU in functional_units:
+        output_ids = set(node.id for node in FU.output_nodes)
+        unit_inputs[FU.id] = [node.id for node in FU.input_nodes if node.id not in output_ids and
+                              not (node.label in utensils and len(node.ingredients) == 1 and
+                                   any(node2.label == node.ingredients[0] and node2.container == node.label
+                                       for node2 in FU.input_nodes))]
+    costs = [0 if kitchen.contains(node) else float('inf') for node in object_nodes]
+    changed = True
+    while changed:
+        changed = False
+        for node in object_nodes:
+            for FU_idx in object_to_FU_map.get(node.id, []):
+                cost = 1 / success_rates[functional_units[FU_idx].motion_node] + \
+                    sum(costs[node_id] for node_id in unit_inputs[FU_idx])
+                if cost < costs[node.id] - 1e-9:
+                    costs[node.id] = cost
+                    changed = True
+
+    for goal_node in object_nodes:
+        stats = {}
+        result = search_A_star(kitchen, goal_node, success_rates, object_nodes, functional_units, object_to_FU_map,
+                               utensils, stats=stats)
+        if kitchen.contains(goal_node):
+            assert result == []
+            continue
+        assert stats["cost"] == pytest.approx(costs[goal_node.id])
+        assert bool(result) == (costs[goal_node.id] != float('inf'))
+
+        made = set(node.id for FU in result for node in FU.output_nodes)
+        assert not result or goal_node.id in made
+        for FU in result:
+            assert all(node_id in made or kitchen.contains(object_nodes[node_id]) for node_id in unit_inputs[FU.id])
+
+
+# Test that A* cut short by its budget returns a complete task tree, whose cost is at least the least
+# cost, and a lower bound at most the least cost
+def test_A_star_search_with_budget():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
+    kitchen = KitchenIndex(kitchen_items, object_nodes)
+    reachable = ReachabilityIndex(kitchen, object_nodes, functional_units, object_to_FU_map, utensils)
+    args = (success_rates, object_nodes, functional_units, object_to_FU_map, utensils)
+
+    for goal_node in object_nodes[::5]:
+        if kitchen.contains(goal_node) or not reachable.is_makeable(goal_node):
+            continue
+        stats = {}
+        search_A_star(kitchen, goal_node, *args, stats=stats, reachable=reachable)
+        for max_expansions in (0, 1, 10):
+            budget_stats = {}
+            result = search_A_star(kitchen, goal_node, *args, stats=budget_stats, reachable=reachable,
+                                   max_expansions=max_expansions)
+            assert budget_stats["lower_bound"] <= stats["cost"] + 1e-9
+            assert budget_stats["cost"] >= stats["cost"] - 1e-9
+            if not budget_stats["exhausted"]:
+                assert budget_stats["cost"] == pytest.approx(stats["cost"])
+
+            made = set(node.id for FU in result for node in FU.output_nodes)
+            assert goal_node.id in made
+            for FU in result:
+                assert all(node_id in made or reachable.kitchen.contains(object_nodes[node_id])
+                           for node_id in get_required_inputs(FU, set(utensils)))
+
+    goal_node = next(node for node in object_nodes if reachable.is_makeable(node) and not kitchen.contains(node))
+    stats = {}
+    assert search_A_star(kitchen, goal_node, *args, stats=stats, reachable=reachable, time_limit=0)
+    assert stats["exhausted"] and stats["lower_bound"] == 0
+
+
+# Test that the costs computed once for the whole graph are the ones A* finds goal by goal, and that
+# A* given them returns a task tree of that cost
+def test_compute_production_costs():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
+    kitchen = KitchenIndex(kitchen_items, object_nodes)
+    best_costs, selected_units = compute_production_costs(kitchen, success_rates, object_nodes, functional_units,
+                                                          object_to_FU_map, utensils)
+
+    for goal_node in object_nodes:
+        stats, table_stats = {}, {}
+        result = search_A_star(kitchen, goal_node, success_rates, object_nodes, functional_units, object_to_FU_map,
+                               utensils, stats=stats)
+        table_result = search_A_star(kitchen, goal_node, success_rates, object_nodes, functional_units,
+                                     object_to_FU_map, utensils, stats=table_stats,
+                                     production_costs=(best_costs, selected_units))
+        assert best_costs.get(goal_node.id, float('inf')) == pytest.approx(stats["cost"])
+        assert table_stats["cost"] == pytest.approx(stats["cost"])
+        assert bool(table_result) == bool(result)
+        if goal_node.id in selected_units:
+            assert table_result[-1].id == selected_units[goal_node.id]
+
+
+# Test that the reachability pass marks an FU as able to run when every input the searches expand for it
+# can be made, with the utensils taken as in the kitchen, and that the searches given it skip unmakeable
+# goals and give every other object a complete task tree, in the full kitchen and in kitchens with part
+# of its items
+def test_reachability_index():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
+    kitchen = KitchenIndex(kitchen_items, object_nodes)
+    args = (object_nodes, functional_units, object_to_FU_map, utensils)
+    rng = random.Random(0)
+    reduced_kitchens = [KitchenIndex(rng.sample(kitchen_items, len(kitchen_items) * percent // 100), object_nodes)
+                        for percent in (30, 60, 90)]
+
+    for goal_kitchen in [kitchen] + reduced_kitchens:
+        reachable = ReachabilityIndex(goal_kitchen, object_nodes, functional_units, object_to_FU_map, utensils)
+        # A* does not need the inputs an FU passes through, so it can make at least these objects
+        best_costs, _ = compute_production_costs(reachable.kitchen, success_rates, object_nodes, functional_units,
+                                                 object_to_FU_map, utensils)
+        assert set(node.id for node in object_nodes if node in reachable) <= set(best_costs)
+
+        for goal_node in object_nodes:
+            if not reachable.is_makeable(goal_node):
+                assert search_BFS(goal_kitchen, goal_node, *args, reachable=reachable) == []
+                assert search_IDS(goal_kitchen, goal_node, *args, reachable=reachable) == []
+                continue
+            for FU_idx in object_to_FU_map.get(goal_node.id, []):
+                assert reachable.units[FU_idx] == all(reachable.objects[node_id] for node_id in
+                                                      get_inputs_to_search(functional_units[FU_idx], set(utensils)))
+            for search in (search_BFS, search_IDS):
+                task_tree = search(goal_kitchen, goal_node, *args, reachable=reachable)
+                made = set(node.id for FU in task_tree for node in FU.output_nodes)
+                assert goal_node.id in made or reachable.kitchen.contains(goal_node)
+                for FU in task_tree:
+                    assert all(node_id in made or reachable.kitchen.contains(object_nodes[node_id])
+                               for node_id in get_inputs_to_search(FU, set(utensils)))
+
+
+# Test that the subtree cache returns the trees the searches found, evicts the least recently used
+# entries, keeps the trees of other utensil lists apart and keeps its entries in its backing file for
+# the same graph only
+def test_subtree_cache():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
+    attribute_index = AttributeIndex(object_nodes)
+    kitchen = KitchenIndex(kitchen_items, object_nodes, attribute_index)
+    goals = [attribute_index.find(create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"]))
+             for goal in goal_nodes]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'subtrees')
+        with SubtreeCache(capacity=len(goals), filepath=cache_path, graph_key='graph') as subtree_cache:
+            for _ in range(2):
+                for goal in goals:
+                    assert search_BFS(kitchen, goal, object_nodes, functional_units, object_to_FU_map, utensils,
+                                      subtree_cache) == \
+                        search_BFS(kitchen, goal, object_nodes, functional_units, object_to_FU_map, utensils)
+                    assert search_A_star(kitchen, goal, success_rates, object_nodes, functional_units, object_to_FU_map,
+                                         utensils, subtree_cache) == \
+                        search_A_star(kitchen, goal, success_rates, object_nodes, functional_units, object_to_FU_map,
+                                      utensils)
+            assert subtree_cache.misses == 2 * len(goals)
+            assert subtree_cache.hits == 2 * len(goals)
+            assert len(subtree_cache) == len(goals)  # the older half was evicted from memory
+
+        utensil_fingerprint = get_utensil_fingerprint(utensils)
+        with SubtreeCache(capacity=1, filepath=cache_path, graph_key='graph') as subtree_cache:
+            assert subtree_cache.get(goals[0].id, kitchen.fingerprint, utensil_fingerprint, 'BFS') is not None
+            assert subtree_cache.get(goals[0].id, kitchen.fingerprint + 'x', utensil_fingerprint, 'BFS') is None
+            assert subtree_cache.get(goals[0].id, kitchen.fingerprint, get_utensil_fingerprint([]), 'BFS') is None
+            assert (subtree_cache.hits, subtree_cache.misses) == (1, 2)
+
+            # the utensils decide which inputs are searched, so a search with none does not take the
+            # tree found with them (greek salad has another tree without them)
+            goal = goals[1]
+            for search, args in ((search_BFS, ()), (search_A_star, (success_rates,))):
+                expected = search(kitchen, goal, *args, object_nodes, functional_units, object_to_FU_map, [])
+                assert expected != search(kitchen, goal, *args, object_nodes, functional_units, object_to_FU_map,
+                                          utensils, subtree_cache)
+                assert search(kitchen, goal, *args, object_nodes, functional_units, object_to_FU_map, [],
+                              subtree_cache) == expected
+            assert subtree_cache.misses == 4
+
+        with SubtreeCache(filepath=cache_path, graph_key='another graph') as subtree_cache:
+            assert subtree_cache.get(goals[0].id, kitchen.fingerprint, utensil_fingerprint, 'BFS') is None
+
+
+# Test that an A* search answered from the subtree cache fills stats with the cost of the cached tree,
+# and that trees searched with and without a ReachabilityIndex are cached apart
+def test_A_star_search_with_subtree_cache():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, success_rates = load_test_data()
+    attribute_index = AttributeIndex(object_nodes)
+    kitchen = KitchenIndex(kitchen_items, object_nodes, attribute_index)
+    reachable = ReachabilityIndex(kitchen, object_nodes, functional_units, object_to_FU_map, utensils)
+    goals = [attribute_index.find(create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"]))
+             for goal in goal_nodes]
+    # a goal the index cannot make is answered without searching, so it is not cached
+    goals = [goal for goal in goals if reachable.is_makeable(goal)]
+    args = (success_rates, object_nodes, functional_units, object_to_FU_map, utensils)
+
+    subtree_cache = SubtreeCache()
+    for goal_reachable in (None, reachable):
+        for goal in goals:
+            stats, cached_stats = {}, {}
+            task_tree = search_A_star(kitchen, goal, *args, subtree_cache, stats=stats, reachable=goal_reachable)
+            misses = subtree_cache.misses
+            assert search_A_star(kitchen, goal, *args, subtree_cache, stats=cached_stats,
+                                 reachable=goal_reachable) == task_tree
+            assert subtree_cache.misses == misses, "the second search is answered from the cache"
+            assert cached_stats["cost"] == pytest.approx(stats["cost"])
+            assert cached_stats["lower_bound"] == pytest.approx(stats["cost"])
+            assert cached_stats["exhausted"] is False
+    assert subtree_cache.misses == subtree_cache.hits == 2 * len(goals)
+    assert len(subtree_cache) == 2 * len(goals)
+
+
+# Test that a sharded build in a process pool gives the same ids as a serial build
+def test_create_graph_parallel():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the same FOON with '\r\n' line endings, which both builds read as '\n', and one more FU with an
+        # object in motion (a field kept with its line ending) and a '\x0c' inside a line
+        crlf_foon = os.path.join(tmp_dir, 'FOON_crlf.txt')
+        with open('FOON.txt', 'rb') as source, open(crlf_foon, 'wb') as target:
+            target.write(source.read().replace(b'\r\n', b'\n').replace(b'\n', b'\r\n'))
+            target.write(b'O\tcup\t1\r\nS\tempty\x0cclean\r\nM\tpick-and-place\r\nO\tcup\t1\r\nS\tin\t[hand]\r\n//\r\n')
+
+        graphs = []
+        for foon_file in ('FOON.txt', crlf_foon):
+            serial_graph = os.path.join(tmp_dir, 'serial.pkl')
+            parallel_graph = os.path.join(tmp_dir, 'parallel.pkl')
+            create_graph(foon_file, serial_graph)
+            create_graph_parallel(foon_file, parallel_graph, num_workers=2)
+
+            functional_units, object_nodes, object_to_FU_map = load_universal_foon(serial_graph)
+            parallel_units, parallel_nodes, parallel_map = load_universal_foon(parallel_graph)
+
+            assert parallel_map == object_to_FU_map
+            assert [node.__getstate__() for node in parallel_nodes] == [node.__getstate__() for node in object_nodes]
+            assert [FU.get_FU_as_text() for FU in parallel_units] == [FU.get_FU_as_text() for FU in functional_units]
+            graphs.append([node.__getstate__() for node in object_nodes])
+
+    # the extra FU only adds objects after those of FOON.txt
+    assert graphs[1][:len(graphs[0])] == graphs[0] and len(graphs[1]) > len(graphs[0])
+
+
+# Test that the cached graph is reused while FOON.txt is unchanged and rebuilt once it changes
+def test_load_graph_cache():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        foon_file = os.path.join(tmp_dir, 'FOON.txt')
+        graph_file = os.path.join(tmp_dir, 'FOON.pkl')
+        shutil.copy('FOON.txt', foon_file)
+
+        functional_units, _, _ = load_graph(graph_file)  # no graph yet, so it is built
+        built_time = os.path.getmtime(graph_file)
+        os.utime(graph_file, (built_time - 10, built_time - 10))
+
+        cached_units, _, _ = load_graph(graph_file)
+        assert os.path.getmtime(graph_file) == built_time - 10, "unchanged FOON.txt should not be parsed again"
+        assert len(cached_units) == len(functional_units)
+
+        with open(foon_file, 'a') as foon:
+            foon.write('O\tonion\nS\twhole\nM\tslice\nO\tonion\nS\tsliced\n//\n')
+        rebuilt_units, _, _ = load_graph(graph_file)
+        assert len(rebuilt_units) == len(functional_units) + 1
+
+        # without a record, nothing says the graph was built from FOON.txt: it is read, not rebuilt over
+        os.remove(graph_file + '.build.json')
+        with open(foon_file, 'a') as foon:
+            foon.write('O\tonion\nS\twhole\nM\tdice\nO\tonion\nS\tdiced\n//\n')
+        unrecorded_units, _, _ = load_graph(graph_file)
+        assert len(unrecorded_units) == len(rebuilt_units)
+        assert sorted(os.listdir(tmp_dir)) == ['FOON.pkl', 'FOON.txt'], "no temporary file is left behind"
+
+
+# Test that IDS gives the same task trees on a lazy graph view, which only builds the nodes it touches
+def test_IDS_search_on_lazy_foon():
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, _ = load_test_data()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compact_path = os.path.join(tmp_dir, 'FOON.bin')
+        write_compact_foon(functional_units, object_nodes, object_to_FU_map, compact_path)
+
+        with LazyFOON(compact_path, cache_size=100) as lazy_foon:
+            for goal in goal_nodes:
+                goal_object = create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"])
+                foon_goal_node = find_goal_node_in_foon(goal_object, object_nodes)
+                goal_id = lazy_foon.lookup(goal_object)
+                assert goal_id == foon_goal_node.id
+
+                expected = search_IDS(kitchen_items, foon_goal_node, object_nodes, functional_units, object_to_FU_map, utensils)
+                result = search_IDS(kitchen_items, lazy_foon.object_nodes[goal_id], lazy_foon.object_nodes,
+                                    lazy_foon.functional_units, lazy_foon.object_to_FU_map, utensils)
+                assert [FU.get_FU_as_text() for FU in result] == [FU.get_FU_as_text() for FU in expected]
+
+            assert lazy_foon.object_nodes.cached_count() <= 100
+
+
+# Test that a kitchen index over a lazy graph view is found from its label index, without building
+# every object, and that its object to FU map takes any integer type as an object id
+def test_lazy_foon_indexes():
+    numpy = pytest.importorskip('numpy')
+    functional_units, object_nodes, object_to_FU_map, kitchen_items, goal_nodes, utensils, _ = load_test_data()
+    kitchen = KitchenIndex(kitchen_items, object_nodes)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compact_path = os.path.join(tmp_dir, 'FOON.bin')
+        write_compact_foon(functional_units, object_nodes, object_to_FU_map, compact_path)
+
+        with LazyFOON(compact_path) as lazy_foon:
+            lazy_kitchen = KitchenIndex(kitchen_items, lazy_foon.object_nodes)
+            assert lazy_kitchen.in_kitchen == kitchen.in_kitchen
+            assert lazy_foon.object_nodes.cached_count() == 0
+
+            for goal in goal_nodes:
+                goal_object = create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"])
+                assert lazy_foon.object_nodes.lookup(goal_object) == find_goal_node_in_foon(goal_object, object_nodes).id
+
+            for object_id in numpy.arange(len(object_nodes), dtype=numpy.int64):
+                if int(object_id) in object_to_FU_map:
+                    assert lazy_foon.object_to_FU_map[object_id] == object_to_FU_map[int(object_id)]
+                else:
+                    assert object_id not in lazy_foon.object_to_FU_map
+            for object_id in (-1, len(object_nodes), 'onion', 1.0):
+                with pytest.raises(KeyError):
+                    lazy_foon.object_to_FU_map[object_id]
+
+
 if __name__ == '__main__':
     # Run IDS search test
     test_IDS_search()
@@ -0,0 +1,115 @@
+import hashlib
+import shelve
+from collections import OrderedDict
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Cache of solved task trees, shared by the searches.
+#
+# An entry is the list of FU indices that a search returned for one goal object, and the cost of that
+# tree for a search that gives one (A*), keyed by the object id, the fingerprint of the kitchen
+# (KitchenIndex.fingerprint), the fingerprint of the utensil list (get_utensil_fingerprint), which decides
+# the inputs a search explores, and the name of the search. A search given a cache returns the cached tree
+# of its goal without expanding any node, and stores the tree it found.
+# Entries are kept in memory up to a fixed number, least recently used first out, and can be backed by a
+# shelve file so they survive between runs.
+
+GRAPH_KEY_ENTRY = '__graph_key__'  # shelf entry naming the graph the stored trees belong to
+ENTRY_FORMAT = 3  # version of the stored entries, kept with the graph key; other versions are cleared
+
+
+class SubtreeCache:
+    '''
+    LRU cache of task trees, optionally backed by a file.
+
+    Object ids are only meaningful for one graph, and the trees of A* also depend on the success
+    rates, so one cache should be used with one graph and one set of success rates.
+
+    Constructor Parameters:
+            capacity (int): number of entries kept in memory
+            filepath (str): path of a shelve file backing the cache, or None to keep it in memory only
+            graph_key (str): identifies the graph, e.g. the source hash of its build record; a backing
+                    file written for another graph is cleared when it is opened
+
+    '''
+
+    def __init__(self, capacity=4096, filepath=None, graph_key=None):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key = (object id, kitchen fingerprint, utensil fingerprint, algorithm), value = (tuple of FU indices, cost)
+        self.hits = 0
+        self.misses = 0
+
+        self.shelf = None
+        if filepath is not None:
+            self.shelf = shelve.open(filepath)
+            if self.shelf.get(GRAPH_KEY_ENTRY) != (ENTRY_FORMAT, graph_key):
+                self.shelf.clear()
+                self.shelf[GRAPH_KEY_ENTRY] = (ENTRY_FORMAT, graph_key)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, object_id, kitchen_fingerprint, utensil_fingerprint, algorithm, with_cost=False):
+        """
+            parameters: id of the goal object, fingerprint of the kitchen, fingerprint of the utensil list,
+                    name of the search, and whether to return the cost stored with the tree
+            returns: the cached FU indices of the goal's task tree, or None on a miss; with with_cost,
+                    (FU indices, cost) instead, the cost None if none was stored
+        """
+        key = (object_id, kitchen_fingerprint, utensil_fingerprint, algorithm)
+        entry = self.entries.get(key)
+        if entry is None and self.shelf is not None:
+            entry = self.shelf.get(_get_shelf_key(key))
+            if entry is not None:
+                self._keep(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry if with_cost else entry[0]
+
+    def put(self, object_id, kitchen_fingerprint, utensil_fingerprint, algorithm, FU_indices, cost=None):
+        key = (object_id, kitchen_fingerprint, utensil_fingerprint, algorithm)
+        entry = (tuple(FU_indices), cost)
+        self._keep(key, entry)
+        if self.shelf is not None:
+            self.shelf[_get_shelf_key(key)] = entry
+
+    def clear(self):
+        self.entries.clear()
+        if self.shelf is not None:
+            graph_entry = self.shelf.get(GRAPH_KEY_ENTRY)
+            self.shelf.clear()
+            self.shelf[GRAPH_KEY_ENTRY] = graph_entry
+
+    def close(self):
+        if self.shelf is not None:
+            self.shelf.close()
+            self.shelf = None
+
+    def _keep(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+def get_utensil_fingerprint(utensils):
+    """
+        parameters: labels of the utensils given to a search
+        returns: a short string identifying the set of labels, to key the trees searched with them
+    """
+    return hashlib.sha256('\n'.join(sorted(set(utensils))).encode('utf-8')).hexdigest()[:16]
+
+
+# shelve keys are strings
+def _get_shelf_key(key):
+    return '%d:%s:%s:%s' % key
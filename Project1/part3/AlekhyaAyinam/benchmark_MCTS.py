@@ -0,0 +1,268 @@
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from FOON_class import Object
+from FOON_index import AttributeIndex, KitchenIndex, ReachabilityIndex, compile_kitchen
+from search_MCTS import get_motion_success_rates, get_unit_inputs, get_unit_success_probabilities, read_universal_foon, search_MCTS, simulate_unit_execution
+from search_MCTS import MCTSStatisticsStore, make_MCTS_executor, search_MCTS_parallel
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Compares search_MCTS with the version it replaced, which ran every rollout of a unit as its own
+# random.uniform call: time per goal of goal_nodes.json, and the number of successes of a unit in one
+# batch of rollouts, which must have the same distribution (binomial) with both.
+# Then times search_MCTS_parallel on the goal with the largest tree for the same total number of
+# descents split over 1, 2, 4, ... workers (up to the number of CPUs, at least 2), and the share of
+# choices of the most probable unit of cold searches against searches warm-started from a store,
+# and what search_MCTS returns on that goal for growing time budgets.
+
+
+def search_MCTS_legacy(kitchen_items, target_node, obj_nodes=[], func_units=[], obj_to_unit_map=[], iterations=1000, reachable=None):
+    # search_MCTS before its rollouts were drawn with NumPy: one simulate_unit_execution call per rollout
+    # List to store the selected task tree functional units
+    task_sequence = []
+
+    # Compile the kitchen once, so the check in every recursion is a lookup
+    kitchen = compile_kitchen(kitchen_items)
+    if reachable is not None and not reachable.is_makeable(target_node):
+        return task_sequence
+
+    # A dictionary to store the success counts (wins) and number of attempts (trials) for each FU
+    unit_stats = {idx: {"wins": 0, "trials": 0} for idx in range(len(func_units))}
+
+    # Load the motion success probabilities from motion.txt
+    motion_probs = get_motion_success_rates("motion.txt")
+
+    # Perform the MCTS search for a given goal node
+    def perform_mcts(goal):
+        # List to store the sequence of units during the search
+        selected_units = []
+        visited = set()  # Track visited nodes to prevent re-exploring
+
+        # Function to simulate task tree search starting from the goal node
+        def simulate_task_tree(node):
+            # If the node exists in the kitchen, return success
+            if kitchen.contains(node):
+                return True
+
+            # If the node has already been visited, skip to prevent cycles
+            if node.id in visited:
+                return False
+
+            visited.add(node.id)  # Mark the node as visited
+
+            # Retrieve the functional units that produce the node
+            available_units = obj_to_unit_map[node.id]
+            if reachable is not None:
+                available_units = reachable.get_candidates(available_units)
+            optimal_unit = None
+            optimal_score = -float('inf')
+
+            # Simulate each functional unit and select the best one
+            for idx in available_units:
+                unit_stats[idx]["trials"] += 1  # Increment the count of trials for this unit
+                unit_successes = 0
+
+                # Run multiple simulations for each unit
+                for _ in range(iterations):
+                    if simulate_unit_execution(func_units[idx], motion_probs):
+                        unit_successes += 1
+
+                # Update the success count for the functional unit
+                unit_stats[idx]["wins"] += unit_successes
+
+                # Calculate UCB1 score
+                total_trials = sum([unit_stats[unit]["trials"] for unit in unit_stats])
+                success_ratio = unit_stats[idx]["wins"] / unit_stats[idx]["trials"]
+                exploration_bonus = math.sqrt(2 * math.log(total_trials) / unit_stats[idx]["trials"])
+                ucb1_score = success_ratio + exploration_bonus
+
+                # Update the best unit based on the highest score
+                if ucb1_score > optimal_score:
+                    optimal_score = ucb1_score
+                    optimal_unit = idx
+
+            # Add the optimal unit to the task tree
+            if optimal_unit is not None:
+                selected_units.append(optimal_unit)
+                for input_node in func_units[optimal_unit].input_nodes:
+                    simulate_task_tree(obj_nodes[input_node.id])  # Recurse for the input nodes
+
+        simulate_task_tree(goal)
+        return selected_units
+
+    # Run MCTS for the target node
+    task_tree_indices = perform_mcts(target_node)
+
+    # Convert indices to functional units
+    task_sequence = [func_units[index] for index in task_tree_indices]
+    return task_sequence
+
+
+def time_search(search, *args, **kwargs):
+    start = time.perf_counter()
+    task_tree = search(*args, **kwargs)
+    return task_tree, time.perf_counter() - start
+
+
+def time_parallel(kitchen, goal_node, graph, reachable, unit_probabilities, descents=16):
+    # the same budget (descents x 1000 executions per simulated unit) for every number of workers;
+    # the pools are started before timing, as a planner keeps its pool for all searches
+    max_workers = max(2, os.cpu_count() or 1)
+    workers = 1
+    base_time = None
+    while workers <= max_workers:
+        executor = make_MCTS_executor(workers, kitchen, *graph, reachable, unit_probabilities)
+        search_MCTS_parallel(kitchen, goal_node, *graph, workers=workers, passes=1, reachable=reachable, seed=0,
+                             executor=executor)
+        task_tree, parallel_time = time_search(search_MCTS_parallel, kitchen, goal_node, *graph, workers=workers,
+                                               passes=descents // workers, reachable=reachable, seed=0,
+                                               executor=executor)
+        executor.shutdown()
+        base_time = base_time or parallel_time
+        print('-- %d worker(s) x %2d descents | FU: %3d | %8.2f ms | speedup: %4.2fx (%d CPUs)' %
+              (workers, descents // workers, len(task_tree), parallel_time * 1000, base_time / parallel_time,
+               os.cpu_count()))
+        workers *= 2
+
+
+def get_best_choices(kitchen, goal_node, task_tree, graph, reachable, unit_probabilities):
+    # walks the objects in the order of search_MCTS, taking the units of its task tree in turn;
+    # returns the number of objects with more than one candidate, and how many of them got a unit
+    # with the highest success probability
+    obj_nodes, func_units, obj_to_unit_map = graph
+    chosen_units = iter(task_tree)
+    visited = set()
+    choices = [0, 0]
+
+    def walk(node):
+        if kitchen.contains(node) or node.id in visited:
+            return
+        visited.add(node.id)
+        candidates = reachable.get_candidates(obj_to_unit_map[node.id])
+        if not candidates:
+            return
+        FU = next(chosen_units)
+        if len(candidates) > 1:
+            choices[0] += 1
+            choices[1] += unit_probabilities[FU.id] == unit_probabilities[candidates].max()
+        for input_node in FU.input_nodes:
+            walk(obj_nodes[input_node.id])
+
+    walk(goal_node)
+    return choices
+
+
+def compare_warm_start(kitchen, graph, reachable, unit_probabilities, warm_up_iterations=10, seed=0):
+    # every object the kitchen can make is searched, cold with 1000 down to 1 executions per trial,
+    # and warm after a store was filled by searching a quarter of them once
+    goal_nodes = [node for node in graph[0] if reachable.is_makeable(node) and not kitchen.contains(node)]
+    rng = np.random.default_rng(seed)
+
+    def search_all(iterations, store=None):
+        choices, start = [0, 0], time.perf_counter()
+        for goal_node in goal_nodes:
+            task_tree = search_MCTS(kitchen, goal_node, *graph, iterations=iterations, reachable=reachable,
+                                    unit_probabilities=unit_probabilities, rng=rng, store=store)
+            for i, count in enumerate(get_best_choices(kitchen, goal_node, task_tree, graph, reachable, unit_probabilities)):
+                choices[i] += count
+        return choices[1] / choices[0], time.perf_counter() - start
+
+    for iterations in (1000, 100, 10, 1):
+        best_choices, search_time = search_all(iterations)
+        print('-- cold, %4d executions per trial | best unit chosen: %6.2f%% | %d objects: %6.2f s' %
+              (iterations, best_choices * 100, len(goal_nodes), search_time))
+
+    store = MCTSStatisticsStore(len(graph[1]))
+    start = time.perf_counter()
+    for goal_node in goal_nodes[::4]:
+        search_MCTS(kitchen, goal_node, *graph, iterations=warm_up_iterations, reachable=reachable,
+                    unit_probabilities=unit_probabilities, rng=rng, store=store)
+    print('-- warm-up: %d searches, %d executions per trial | %6.2f s' %
+          (store.searches, warm_up_iterations, time.perf_counter() - start))
+    snapshot = (store.successes, store.executions)
+    for iterations in (10, 1):
+        store.successes, store.executions = snapshot
+        best_choices, search_time = search_all(iterations, store)
+        print('-- warm, %4d executions per trial | best unit chosen: %6.2f%% | %d objects: %6.2f s' %
+              (iterations, best_choices * 100, len(goal_nodes), search_time))
+
+
+def time_anytime(kitchen, goal_node, graph, reachable, unit_probabilities):
+    # the success probability of the task tree, estimated and true, and its 95% lower bound
+    for time_limit in (0.005, 0.02, 0.1, 0.5):
+        stats = {}
+        task_tree, search_time = time_search(search_MCTS, kitchen, goal_node, *graph, reachable=reachable,
+                                             unit_probabilities=unit_probabilities, rng=0, time_limit=time_limit,
+                                             stats=stats)
+        true_probability = np.prod(unit_probabilities[np.unique([FU.id for FU in task_tree])])
+        print('-- time limit %5.0f ms | %3d descents, %9d rollouts | success probability estimated: %.3e, '
+              'true: %.3e, 95%% lower bound: %.3e | %6.1f ms' %
+              (time_limit * 1000, stats["descents"], stats["rollouts"], stats["success_probability"],
+               true_probability, stats["success_lower_bound"], search_time * 1000))
+
+
+def compare_rollouts(probability, iterations=1000, batches=2000, seed=0):
+    # successes of one unit in a batch of rollouts: one random.uniform per rollout, and one binomial draw
+    FU = type('FU', (), {'motion_node': 'motion'})()
+    start = time.perf_counter()
+    legacy_counts = np.array([sum(simulate_unit_execution(FU, {'motion': probability}) for _ in range(iterations))
+                              for _ in range(batches)])
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    counts = np.random.default_rng(seed).binomial(iterations, np.full(batches, probability))
+    new_time = time.perf_counter() - start
+    print('-- p = %.2f | mean successes legacy: %7.2f, search_MCTS: %7.2f, expected: %7.2f | '
+          'std legacy: %5.2f, search_MCTS: %5.2f, expected: %5.2f | %d batches legacy: %7.1f ms, search_MCTS: %5.2f ms' %
+          (probability, legacy_counts.mean(), counts.mean(), iterations * probability, legacy_counts.std(),
+           counts.std(), math.sqrt(iterations * probability * (1 - probability)), batches, legacy_time * 1000,
+           new_time * 1000))
+
+
+if __name__ == '__main__':
+    foon_functional_units, foon_object_nodes, foon_object_to_FU_map = read_universal_foon()
+    kitchen_items = json.load(open('kitchen.json'))
+    goal_nodes = json.load(open('goal_nodes.json'))
+    attribute_index = AttributeIndex(foon_object_nodes)
+    kitchen = KitchenIndex(kitchen_items, foon_object_nodes, attribute_index)
+    reachable = ReachabilityIndex(kitchen, foon_object_nodes, foon_functional_units, foon_object_to_FU_map,
+                                  get_inputs=get_unit_inputs)
+    unit_probabilities = get_unit_success_probabilities(foon_functional_units, get_motion_success_rates('motion.txt'))
+    graph = (foon_object_nodes, foon_functional_units, foon_object_to_FU_map)
+
+    for node in goal_nodes:
+        node_object = Object(node["label"])
+        node_object.states = node["states"]
+        node_object.ingredients = node["ingredients"]
+        node_object.container = node["container"]
+        goal_node = attribute_index.find(node_object)
+        if goal_node is None:
+            continue
+        legacy_tree, legacy_time = time_search(search_MCTS_legacy, kitchen, goal_node, *graph, reachable=reachable)
+        task_tree, new_time = time_search(search_MCTS, kitchen, goal_node, *graph, reachable=reachable,
+                                          unit_probabilities=unit_probabilities, rng=0)
+        print('-- %-14s FU legacy: %3d, search_MCTS: %3d | legacy: %9.2f ms | search_MCTS: %7.2f ms | speedup: %5.0fx' %
+              (node["label"], len(legacy_tree), len(task_tree), legacy_time * 1000, new_time * 1000,
+               legacy_time / new_time))
+
+    largest_goal = None
+    for node in goal_nodes:
+        node_object = Object(node["label"])
+        node_object.states = node["states"]
+        node_object.ingredients = node["ingredients"]
+        node_object.container = node["container"]
+        goal_node = attribute_index.find(node_object)
+        if goal_node is not None:
+            size = len(search_MCTS(kitchen, goal_node, *graph, reachable=reachable, unit_probabilities=unit_probabilities, rng=0))
+            if largest_goal is None or size > largest_goal[0]:
+                largest_goal = (size, goal_node)
+    time_parallel(kitchen, largest_goal[1], graph, reachable, unit_probabilities)
+    compare_warm_start(kitchen, graph, reachable, unit_probabilities)
+    time_anytime(kitchen, largest_goal[1], graph, reachable, unit_probabilities)
+
+    for probability in (0.1, 0.5, 0.9):
+        compare_rollouts(probability)
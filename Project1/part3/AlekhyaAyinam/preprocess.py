@@ -1,18 +1,41 @@
-from FOON_class import FunctionalUnit, Object
+import hashlib
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from FOON_class import FunctionalUnit, Object, ObjectRegistry, Vocabulary
+from FOON_store import is_compact_foon, read_compact_foon, write_compact_foon
 import pickle
 
 # -----------------------------------------------------------------------------------------------------------------------------#
 
 
+def iter_FU_list(filepath):
+    """
+        parameters: path of a text file
+        returns: a generator that yields one FU at a time, as soon as its
+                 '//' separator is read
+    """
+    with open(filepath, 'r') as lines:
+        for FU in parse_FU_lines(lines):
+            yield FU
+
+
 def get_FU_list(filepath):
     """
         parameters: path of a text file
         returns: a list of FU
     """
-    lines = open(filepath, 'r')
+    return list(iter_FU_list(filepath))
 
-    FU_list = []
 
+def parse_FU_lines(lines):
+    """
+        parameters: an iterable of lines in FOON text format
+        returns: a generator of FU
+    """
     FU = FunctionalUnit()
     new_object = None
     is_input = True
@@ -28,7 +51,7 @@ def get_FU_list(filepath):
                 new_object = None
                 # if FU is already constructed, add it to the FU list
             if FU.motion_node:
-                FU_list.append(FU)
+                yield FU
                 FU = FunctionalUnit()
 
             is_input = True
@@ -85,75 +108,486 @@ def get_FU_list(filepath):
             is_input = False
             FU.motion_node = label[1]
 
-    return FU_list
-
-
-def create_graph(foon_file='FOON.txt'):
 
-    functional_units = []
-    fu_id = 0
-
-    FU_list = get_FU_list(foon_file)
-    for FU in FU_list:
+class FOONBuilder:
+    '''
+    Builds the universal foon one functional unit at a time.
+
+    Duplicate FUs and objects are found through their canonical keys, and new FUs and objects
+    get the next id after the current maximum, so a builder can be filled from FOON.txt
+    or loaded from an existing universal foon and extended with new subgraph files.
+    '''
+
+    def __init__(self):
+        self.functional_units = []  # index = FU id
+        self.object_registry = ObjectRegistry()
+        # key = object index in object_nodes,
+        # value = index of all FU where this object is an output
+        self.object_to_FU_map = {}
+        # same keys, value = index of all FU where this object is an input
+        self.object_to_consumer_map = {}
+        # same keys, value = index of all FU where this object is an input or an output
+        self.object_to_mention_map = {}
+        # key = FU.get_FU_key(), so a duplicate is found with one dict lookup
+        # instead of comparing against every FU kept so far
+        self.FU_keys = set()
+        # motions get their own vocabulary; labels, states, ingredients and containers
+        # are in the vocabulary of the object registry
+        self.motion_vocabulary = Vocabulary()
+
+    @property
+    def object_nodes(self):
+        return self.object_registry.object_nodes
+
+    @classmethod
+    def from_graph(cls, functional_units, object_nodes, object_to_FU_map,
+                   object_to_consumer_map=None, object_to_mention_map=None):
+        # wraps an already built graph; its lists and maps are extended in place,
+        # and the consumer and mention maps are derived when they are not given
+        builder = cls()
+        builder.functional_units = functional_units
+        builder.object_registry = ObjectRegistry.from_objects(object_nodes)
+        builder.object_to_FU_map = object_to_FU_map
+        if object_to_consumer_map is None or object_to_mention_map is None:
+            object_to_consumer_map, object_to_mention_map = get_FU_indexes(functional_units)
+        builder.object_to_consumer_map = object_to_consumer_map
+        builder.object_to_mention_map = object_to_mention_map
+        builder.FU_keys = set(FU.get_FU_key() for FU in functional_units)
+        for FU in functional_units:
+            builder._set_motion(FU)
+        return builder
+
+    @classmethod
+    def load(cls, filepath='FOON.pkl'):
+        return cls.from_graph(*read_graph(filepath, with_indexes=True))
+
+    def add_FU(self, FU, FU_key=None, node_keys=None):
+        """
+            parameters: a parsed FU,
+                        optionally its FU key and the object keys of its input and output
+                        nodes (in node order) when they were already computed
+            returns: the id given to the FU, or None if it is a duplicate
+        """
         # checking duplicate functional unit
-        if not FU.check_if_FU_exist(functional_units):
-            FU.id = fu_id  # set the id according to its index
-            functional_units.append(FU)
-            fu_id += 1
-
-    # save universal foon in a pickle file
-    object_nodes = []
-    object_id = 0
-    for FU in functional_units:
-        for _input in FU.input_nodes:
-            # avoid adding duplicate objects
-            existing_object_id = _input.check_object_exist(object_nodes)
-
-            # if the object exists, assign the existing object id
-            # if it does not, give it a new id
-            if existing_object_id == -1:  # object is not found
-                _input.id = object_id
-                object_nodes.append(_input)
-                object_id += 1
-            else:
-                _input.id = existing_object_id
+        if FU_key is None:
+            FU_key = FU.get_FU_key()
+        if FU_key in self.FU_keys:
+            return None
+        self.FU_keys.add(FU_key)
+
+        FU.id = len(self.functional_units)  # set the id according to its index
+        self.functional_units.append(FU)
+        self._set_motion(FU)
+
+        # avoid adding duplicate objects: the registry gives an existing object its id
+        # and a new object the next id
+        if node_keys is None:
+            node_keys = [None] * (len(FU.input_nodes) + len(FU.output_nodes))
+        for _input, key in zip(FU.input_nodes, node_keys):
+            self.object_registry.intern(_input, key)
+
+        for _output, key in zip(FU.output_nodes, node_keys[len(FU.input_nodes):]):
+            self.object_registry.intern(_output, key)
+
+        # FUs share the registered instance of an object instead of each holding a copy
+        FU.input_nodes = [self.object_registry.get_shared_node(_input) for _input in FU.input_nodes]
+        FU.output_nodes = [self.object_registry.get_shared_node(_output) for _output in FU.output_nodes]
 
         for _output in FU.output_nodes:
-            existing_object_id = _output.check_object_exist(object_nodes)
+            # ignore object that has no state like "knife"
+            if len(_output.states) == 0 and len(
+                    _output.ingredients) == 0 and _output.container == None:
+                continue
 
-            if existing_object_id == -1:  # object is not found
-                _output.id = object_id
-                object_nodes.append(_output)
-                object_id += 1
+            if _output.id not in self.object_to_FU_map:
+                self.object_to_FU_map[_output.id] = []
+            self.object_to_FU_map[_output.id].append(FU.id)
+
+        _add_FU_to_indexes(FU, self.object_to_consumer_map, self.object_to_mention_map)
+        return FU.id
+
+    def _set_motion(self, FU):
+        FU.motion_id = self.motion_vocabulary.add(FU.motion_node)
+        FU.motion_node = self.motion_vocabulary.get_string(FU.motion_id)
+
+    def add_file(self, foon_file):
+        """
+            parameters: path of a FOON text file
+            returns: number of new FU
+        """
+        # FUs are deduplicated as they are parsed, so the raw FU list is never held in memory
+        added = 0
+        for FU in iter_FU_list(foon_file):
+            if self.add_FU(FU) is not None:
+                added += 1
+        return added
+
+    def add_files_parallel(self, foon_files, num_workers=None):
+        """
+            parameters: a list of paths of FOON text files,
+                        number of worker processes (default: number of CPUs)
+            returns: number of new FU
+        """
+        # each file is split into shards on '//' lines; shards are parsed and deduplicated
+        # in worker processes, then added here in file and shard order, which gives the same
+        # ids as calling add_file on every file in turn
+        num_workers = num_workers or os.cpu_count() or 1
+        if num_workers == 1:
+            # nothing to gain from a pool, and sending shards between processes has a cost
+            return sum(self.add_file(foon_file) for foon_file in foon_files)
+
+        shards = []
+        for foon_file in foon_files:
+            shards.extend(split_FOON_file(foon_file, num_workers * SHARDS_PER_WORKER))
+
+        added = 0
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for FU_records in executor.map(parse_FOON_shard, shards):
+                for FU_key, node_keys, motion, num_inputs, node_fields in FU_records:
+                    # a duplicate of an earlier shard is dropped before any object is built
+                    if FU_key in self.FU_keys:
+                        continue
+                    FU = _make_FU(motion, num_inputs, node_fields)
+                    self.add_FU(FU, FU_key, node_keys)
+                    added += 1
+        return added
+
+    def save(self, output_file='FOON.pkl', sources=None, extra_files=()):
+        """
+            parameters: path of the universal foon to write; a '.bin' file is written in the
+                        compact format of FOON_store, anything else as a pickle,
+                        the FOON text files the graph was built from, in order, and other
+                        files the cache should depend on; when sources is given, a build
+                        record with their content hash is written next to the graph
+        """
+        # the graph is written to a temporary file next to it and then moved over it, so a crash or
+        # a concurrent load_graph never sees a half written graph
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        temp_fd, temp_file = tempfile.mkstemp(dir=output_dir, prefix=os.path.basename(output_file) + '.', suffix='.tmp')
+        os.close(temp_fd)
+        # mkstemp makes the file private; the graph keeps the mode it had, or the usual one
+        os.chmod(temp_file, os.stat(output_file).st_mode if os.path.exists(output_file) else 0o644)
+        try:
+            if output_file.endswith('.bin'):
+                write_compact_foon(self.functional_units, self.object_nodes, self.object_to_FU_map, temp_file)
             else:
-                _output.id = existing_object_id
+                with open(temp_file, "wb") as F:
+                    pickle_data = {
+                        "functional_units": self.functional_units,
+                        "object_nodes": self.object_nodes,
+                        "object_to_FU_map": self.object_to_FU_map,
+                        "object_to_consumer_map": self.object_to_consumer_map,
+                        "object_to_mention_map": self.object_to_mention_map
+                    }
+                    pickle.dump(pickle_data, F)
+
+            # the old record no longer describes the file, whether or not a new one is written;
+            # a graph without a record is read as it is, never rebuilt over
+            if os.path.exists(output_file + BUILD_RECORD_SUFFIX):
+                os.remove(output_file + BUILD_RECORD_SUFFIX)
+            os.replace(temp_file, output_file)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+        if sources is not None:
+            write_build_record(output_file, sources, extra_files)
+        print('-- universal foon saved to', output_file)
+
+
+def get_FU_indexes(functional_units):
+    """
+        parameters: a list of functional units (index = FU id)
+        returns: object_to_consumer_map (dict), object_to_mention_map (dict):
+                 key = object id, value = index of all FU where the object is an input /
+                 an input or an output, in increasing order
+    """
+    object_to_consumer_map = {}
+    object_to_mention_map = {}
+    for FU in functional_units:
+        _add_FU_to_indexes(FU, object_to_consumer_map, object_to_mention_map)
+    return object_to_consumer_map, object_to_mention_map
 
-    object_to_FU_map = {}
 
-    # create a mapping between output node to functional units
-    # in this map, key = object index in object_nodes,
-    # value = index of all FU where this object is an output
-    for FU_index, FU in enumerate(functional_units):
-        for _output in FU.output_nodes:
+def _add_FU_to_indexes(FU, object_to_consumer_map, object_to_mention_map):
+    # an object listed twice in the same FU is indexed once
+    input_ids = set()
+    for _input in FU.input_nodes:
+        if _input.id not in input_ids:
+            input_ids.add(_input.id)
+            object_to_consumer_map.setdefault(_input.id, []).append(FU.id)
+            object_to_mention_map.setdefault(_input.id, []).append(FU.id)
 
-            # ignore object that has no state like "knife"
-            if len(_output.states) == 0 and len(
-                    _output.ingredients) == 0 and _output.container == None:
-                continue
+    output_ids = set()
+    for _output in FU.output_nodes:
+        if _output.id not in input_ids and _output.id not in output_ids:
+            output_ids.add(_output.id)
+            object_to_mention_map.setdefault(_output.id, []).append(FU.id)
+
+
+def create_graph(foon_file='FOON.txt', output_file='FOON.pkl', extra_files=()):
+    """
+        parameters: path of a FOON text file,
+                    path of the universal foon to write; a '.bin' file is written in the
+                    compact format of FOON_store, anything else as a pickle,
+                    other files (e.g. motion.txt, utensils.txt) whose content is recorded
+                    in the build record together with the FOON file
+    """
+    builder = FOONBuilder()
+    builder.add_file(foon_file)
+    builder.save(output_file, [foon_file], extra_files)
+
+    print('-- total functional unit:', len(builder.functional_units))
+
+
+def create_graph_parallel(foon_path='FOON.txt', output_file='FOON.pkl', num_workers=None):
+    """
+        parameters: path of a FOON text file, or of a directory of FOON text files
+                    (read in sorted name order),
+                    path of the universal foon to write,
+                    number of worker processes (default: number of CPUs)
+        returns: nothing, ids are the same as create_graph on the same files
+    """
+    if os.path.isdir(foon_path):
+        foon_files = [os.path.join(foon_path, name) for name in sorted(os.listdir(foon_path))
+                      if name.endswith('.txt')]
+    else:
+        foon_files = [foon_path]
+
+    builder = FOONBuilder()
+    builder.add_files_parallel(foon_files, num_workers)
+    builder.save(output_file, foon_files)
+
+    print('-- total functional unit:', len(builder.functional_units))
 
-            object_index = _output.id
-            if object_index not in object_to_FU_map:
-                object_to_FU_map[object_index] = []
-            object_to_FU_map[object_index].append(FU_index)
 
-    F = open('FOON.pkl', "wb")
-    pickle_data = {
-        "functional_units": functional_units,
-        "object_nodes": object_nodes,
-        "object_to_FU_map": object_to_FU_map
+def append_to_graph(foon_files, graph_file='FOON.pkl', output_file=None):
+    """
+        parameters: a list of paths of new FOON text files (subgraphs),
+                    path of the existing universal foon,
+                    path to write the extended universal foon to (default: graph_file)
+        returns: number of new FU; a graph without a build record is refused (ValueError),
+                 since the extended graph could not be rebuilt from any recorded sources
+    """
+    build_record = read_build_record(graph_file)
+    if build_record is None:
+        raise ValueError(graph_file + ' has no build record; build it with create_graph before appending to it')
+    builder = FOONBuilder.load(graph_file)
+
+    added = 0
+    for foon_file in foon_files:
+        added += builder.add_file(foon_file)
+
+    # the extended graph is cached on the old sources plus the new files
+    builder.save(output_file or graph_file, build_record["sources"] + list(foon_files), build_record["extra_files"])
+
+    print('-- new functional unit:', added)
+    print('-- total functional unit:', len(builder.functional_units))
+    return added
+
+
+# -----------------------------------------------------------------------------------------------------------------------------#
+
+# Build cache: a graph written with its sources gets a build record next to it (FOON.pkl.build.json)
+# holding a content hash of those sources. load_graph rebuilds the graph only when the hash of the
+# sources on disk no longer matches, so an unchanged FOON.txt is never parsed again. A graph without a
+# record is never rebuilt: it may hold functional units that are in no FOON text file.
+
+BUILD_RECORD_SUFFIX = '.build.json'
+GRAPH_BUILD_VERSION = 3  # part of every hash; bump it when the build gives a different graph for the same input
+
+
+def read_graph(filepath='FOON.pkl', with_indexes=False):
+    """
+        parameters: path of universal foon (pickle file or compact FOON_store file),
+                    whether to also return the consumer and mention maps
+        returns: functional_units (list), object_nodes (list), object_to_FU_map (dict),
+                 and with_indexes: object_to_consumer_map (dict), object_to_mention_map (dict),
+                 derived from the FU when the file does not hold them
+    """
+    if is_compact_foon(filepath):
+        graph = read_compact_foon(filepath)
+        object_to_consumer_map = object_to_mention_map = None
+    else:
+        with open(filepath, 'rb') as F:
+            pickle_data = pickle.load(F)
+        graph = pickle_data["functional_units"], pickle_data["object_nodes"], pickle_data["object_to_FU_map"]
+        object_to_consumer_map = pickle_data.get("object_to_consumer_map")
+        object_to_mention_map = pickle_data.get("object_to_mention_map")
+
+    if not with_indexes:
+        return graph
+    if object_to_consumer_map is None or object_to_mention_map is None:
+        object_to_consumer_map, object_to_mention_map = get_FU_indexes(graph[0])
+    return graph + (object_to_consumer_map, object_to_mention_map)
+
+
+def load_graph(graph_file='FOON.pkl', foon_files=None, extra_files=None, with_indexes=False):
+    """
+        parameters: path of universal foon,
+                    the FOON text files it is built from (default: the sources in its build
+                    record, or FOON.txt next to it),
+                    other files the cache depends on (default: those in its build record),
+                    whether to also return the consumer and mention maps
+        returns: functional_units (list), object_nodes (list), object_to_FU_map (dict),
+                 and with_indexes: object_to_consumer_map (dict), object_to_mention_map (dict),
+                 rebuilding graph_file first if its sources changed since it was built; a graph
+                 without a build record (e.g. saved without sources) is read as it is, since
+                 nothing tells what it was built from
+    """
+    build_record = read_build_record(graph_file)
+    if build_record is None and os.path.exists(graph_file):
+        return read_graph(graph_file, with_indexes)
+    if foon_files is None:
+        if build_record is not None:
+            foon_files = build_record["sources"]
+        else:
+            foon_files = [os.path.join(os.path.dirname(graph_file), 'FOON.txt')]
+    if extra_files is None:
+        extra_files = build_record["extra_files"] if build_record is not None else []
+
+    # nothing to check against, e.g. a graph shipped without its FOON text
+    if not all(os.path.exists(path) for path in list(foon_files) + list(extra_files)):
+        return read_graph(graph_file, with_indexes)
+
+    if build_record is None or not os.path.exists(graph_file) or \
+            build_record["source_hash"] != get_source_hash(foon_files, extra_files):
+        # no graph yet, or a graph whose recorded sources changed
+        print('-- sources of', graph_file, 'changed, rebuilding it')
+        builder = FOONBuilder()
+        for foon_file in foon_files:
+            builder.add_file(foon_file)
+        builder.save(graph_file, foon_files, extra_files)
+        graph = builder.functional_units, builder.object_nodes, builder.object_to_FU_map
+        if with_indexes:
+            graph += (builder.object_to_consumer_map, builder.object_to_mention_map)
+        return graph
+
+    return read_graph(graph_file, with_indexes)
+
+
+def get_source_hash(foon_files, extra_files=()):
+    """
+        parameters: the FOON text files of a graph (in order), other files to depend on
+        returns: a sha256 hex digest of the build version and the content of all the files
+    """
+    sha = hashlib.sha256(b'universal foon build %d' % GRAPH_BUILD_VERSION)
+    for group in (foon_files, extra_files):
+        sha.update(b'%d files' % len(group))
+        for path in group:
+            with open(path, 'rb') as source:
+                content = source.read()
+            sha.update(b'%d:' % len(content))
+            sha.update(content)
+    return sha.hexdigest()
+
+
+def read_build_record(graph_file):
+    """
+        parameters: path of universal foon
+        returns: its build record (source_hash, sources, extra_files), with paths made relative
+                 to the working directory, or None if the graph has no record
+    """
+    try:
+        with open(graph_file + BUILD_RECORD_SUFFIX, 'r') as record_file:
+            build_record = json.load(record_file)
+    except (OSError, ValueError):
+        return None
+
+    graph_dir = os.path.dirname(graph_file)
+    for name in ("sources", "extra_files"):
+        build_record[name] = [os.path.join(graph_dir, path) for path in build_record[name]]
+    return build_record
+
+
+def write_build_record(graph_file, sources, extra_files=()):
+    # paths are stored relative to the graph, so the graph and its sources can be moved together
+    graph_dir = os.path.dirname(os.path.abspath(graph_file))
+    build_record = {
+        "source_hash": get_source_hash(sources, extra_files),
+        "sources": [os.path.relpath(os.path.abspath(path), graph_dir) for path in sources],
+        "extra_files": [os.path.relpath(os.path.abspath(path), graph_dir) for path in extra_files],
     }
-    pickle.dump(pickle_data, F)
-    F.close()
-    print('-- universal foon saved to FOON.pkl')
+    with open(graph_file + BUILD_RECORD_SUFFIX, 'w') as record_file:
+        json.dump(build_record, record_file, indent=4)
+
+# -----------------------------------------------------------------------------------------------------------------------------#
 
-    print('-- total functional unit:', len(functional_units))
+SHARDS_PER_WORKER = 4  # more shards than workers keeps every worker busy when shards differ in size
+
+
+def split_FOON_file(filepath, num_shards):
+    """
+        parameters: path of a FOON text file, wanted number of shards
+        returns: a list of (filepath, start, end) byte ranges; every range but the
+                 last one ends right after a '//' line
+    """
+    size = os.path.getsize(filepath)
+    boundaries = [0]
+    with open(filepath, 'rb') as foon_file:
+        for shard in range(1, num_shards):
+            target = size * shard // num_shards
+            if target <= boundaries[-1]:
+                continue
+            foon_file.seek(target)
+            foon_file.readline()  # skip the rest of the line the target falls in
+            for line in foon_file:
+                if line.startswith(b'//'):
+                    break
+            boundary = foon_file.tell()
+            if boundaries[-1] < boundary < size:
+                boundaries.append(boundary)
+    boundaries.append(size)
+
+    return [(filepath, start, end) for start, end in zip(boundaries, boundaries[1:])]
+
+
+def parse_FOON_shard(shard):
+    """
+        parameters: a (filepath, start, end) byte range from split_FOON_file
+        returns: the FU of the shard in order, without duplicates within the shard, as
+                 (FU key, object keys of its nodes, motion, number of input nodes, node fields)
+                 records of plain tuples, which are much cheaper to send back to the parent
+                 process than Object instances; the keys are sent so that the merge does not
+                 compute them again
+    """
+    filepath, start, end = shard
+    with open(filepath, 'rb') as foon_file:
+        foon_file.seek(start)
+        chunk = foon_file.read(end - start)
+    # read as iter_FU_list reads the file in text mode, with universal newlines, so that a '\r\n'
+    # or a '\x0c' gives the same fields in both builds
+    lines = io.TextIOWrapper(io.BytesIO(chunk), encoding='utf-8', newline=None)
+
+    FU_records = []
+    FU_keys = set()
+    for FU in parse_FU_lines(lines):
+        FU_key = FU.get_FU_key()
+        if FU_key not in FU_keys:
+            FU_keys.add(FU_key)
+            nodes = FU.input_nodes + FU.output_nodes
+            node_fields = [(node.label, tuple(node.states), tuple(node.ingredients), node.container,
+                            node.object_in_motion, node.recipe_category)
+                           for node in nodes]
+            FU_records.append((FU_key, [node.get_object_key() for node in nodes], FU.motion_node,
+                               len(FU.input_nodes), node_fields))
+    return FU_records
+
+
+def _make_FU(motion, num_inputs, node_fields):
+    # rebuilds a parsed FU from a parse_FOON_shard record
+    nodes = []
+    for label, states, ingredients, container, object_in_motion, recipe_category in node_fields:
+        node = Object(label)
+        node.states = list(states)
+        node.ingredients = list(ingredients)
+        node.container = container
+        node.object_in_motion = object_in_motion
+        node.recipe_category = recipe_category
+        nodes.append(node)
+
+    FU = FunctionalUnit()
+    FU.input_nodes = nodes[:num_inputs]
+    FU.output_nodes = nodes[num_inputs:]
+    FU.motion_node = motion
+    return FU
@@ -1,90 +1,381 @@
-import pickle
 import json
-import random
 import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from FOON_class import Object
+from FOON_index import AttributeIndex, KitchenIndex, ReachabilityIndex, compile_kitchen
+from preprocess import load_graph
 
-# Checks if an ingredient exists in the kitchen
+# Checks if an ingredient exists in the kitchen (a list of kitchen items or a KitchenIndex)
 def check_if_exist_in_kitchen(kitchen_items, ingredient):
-    for item in kitchen_items:
-        if item["label"] == ingredient.label \
-                and sorted(item["states"]) == sorted(ingredient.states) \
-                and sorted(item["ingredients"]) == sorted(ingredient.ingredients) \
-                and item["container"] == ingredient.container:
+    return compile_kitchen(kitchen_items).contains(ingredient)
+
+# Wins (successes of the simulated executions) and trials (number of times simulated) of every
+# functional unit, in arrays indexed by FU id, with the trials of all units together. The counts
+# are floats, so that statistics seeded from an MCTSStatisticsStore can hold decayed counts.
+class MCTSStatistics:
+    def __init__(self, num_units):
+        self.wins = np.zeros(num_units, dtype=np.float64)
+        self.trials = np.zeros(num_units, dtype=np.float64)
+        self.total_trials = 0
+
+    def copy(self):
+        statistics = MCTSStatistics(0)
+        statistics.wins, statistics.trials = self.wins.copy(), self.trials.copy()
+        statistics.total_trials = self.total_trials
+        return statistics
+
+    # Adds the wins and trials of another MCTSStatistics over the same graph (e.g. of a worker),
+    # times weight (-1 takes them away)
+    def merge(self, other, weight=1):
+        self.wins += weight * other.wins
+        self.trials += weight * other.trials
+        self.total_trials += weight * other.total_trials
+
+# What the searches learned about every functional unit (index = FU id), kept between searches:
+# the successes and number of simulated executions of each unit. A search given the store starts
+# from these counts instead of from nothing (see get_statistics), and adds what it simulated when
+# it ends (see add). Before each addition, the stored counts are multiplied by decay, so that old
+# searches weigh less and less (decay=1 keeps everything).
+# With filepath, the store starts from the snapshot in that file (if there is one, and it was saved
+# for the same graph_key and number of units) and save() writes the snapshot back.
+class MCTSStatisticsStore:
+    def __init__(self, num_units, decay=1.0, filepath=None, graph_key=None):
+        self.decay = decay
+        self.filepath = filepath
+        self.graph_key = graph_key
+        self.successes = np.zeros(num_units, dtype=np.float64)
+        self.executions = np.zeros(num_units, dtype=np.float64)
+        self.searches = 0
+
+        if filepath is not None and os.path.exists(filepath):
+            with np.load(filepath) as snapshot:
+                if str(snapshot["graph_key"]) == str(graph_key) and len(snapshot["successes"]) == num_units:
+                    self.successes = snapshot["successes"]
+                    self.executions = snapshot["executions"]
+                    self.searches = int(snapshot["searches"])
+
+    # Statistics for a search simulating `iterations` executions per trial: the stored executions of
+    # a unit count as executions / iterations trials, so the success ratio of a unit stays in the
+    # scale of the search whatever the number of iterations of the searches it was learned from
+    def get_statistics(self, iterations):
+        statistics = MCTSStatistics(0)
+        statistics.wins = self.successes.copy()
+        statistics.trials = self.executions / iterations
+        statistics.total_trials = float(statistics.trials.sum())
+        return statistics
+
+    # Adds the statistics of a search of `iterations` executions per trial; seed is the statistics
+    # it started from (from get_statistics), which are already in the store
+    def add(self, statistics, iterations, seed=None):
+        new_successes = statistics.wins
+        new_executions = statistics.trials * iterations
+        if seed is not None:
+            new_successes = new_successes - seed.wins
+            new_executions = new_executions - seed.trials * iterations
+        # the subtraction can leave a rounding error below zero
+        self.successes = np.maximum(self.successes * self.decay + new_successes, 0)
+        self.executions = np.maximum(self.executions * self.decay + new_executions, 0)
+        self.searches += 1
+
+    def save(self, filepath=None):
+        filepath = filepath or self.filepath
+        with open(filepath, 'wb') as snapshot:
+            np.savez(snapshot, successes=self.successes, executions=self.executions, searches=self.searches,
+                     graph_key=str(self.graph_key))
+
+# Budget of a search: a deadline (time_limit seconds from now) and a number of simulated executions
+# (max_rollouts); None is no limit. Once a simulation would go past either, the budget is spent.
+class MCTSBudget:
+    def __init__(self, time_limit=None, max_rollouts=None):
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+        self.max_rollouts = max_rollouts
+        self.rollouts = 0
+        self.spent = False
+
+    # Takes `rollouts` executions from the budget; returns False, and spends the budget, if they do
+    # not fit in it or the deadline has passed
+    def take(self, rollouts):
+        if not self.spent:
+            if (self.max_rollouts is not None and self.rollouts + rollouts > self.max_rollouts) or \
+                    (self.deadline is not None and time.perf_counter() >= self.deadline):
+                self.spent = True
+            else:
+                self.rollouts += rollouts
+        return not self.spent
+
+# Ids of the inputs of a unit that MCTS searches: all of them, utensils and inputs the unit passes
+# through included. A ReachabilityIndex for MCTS is built with this rule (get_inputs), so every object
+# it calls makeable has a task tree of units whose inputs MCTS can all find.
+def get_unit_inputs(FU):
+    return [input_node.id for input_node in FU.input_nodes]
+
+# One descent of MCTS from the goal node: at every object not in the kitchen, all candidate units
+# are simulated and the one with the best UCB1 score is chosen, then its inputs are searched.
+# The wins and trials are added to statistics; returns the indices of the chosen units.
+# With an MCTSBudget, every simulation is taken from it; once it is spent, the rest of the tree is
+# completed without simulating, each object taking the unit that first made it reachable
+# (ReachabilityIndex.first_units, which always ends in the kitchen) or else its first candidate.
+def run_MCTS_pass(kitchen, goal, obj_nodes, func_units, obj_to_unit_map, iterations, reachable, unit_probabilities,
+                  rng, statistics, budget=None):
+    unit_wins, unit_trials = statistics.wins, statistics.trials
+    # List to store the sequence of units during the search
+    selected_units = []
+    visited = set()  # Track visited nodes to prevent re-exploring
+
+    # Function to simulate task tree search starting from the goal node
+    def simulate_task_tree(node):
+        # If the node exists in the kitchen, return success
+        if kitchen.contains(node):
             return True
-    return False
+
+        # If the node has already been visited, skip to prevent cycles
+        if node.id in visited:
+            return False
+
+        visited.add(node.id)  # Mark the node as visited
+
+        # Retrieve the functional units that produce the node
+        available_units = obj_to_unit_map[node.id]
+        if reachable is not None:
+            available_units = reachable.get_candidates(available_units)
+        optimal_unit = None
+
+        # Out of budget: complete the tree without simulating
+        if available_units and budget is not None and not budget.take(len(available_units) * iterations):
+            if reachable is not None and reachable.first_units[node.id] != -1:
+                optimal_unit = reachable.first_units[node.id]
+            else:
+                optimal_unit = available_units[0]
+
+        # Simulate every functional unit at once and select the best one
+        elif available_units:
+            candidates = np.asarray(available_units)
+
+            # successes out of `iterations` executions of each unit, and one more trial for each
+            np.add.at(unit_wins, candidates, rng.binomial(iterations, unit_probabilities[candidates]))
+            np.add.at(unit_trials, candidates, 1)
+
+            # UCB1 score of each unit; a unit is scored with the trials counted up to it as the
+            # total, as when the units were simulated one after the other
+            totals = statistics.total_trials + np.arange(1, len(candidates) + 1)
+            statistics.total_trials += len(candidates)
+            success_ratios = unit_wins[candidates] / unit_trials[candidates]
+            exploration_bonuses = np.sqrt(2 * np.log(totals) / unit_trials[candidates])
+            ucb1_scores = success_ratios + exploration_bonuses
+
+            # the first unit with the highest score
+            optimal_unit = available_units[int(np.argmax(ucb1_scores))]
+
+        # Add the optimal unit to the task tree
+        if optimal_unit is not None:
+            selected_units.append(optimal_unit)
+            for input_id in get_unit_inputs(func_units[optimal_unit]):
+                simulate_task_tree(obj_nodes[input_id])  # Recurse for the input nodes
+
+    simulate_task_tree(goal)
+    return selected_units
+
+# Final task tree from gathered statistics, without simulating: at every object not in the kitchen,
+# the simulated candidate unit with the highest success ratio (wins / trials) is chosen, in the same
+# order as run_MCTS_pass; an object none of whose units was simulated is left out.
+def select_task_tree(kitchen, goal, obj_nodes, func_units, obj_to_unit_map, statistics, reachable=None):
+    selected_units = []
+    visited = set()
+    stack = [goal]
+    while stack:
+        node = stack.pop()
+        if kitchen.contains(node) or node.id in visited:
+            continue
+        visited.add(node.id)
+
+        available_units = obj_to_unit_map[node.id]
+        if reachable is not None:
+            available_units = reachable.get_candidates(available_units)
+        candidates = np.asarray(available_units, dtype=np.int64)
+        candidates = candidates[statistics.trials[candidates] > 0]
+        if len(candidates) == 0:
+            continue
+
+        success_ratios = statistics.wins[candidates] / statistics.trials[candidates]
+        optimal_unit = int(candidates[np.argmax(success_ratios)])
+        selected_units.append(optimal_unit)
+        # inputs are pushed in reverse, so they are searched in order as by the recursion
+        for input_id in reversed(get_unit_inputs(func_units[optimal_unit])):
+            stack.append(obj_nodes[input_id])
+    return selected_units
 
 # Monte Carlo Tree Search (MCTS) implementation
-def search_MCTS(kitchen_items, target_node, obj_nodes=[], func_units=[], obj_to_unit_map=[], iterations=1000):
+# With a ReachabilityIndex of the kitchen (reachable), only the units that can run are simulated,
+# and a goal that cannot be made gives an empty task tree without any simulation.
+# The rollouts of all candidate units of a node are drawn in one NumPy call: the number of successes
+# of a unit in `iterations` executions is binomial, with the unit's success probability from
+# unit_probabilities (see get_unit_success_probabilities, loaded from motion.txt if not given).
+# rng is a numpy.random.Generator, or a seed for one, to make a search repeatable.
+# With an MCTSStatisticsStore (store), the search starts from the statistics of the earlier searches
+# and adds its own to the store.
+# Given a budget (time_limit in seconds, max_rollouts simulated executions), the search keeps running
+# descents until the budget is spent, and returns the task tree of the descent with the highest
+# estimated success probability (see get_success_bounds). The budget is checked before every
+# simulation and never exceeded by rollouts; the descent that spends it completes its tree without
+# simulating (see run_MCTS_pass), so only that walk can run past time_limit. stats, if given, is filled with the
+# estimated success probability of the task tree ("success_probability"), the probability it is above
+# with 95% confidence ("success_lower_bound"), and the descents and rollouts run ("descents", "rollouts").
+def search_MCTS(kitchen_items, target_node, obj_nodes=[], func_units=[], obj_to_unit_map=[], iterations=1000, reachable=None,
+                unit_probabilities=None, rng=None, store=None, time_limit=None, max_rollouts=None, stats=None):
     # List to store the selected task tree functional units
     task_sequence = []
 
-    # A dictionary to store the success counts (wins) and number of attempts (trials) for each FU
-    unit_stats = {idx: {"wins": 0, "trials": 0} for idx in range(len(func_units))}
+    # Compile the kitchen once, so the check in every recursion is a lookup
+    kitchen = compile_kitchen(kitchen_items)
+    if reachable is not None and not reachable.is_makeable(target_node):
+        return task_sequence
 
-    # Load the motion success probabilities from motion.txt
-    motion_probs = get_motion_success_rates("motion.txt")
+    # The success counts (wins) and number of attempts (trials) of each FU (index = FU id), and the
+    # trials of all FUs together, kept up to date so UCB1 does not sum over the whole graph
+    if store is None:
+        statistics = MCTSStatistics(len(func_units))
+    else:
+        seed_statistics = store.get_statistics(iterations)
+        statistics = seed_statistics.copy()
 
-    # Perform the MCTS search for a given goal node
-    def perform_mcts(goal):
-        # List to store the sequence of units during the search
-        selected_units = []
-        visited = set()  # Track visited nodes to prevent re-exploring
+    # Success probability of every FU, from the motion success probabilities of motion.txt
+    if unit_probabilities is None:
+        unit_probabilities = get_unit_success_probabilities(func_units, get_motion_success_rates("motion.txt"))
+    rng = np.random.default_rng(rng)
 
-        # Function to simulate task tree search starting from the goal node
-        def simulate_task_tree(node):
-            # If the node exists in the kitchen, return success
-            if check_if_exist_in_kitchen(kitchen_items, node):
-                return True
+    # Run MCTS for the target node, once or until the budget is spent
+    budget = None
+    if time_limit is not None or max_rollouts is not None:
+        budget = MCTSBudget(time_limit, max_rollouts)
+    start_trials = statistics.total_trials
+    task_tree_indices = None
+    best_probability = -1.0
+    num_descents = 0
+    while True:
+        descent_trials = statistics.total_trials
+        descent_indices = run_MCTS_pass(kitchen, target_node, obj_nodes, func_units, obj_to_unit_map, iterations,
+                                        reachable, unit_probabilities, rng, statistics, budget)
+        num_descents += 1
+        num_rollouts = (statistics.total_trials - start_trials) * iterations
+        if budget is None:
+            task_tree_indices = descent_indices
+            break
 
-            # If the node has already been visited, skip to prevent cycles
-            if node.id in visited:
-                return False
+        # the best tree so far is scored again, with what this descent learned
+        if task_tree_indices is not None:
+            best_probability = get_success_bounds(task_tree_indices, statistics, iterations)[0]
+        probability = get_success_bounds(descent_indices, statistics, iterations)[0]
+        if probability > best_probability:
+            task_tree_indices, best_probability = descent_indices, probability
 
-            visited.add(node.id)  # Mark the node as visited
+        # a descent without any simulation (e.g. a goal in the kitchen) would be the same again
+        if budget.spent or statistics.total_trials == descent_trials:
+            break
 
-            # Retrieve the functional units that produce the node
-            available_units = obj_to_unit_map[node.id]
-            optimal_unit = None
-            optimal_score = -float('inf')
+    if stats is not None:
+        stats["success_probability"], stats["success_lower_bound"] = get_success_bounds(task_tree_indices, statistics,
+                                                                                        iterations)
+        stats["descents"] = num_descents
+        stats["rollouts"] = int(num_rollouts)
+    if store is not None:
+        store.add(statistics, iterations, seed_statistics)
 
-            # Simulate each functional unit and select the best one
-            for idx in available_units:
-                unit_stats[idx]["trials"] += 1  # Increment the count of trials for this unit
-                unit_successes = 0
+    # Convert indices to functional units
+    task_sequence = [func_units[index] for index in task_tree_indices]
+    return task_sequence
 
-                # Run multiple simulations for each unit
-                for _ in range(iterations):
-                    if simulate_unit_execution(func_units[idx], motion_probs):
-                        unit_successes += 1
+# Estimated success probability of a task tree (FU indices), the product of the success ratios of its
+# units, and a probability it is above with the given confidence: each unit's ratio, over all its
+# simulated executions, is lowered by the Hoeffding bound, with the confidence shared between units.
+# A unit never simulated (taken when the budget was spent) is estimated at 0.5, like a motion missing
+# from motion.txt, and bounded below by 0.
+def get_success_bounds(unit_indices, statistics, iterations, confidence=0.95):
+    units = np.unique(np.asarray(unit_indices, dtype=np.int64))
+    if len(units) == 0:
+        return 1.0, 1.0
+    executions = statistics.trials[units] * iterations
+    simulated = executions > 0
+    success_ratios = np.full(len(units), 0.5)
+    success_ratios[simulated] = statistics.wins[units][simulated] / executions[simulated]
+    lower_ratios = np.zeros(len(units))
+    margins = np.sqrt(math.log(len(units) / (1 - confidence)) / (2 * executions[simulated]))
+    lower_ratios[simulated] = np.clip(success_ratios[simulated] - margins, 0, 1)
+    return float(np.prod(success_ratios)), float(np.prod(lower_ratios))
 
-                # Update the success count for the functional unit
-                unit_stats[idx]["wins"] += unit_successes
+# Graph of the MCTS worker processes, set once per process by init_MCTS_worker
+_worker_graph = None
 
-                # Calculate UCB1 score
-                total_trials = sum([unit_stats[unit]["trials"] for unit in unit_stats])
-                success_ratio = unit_stats[idx]["wins"] / unit_stats[idx]["trials"]
-                exploration_bonus = math.sqrt(2 * math.log(total_trials) / unit_stats[idx]["trials"])
-                ucb1_score = success_ratio + exploration_bonus
+def init_MCTS_worker(kitchen, obj_nodes, func_units, obj_to_unit_map, reachable, unit_probabilities):
+    global _worker_graph
+    _worker_graph = (kitchen, obj_nodes, func_units, obj_to_unit_map, reachable, unit_probabilities)
 
-                # Update the best unit based on the highest score
-                if ucb1_score > optimal_score:
-                    optimal_score = ucb1_score
-                    optimal_unit = idx
+# One root-parallel worker: `passes` descents from the goal with its own random stream, starting
+# from seed_statistics if given; returns the wins and trials it gathered (without seed_statistics)
+def run_MCTS_worker(target_id, iterations, passes, seed_sequence, seed_statistics=None):
+    kitchen, obj_nodes, func_units, obj_to_unit_map, reachable, unit_probabilities = _worker_graph
+    if seed_statistics is None:
+        statistics = MCTSStatistics(len(func_units))
+    else:
+        statistics = seed_statistics.copy()
+    rng = np.random.default_rng(seed_sequence)
+    for _ in range(passes):
+        run_MCTS_pass(kitchen, obj_nodes[target_id], obj_nodes, func_units, obj_to_unit_map, iterations, reachable,
+                      unit_probabilities, rng, statistics)
+    if seed_statistics is not None:
+        statistics.merge(seed_statistics, -1)
+    return statistics
 
-            # Add the optimal unit to the task tree
-            if optimal_unit is not None:
-                selected_units.append(optimal_unit)
-                for input_node in func_units[optimal_unit].input_nodes:
-                    simulate_task_tree(obj_nodes[input_node.id])  # Recurse for the input nodes
+# Process pool for search_MCTS_parallel. The graph is given to every worker process once, when it
+# starts (with the fork start method the pages are shared, not copied), so a search only sends the
+# goal id and a seed; a pool can be kept for many goals of the same kitchen and graph.
+def make_MCTS_executor(workers, kitchen_items, obj_nodes, func_units, obj_to_unit_map, reachable=None,
+                       unit_probabilities=None):
+    if unit_probabilities is None:
+        unit_probabilities = get_unit_success_probabilities(func_units, get_motion_success_rates("motion.txt"))
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_MCTS_worker,
+                               initargs=(compile_kitchen(kitchen_items), obj_nodes, func_units, obj_to_unit_map,
+                                         reachable, unit_probabilities))
 
-        simulate_task_tree(goal)
-        return selected_units
+# Root-parallel MCTS: `workers` independent searches, each of `passes` descents with `iterations`
+# executions per simulated unit, run in a process pool with their own random streams (spawned from
+# seed by numpy.random.SeedSequence, so a seed makes the search repeatable for any pool).
+# Their wins and trials are merged, and the task tree is selected from the merged statistics
+# (see select_task_tree). executor is a pool from make_MCTS_executor for the same kitchen and graph;
+# without one, a pool of `workers` processes is made for this search. workers defaults to the
+# number of CPUs. With an MCTSStatisticsStore (store), every worker starts from the statistics of the
+# earlier searches, and the merged statistics are added to the store.
+def search_MCTS_parallel(kitchen_items, target_node, obj_nodes=[], func_units=[], obj_to_unit_map=[], iterations=1000,
+                         workers=None, passes=1, reachable=None, unit_probabilities=None, seed=None, executor=None,
+                         store=None):
+    task_sequence = []
+    kitchen = compile_kitchen(kitchen_items)
+    if reachable is not None and not reachable.is_makeable(target_node):
+        return task_sequence
 
-    # Run MCTS for the target node
-    task_tree_indices = perform_mcts(target_node)
+    workers = workers or os.cpu_count() or 1
+    own_executor = executor is None
+    if own_executor:
+        executor = make_MCTS_executor(workers, kitchen, obj_nodes, func_units, obj_to_unit_map, reachable,
+                                      unit_probabilities)
+    seed_statistics = None if store is None else store.get_statistics(iterations)
+    try:
+        futures = [executor.submit(run_MCTS_worker, target_node.id, iterations, passes, seed_sequence, seed_statistics)
+                   for seed_sequence in np.random.SeedSequence(seed).spawn(workers)]
+        statistics = MCTSStatistics(len(func_units)) if store is None else seed_statistics.copy()
+        for future in futures:
+            statistics.merge(future.result())
+    finally:
+        if own_executor:
+            executor.shutdown()
+    if store is not None:
+        store.add(statistics, iterations, seed_statistics)
 
-    # Convert indices to functional units
+    task_tree_indices = select_task_tree(kitchen, target_node, obj_nodes, func_units, obj_to_unit_map, statistics,
+                                         reachable)
     task_sequence = [func_units[index] for index in task_tree_indices]
     return task_sequence
 
@@ -94,6 +385,11 @@ def simulate_unit_execution(FU, success_probs):
     probability = success_probs.get(motion_key, 0.5)  # Default to 50% success rate if not found
     return random.uniform(0, 1) <= probability
 
+# Success probability of every functional unit (index = FU id) as an array, from the success
+# probabilities of motions; a motion missing from them succeeds half of the time
+def get_unit_success_probabilities(func_units, success_probs):
+    return np.array([success_probs.get(FU.motion_node, 0.5) for FU in func_units], dtype=np.float64)
+
 # Load success rates from the motion.txt file
 def get_motion_success_rates(filepath):
     probabilities = {}
@@ -117,14 +413,10 @@ def save_paths_to_file(task_tree, path):
         for FU in task_tree:
             _file.write(FU.get_FU_as_text() + "\n")
 
-# Reads the FOON graph from a pickle file
+# Reads the FOON graph from a pickle file (or a compact FOON_store file),
+# rebuilding it first if FOON.txt changed since it was written
 def read_universal_foon(filepath='FOON.pkl'):
-    pickle_data = pickle.load(open(filepath, 'rb'))
-    functional_units = pickle_data["functional_units"]
-    object_nodes = pickle_data["object_nodes"]
-    object_to_FU_map = pickle_data["object_to_FU_map"]
-
-    return functional_units, object_nodes, object_to_FU_map
+    return load_graph(filepath)
 
 # Main function
 if __name__ == '__main__':
@@ -137,14 +429,24 @@ if __name__ == '__main__':
 
     kitchen_items = json.load(open('kitchen.json'))
     goal_nodes = json.load(open("goal_nodes.json"))
+    attribute_index = AttributeIndex(foon_object_nodes)
+    # the kitchen is compiled once for all goals: one array lookup per kitchen check
+    kitchen = KitchenIndex(kitchen_items, foon_object_nodes, attribute_index)
+    # what the kitchen can make, with the inputs search_MCTS searches
+    reachable = ReachabilityIndex(kitchen, foon_object_nodes, foon_functional_units, foon_object_to_FU_map,
+                                  get_inputs=get_unit_inputs)
+    # success probability of every FU, for the rollouts of all goals
+    unit_probabilities = get_unit_success_probabilities(foon_functional_units, get_motion_success_rates('motion.txt'))
+    # what the searches learn about each FU is kept for the next goals, which share many of them
+    statistics_store = MCTSStatisticsStore(len(foon_functional_units))
     
     for node in goal_nodes:
         node_object = Object(node["label"])
         node_object.states = node["states"]
         node_object.ingredients = node["ingredients"]
         node_object.container = node["container"]
-        for object in foon_object_nodes:
-            if object.check_object_equal(node_object):
-                output_task_tree = search_MCTS(kitchen_items, object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map)
-                break
+        goal_id = attribute_index.lookup(node_object)
+        if goal_id != -1:
+            output_task_tree = search_MCTS(kitchen, foon_object_nodes[goal_id], foon_object_nodes, foon_functional_units, foon_object_to_FU_map,
+                                           reachable=reachable, unit_probabilities=unit_probabilities, store=statistics_store)
 
@@ -0,0 +1,244 @@
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import pytest
+
+from FOON_class import Object
+from FOON_index import AttributeIndex, KitchenIndex, ReachabilityIndex
+from search_MCTS import MCTSStatistics, MCTSStatisticsStore, run_MCTS_pass, search_MCTS, search_MCTS_parallel, \
+    make_MCTS_executor, read_universal_foon, get_motion_success_rates, get_unit_inputs, get_unit_success_probabilities
+
+# Utility function to create a dummy object for testing
+def create_test_object(label, states, ingredients, container):
+    obj = Object(label)
+    obj.states = states
+    obj.ingredients = ingredients
+    obj.container = container
+    return obj
+
+def load_test_data():
+    """
+    Load the graph, kitchen and goal nodes, with the indexes the searches use.
+    Returns the graph (object nodes, functional units, object to FU map), the kitchen index, the
+    reachability index of the kitchen, the success probability of every FU and the goal nodes found
+    in the graph.
+    """
+    functional_units, object_nodes, object_to_FU_map = read_universal_foon('FOON.pkl')
+    with open('kitchen.json', 'r') as kitchen_file:
+        kitchen_items = json.load(kitchen_file)
+    with open('goal_nodes.json', 'r') as goal_file:
+        goal_nodes = json.load(goal_file)
+
+    attribute_index = AttributeIndex(object_nodes)
+    kitchen = KitchenIndex(kitchen_items, object_nodes, attribute_index)
+    reachable = ReachabilityIndex(kitchen, object_nodes, functional_units, object_to_FU_map, get_inputs=get_unit_inputs)
+    unit_probabilities = get_unit_success_probabilities(functional_units, get_motion_success_rates('motion.txt'))
+
+    goal_object_nodes = []
+    for goal in goal_nodes:
+        goal_object = create_test_object(goal["label"], goal["states"], goal["ingredients"], goal["container"])
+        goal_node = attribute_index.find(goal_object)
+        if goal_node is not None:
+            goal_object_nodes.append(goal_node)
+
+    graph = (object_nodes, functional_units, object_to_FU_map)
+    return graph, kitchen, reachable, unit_probabilities, goal_object_nodes
+
+def search_MCTS_per_unit(kitchen, target_node, obj_nodes, func_units, obj_to_unit_map, iterations, reachable,
+                         unit_probabilities, rng):
+    """
+    One MCTS descent the way it was written before the rollouts and statistics were vectorised: the
+    candidate units of an object are simulated one after the other, each with its own binomial draw,
+    and their wins and trials are kept in a dictionary. Returns the FU indices of the task tree.
+    """
+    rng = np.random.default_rng(rng)
+    if reachable is not None and not reachable.is_makeable(target_node):
+        return []
+    unit_stats = {idx: {"wins": 0, "trials": 0} for idx in range(len(func_units))}
+    total_trials = 0
+    selected_units = []
+    visited = set()
+
+    def simulate_task_tree(node):
+        nonlocal total_trials
+        if kitchen.contains(node) or node.id in visited:
+            return
+        visited.add(node.id)
+
+        available_units = obj_to_unit_map[node.id]
+        if reachable is not None:
+            available_units = reachable.get_candidates(available_units)
+        optimal_unit = None
+        optimal_score = -float('inf')
+        for idx in available_units:
+            unit_stats[idx]["trials"] += 1
+            unit_stats[idx]["wins"] += int(rng.binomial(iterations, unit_probabilities[idx]))
+            total_trials += 1
+            success_ratio = unit_stats[idx]["wins"] / unit_stats[idx]["trials"]
+            exploration_bonus = math.sqrt(2 * math.log(total_trials) / unit_stats[idx]["trials"])
+            if success_ratio + exploration_bonus > optimal_score:
+                optimal_score = success_ratio + exploration_bonus
+                optimal_unit = idx
+
+        if optimal_unit is not None:
+            selected_units.append(optimal_unit)
+            for input_node in func_units[optimal_unit].input_nodes:
+                simulate_task_tree(obj_nodes[input_node.id])
+
+    simulate_task_tree(target_node)
+    return selected_units
+
+
+# Test that drawing the rollouts of all candidate units at once and keeping the statistics in arrays
+# chooses the same task trees, for the same random stream, as simulating the units one at a time
+def test_MCTS_matches_per_unit_search():
+    graph, kitchen, reachable, unit_probabilities, goal_nodes = load_test_data()
+    object_nodes, functional_units, _ = graph
+
+    goals = goal_nodes + object_nodes[::50]
+    for goal_node in goals:
+        for seed in range(3):
+            for goal_reachable in (None, reachable):
+                expected = search_MCTS_per_unit(kitchen, goal_node, *graph, 100, goal_reachable, unit_probabilities,
+                                                seed)
+                task_tree = search_MCTS(kitchen, goal_node, *graph, iterations=100, reachable=goal_reachable,
+                                        unit_probabilities=unit_probabilities, rng=seed)
+                assert [FU.id for FU in task_tree] == expected, \
+                    f"different task tree for object {goal_node.id} with seed {seed}"
+
+
+# Test that the running trial total of the array statistics stays the sum of the trials of every
+# unit over many descents, and that merging statistics (as from the workers of a parallel search)
+# adds them up and takes them away again
+def test_MCTS_statistics():
+    graph, kitchen, reachable, unit_probabilities, goal_nodes = load_test_data()
+    _, functional_units, _ = graph
+    rng = np.random.default_rng(0)
+
+    statistics = MCTSStatistics(len(functional_units))
+    for goal_node in goal_nodes:
+        for _ in range(5):
+            task_tree_indices = run_MCTS_pass(kitchen, goal_node, *graph, 10, reachable, unit_probabilities, rng,
+                                              statistics)
+            assert all(statistics.trials[task_tree_indices] > 0), "every chosen unit was simulated"
+    assert statistics.total_trials == statistics.trials.sum() > 0
+    assert np.all(statistics.wins <= statistics.trials * 10)
+
+    merged = statistics.copy()
+    merged.merge(statistics)
+    assert np.array_equal(merged.wins, 2 * statistics.wins)
+    assert merged.total_trials == 2 * statistics.total_trials
+    merged.merge(statistics, -1)
+    merged.merge(statistics, -1)
+    assert not merged.wins.any() and not merged.trials.any() and merged.total_trials == 0
+
+
+# Test that root-parallel MCTS is repeatable: the same seed and number of workers give the same task
+# tree and the same merged statistics (recorded in a store), with its own pool or a shared one
+def test_MCTS_parallel_is_repeatable():
+    graph, kitchen, reachable, unit_probabilities, goal_nodes = load_test_data()
+    _, functional_units, _ = graph
+    options = dict(iterations=10, workers=2, passes=3, reachable=reachable, unit_probabilities=unit_probabilities)
+
+    executor = make_MCTS_executor(2, kitchen, *graph, reachable, unit_probabilities)
+    try:
+        for goal_node in filter(reachable.is_makeable, goal_nodes):
+            results = []
+            for seed, goal_executor in ((7, None), (7, executor), (8, executor)):
+                store = MCTSStatisticsStore(len(functional_units))
+                task_tree = search_MCTS_parallel(kitchen, goal_node, *graph, seed=seed, executor=goal_executor,
+                                                 store=store, **options)
+                results.append(([FU.id for FU in task_tree], store.successes, store.executions))
+
+            (tree, successes, executions), (same_tree, same_successes, same_executions), other = results
+            assert same_tree == tree
+            assert np.array_equal(same_successes, successes) and np.array_equal(same_executions, executions)
+            assert executions.sum() > 0, "the workers simulated units"
+            assert not np.array_equal(other[1], successes), "another seed draws other rollouts"
+    finally:
+        executor.shutdown()
+
+
+# Test that a statistics store decays older searches, gives a search its counts in the scale of the
+# search's iterations, and reads back a saved snapshot only for the same graph_key and number of units
+def test_MCTS_statistics_store():
+    graph, kitchen, reachable, unit_probabilities, goal_nodes = load_test_data()
+    _, functional_units, _ = graph
+    rng = np.random.default_rng(0)
+
+    store = MCTSStatisticsStore(len(functional_units), decay=0.5, graph_key='FOON.txt:1')
+    first = MCTSStatistics(len(functional_units))
+    run_MCTS_pass(kitchen, goal_nodes[0], *graph, 10, reachable, unit_probabilities, rng, first)
+    store.add(first, 10)
+    assert np.array_equal(store.successes, first.wins) and np.array_equal(store.executions, first.trials * 10)
+
+    # a search of 100 iterations per trial, seeded from the store, adds only what it simulated
+    seed = store.get_statistics(100)
+    assert np.allclose(seed.trials * 100, store.executions) and seed.total_trials == pytest.approx(seed.trials.sum())
+    second = seed.copy()
+    run_MCTS_pass(kitchen, goal_nodes[0], *graph, 100, reachable, unit_probabilities, rng, second)
+    store.add(second, 100, seed)
+    assert np.allclose(store.successes, 0.5 * first.wins + (second.wins - seed.wins))
+    assert np.allclose(store.executions, 0.5 * first.trials * 10 + (second.trials - seed.trials) * 100)
+    assert store.searches == 2
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_file = os.path.join(tmp_dir, 'MCTS_statistics.npz')
+        store.save(snapshot_file)
+
+        loaded = MCTSStatisticsStore(len(functional_units), filepath=snapshot_file, graph_key='FOON.txt:1')
+        assert np.array_equal(loaded.successes, store.successes)
+        assert np.array_equal(loaded.executions, store.executions)
+        assert loaded.searches == 2
+
+        # a snapshot of another graph, or of a graph with another number of units, is not used
+        for num_units, graph_key in ((len(functional_units), 'FOON.txt:2'), (len(functional_units) + 1, 'FOON.txt:1')):
+            rejected = MCTSStatisticsStore(num_units, filepath=snapshot_file, graph_key=graph_key)
+            assert len(rejected.successes) == num_units
+            assert not rejected.successes.any() and not rejected.executions.any() and rejected.searches == 0
+
+
+# Test that search_MCTS stays within its budget: it never simulates more executions than
+# max_rollouts (none at all for 0) and stops close to time_limit, still giving a task tree whose every
+# input is in the kitchen or made by a unit of the tree, with 0 <= lower bound <= estimate <= 1; in
+# kitchens with part of the items too, for every goal the ReachabilityIndex calls makeable
+def test_MCTS_search_with_budget():
+    graph, kitchen, reachable, unit_probabilities, goal_nodes = load_test_data()
+    object_nodes, functional_units, object_to_FU_map = graph
+    rng = random.Random(0)
+    kitchens = [(kitchen, reachable)]
+    for percent in (30, 60, 90):
+        reduced_kitchen = KitchenIndex(rng.sample(kitchen.kitchen_items, len(kitchen) * percent // 100), object_nodes)
+        kitchens.append((reduced_kitchen, ReachabilityIndex(reduced_kitchen, object_nodes, functional_units,
+                                                            object_to_FU_map, get_inputs=get_unit_inputs)))
+
+    for kitchen, reachable in kitchens:
+        goals = [node for node in goal_nodes + object_nodes[::10] if reachable.is_makeable(node)]
+        for goal_node in goals:
+            for budget in ({'max_rollouts': 0}, {'max_rollouts': 1000}, {'max_rollouts': 50000}, {'time_limit': 0.01}):
+                stats = {}
+                start = time.perf_counter()
+                task_tree = search_MCTS(kitchen, goal_node, *graph, reachable=reachable,
+                                        unit_probabilities=unit_probabilities, rng=0, stats=stats, **budget)
+                search_time = time.perf_counter() - start
+
+                if 'max_rollouts' in budget:
+                    assert stats["rollouts"] <= budget['max_rollouts']
+                    if budget['max_rollouts'] == 0:
+                        assert stats["descents"] == 1 and stats["rollouts"] == 0
+                else:
+                    assert search_time < budget['time_limit'] + 0.1
+                assert 0 <= stats["success_lower_bound"] <= stats["success_probability"] <= 1
+
+                made = {output_node.id for FU in task_tree for output_node in FU.output_nodes}
+                if not kitchen.contains(goal_node):
+                    assert goal_node.id in made, f"no unit of the tree makes {goal_node.label} with {budget}"
+                for FU in task_tree:
+                    for input_node in FU.input_nodes:
+                        assert kitchen.contains(object_nodes[input_node.id]) or input_node.id in made, \
+                            f"{input_node.label} is neither in the kitchen nor made, with {budget}"
@@ -1,5 +1,6 @@
 import json
 from FOON_class import Object
+from FOON_index import AttributeIndex
 from search_MCTS import search_MCTS, read_universal_foon, save_paths_to_file  # Assuming your MCTS code is saved as mcts_code.py
 
 # Main function for testing MCTS and generating task trees for different goal objects
@@ -16,6 +17,7 @@ if __name__ == '__main__':
     # Load kitchen items and goal nodes
     kitchen_items = json.load(open('kitchen.json'))
     goal_nodes = json.load(open("goal_nodes.json"))
+    attribute_index = AttributeIndex(foon_object_nodes)
 
     # Iterate over the goal nodes and generate task trees using MCTS
     for node in goal_nodes:
@@ -25,21 +27,19 @@ if __name__ == '__main__':
         node_object.container = node["container"]
 
         # Find the corresponding object in the FOON graph
-        goal_found = False
-        for object in foon_object_nodes:
-            if object.check_object_equal(node_object):
-                goal_found = True
-                print(f"Generating task tree for goal: {node['label']}")
-                
-                # Call MCTS to generate the task tree for the given goal node
-                output_task_tree = search_MCTS(kitchen_items, object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map)
-                
-                # Save the generated task tree to a file
-                output_file_path = f'output_MCTS_{node["label"].replace(" ", "_")}.txt'
-                save_paths_to_file(output_task_tree, output_file_path)
-                print(f"Task tree for {node['label']} saved to {output_file_path}")
-                break
+        goal_id = attribute_index.lookup(node_object)
+        if goal_id != -1:
+            object = foon_object_nodes[goal_id]
+            print(f"Generating task tree for goal: {node['label']}")
+            
+            # Call MCTS to generate the task tree for the given goal node
+            output_task_tree = search_MCTS(kitchen_items, object, foon_object_nodes, foon_functional_units, foon_object_to_FU_map)
+            
+            # Save the generated task tree to a file
+            output_file_path = f'output_MCTS_{node["label"].replace(" ", "_")}.txt'
+            save_paths_to_file(output_task_tree, output_file_path)
+            print(f"Task tree for {node['label']} saved to {output_file_path}")
 
         # If the goal node was not found, print an error message
-        if not goal_found:
+        else:
             print(f'{node_object.label} - Goal node not found in FOON')